@@ -0,0 +1,266 @@
+"""Retention for executions: rows older than a tenant's `retention` move from the execution table into
+gzip-compressed NDJSON segments on disk, indexed by `execution_segment`.
+
+Reads merge the hot table with the segments, so archiving does not change what the API returns.
+
+Usage (archive once, then exit):
+    python -m archive [--tenant tenant_b]
+"""
+import argparse
+import asyncio
+import gzip
+import logging
+import os
+import uuid
+from datetime import datetime
+from typing import List, Optional
+
+from sqlalchemy import select, delete, tuple_
+
+from base_model import ExecutionResponse
+from cache import LRUCache
+from database import SessionLocal, engine, init_models
+from etag import bump_versions
+from models import Execution, ExecutionSegment, EXECUTION_FINISHED
+from search import remove_executions
+from utils import API_KEYS, redis_client
+
+logger = logging.getLogger(__name__)
+
+ARCHIVE_DIR = os.getenv("EXECUTION_ARCHIVE_DIR", "archive")
+ARCHIVE_SEGMENT_ROWS = int(os.getenv("EXECUTION_ARCHIVE_SEGMENT_ROWS", "10000"))
+ARCHIVE_INTERVAL = float(os.getenv("EXECUTION_ARCHIVE_INTERVAL", "3600"))
+ARCHIVE_CACHE_BYTES = int(os.getenv("EXECUTION_ARCHIVE_CACHE_BYTES", str(64 * 1024 * 1024)))
+# Index entries loaded per query while merging a page of executions.
+SEGMENT_BATCH = 8
+ARCHIVE_LOCK_KEY = "execution_archive_lock"
+
+# Segments never change once written, so parsed ones can be kept as long as there is room; room is counted
+# in uncompressed NDJSON bytes, as segment rows hold prompts and responses in full.
+_segment_cache = LRUCache(ARCHIVE_CACHE_BYTES)
+
+
+def execution_key(execution):
+    return execution.timestamp, execution.id
+
+
+def last_key(segment: ExecutionSegment):
+    return segment.last_timestamp, segment.last_id
+
+
+def segment_path(tenant_id: str, first: Execution) -> str:
+    # Named after the first row, so re-archiving after a crash overwrites the orphaned file.
+    return os.path.join(ARCHIVE_DIR, tenant_id, f"{first.timestamp:%Y%m%dT%H%M%S%f}-{first.id}.ndjson.gz")
+
+
+def _write_segment(path: str, records: List[str]):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    temp_path = f"{path}.tmp"
+    with open(temp_path, "wb") as file:
+        with gzip.GzipFile(fileobj=file, mode="wb") as compressed:
+            for record in records:
+                compressed.write((record + "\n").encode())
+        file.flush()
+        os.fsync(file.fileno())
+    os.replace(temp_path, path)
+
+
+def _read_segment(path: str):
+    rows, size = [], 0
+    with gzip.open(path, "rt", encoding="utf-8") as file:
+        for line in file:
+            rows.append(ExecutionResponse.model_validate_json(line))
+            size += len(line)
+    return rows, size
+
+
+async def read_segment(segment: ExecutionSegment) -> List[ExecutionResponse]:
+    """Rows of `segment`, oldest first."""
+    rows = _segment_cache.get(segment.path)
+    if rows is None:
+        rows, size = await asyncio.to_thread(_read_segment, segment.path)
+        _segment_cache.set(segment.path, rows, weight=size)
+    return rows
+
+
+async def archive_tenant(tenant_id: str, before: datetime) -> int:
+    """Moves the tenant's finished executions older than `before` into segments; returns how many moved.
+
+    Each segment is written and synced before its index row is committed and its rows deleted, in
+    one transaction, so a crash leaves at worst an unindexed file."""
+    archived = 0
+    while True:
+        async with SessionLocal() as db:
+            rows = (await db.scalars(
+                select(Execution)
+                .filter(Execution.tenant_id == tenant_id,
+                        Execution.timestamp < before,
+                        Execution.status.in_(EXECUTION_FINISHED))
+                .order_by(Execution.timestamp, Execution.id)
+                .limit(ARCHIVE_SEGMENT_ROWS)
+            )).all()
+            if not rows:
+                return archived
+            path = segment_path(tenant_id, rows[0])
+            # Segments hold the executions as the API returns them, with prompts and responses in full.
+            records = [ExecutionResponse.model_validate(row).model_dump_json() for row in rows]
+            await asyncio.to_thread(_write_segment, path, records)
+            ids = [row.id for row in rows]
+            db.add(ExecutionSegment(
+                tenant_id=tenant_id,
+                path=path,
+                row_count=len(rows),
+                agent_ids=sorted({row.agent_id for row in rows}),
+                first_timestamp=rows[0].timestamp,
+                first_id=rows[0].id,
+                last_timestamp=rows[-1].timestamp,
+                last_id=rows[-1].id,
+                min_id=min(ids),
+                max_id=max(ids)
+            ))
+            await remove_executions(db, ids)
+            await db.execute(delete(Execution).filter(Execution.id.in_(ids)))
+            await db.commit()
+        # Listings read the moved rows back from the segment, but searches no longer find them.
+        await bump_versions(tenant_id, "executions")
+        archived += len(rows)
+        logger.info("Archived %s executions of %s to %s", len(rows), tenant_id, path)
+        if len(rows) < ARCHIVE_SEGMENT_ROWS:
+            return archived
+
+
+async def archive_executions(tenant_ids=None) -> dict:
+    """Runs retention for every tenant with a `retention` in API_KEYS, or only `tenant_ids`."""
+    now = datetime.utcnow()
+    return {
+        tenant_id: await archive_tenant(tenant_id, now - config["retention"])
+        for tenant_id, config in API_KEYS.items()
+        if config.get("retention") and (tenant_ids is None or tenant_id in tenant_ids)
+    }
+
+
+async def find_segments(db, tenant_id: str, agent_id: Optional[int] = None, before=None, newer_than=None,
+                        older_than=None, limit: Optional[int] = None) -> List[ExecutionSegment]:
+    """Index entries of the tenant's segments, newest first by their last row.
+
+    `before` is a (timestamp, id) cursor: only segments holding older rows. `newer_than` and `older_than`
+    bound the key of a segment's last row (inclusive and exclusive), so the index can be read `limit`
+    entries at a time."""
+    query = select(ExecutionSegment).filter(ExecutionSegment.tenant_id == tenant_id)
+    last = tuple_(ExecutionSegment.last_timestamp, ExecutionSegment.last_id)
+    if before is not None:
+        query = query.filter(tuple_(ExecutionSegment.first_timestamp, ExecutionSegment.first_id) < tuple_(*before))
+    if newer_than is not None:
+        query = query.filter(last >= tuple_(*newer_than))
+    if older_than is not None:
+        query = query.filter(last < tuple_(*older_than))
+    query = query.order_by(ExecutionSegment.last_timestamp.desc(), ExecutionSegment.last_id.desc()).limit(limit)
+    segments = (await db.scalars(query)).all()
+    return [segment for segment in segments if not agent_id or agent_id in segment.agent_ids]
+
+
+async def archived_agent_ids(db, tenant_id: str, agent_ids) -> set:
+    """Those of `agent_ids` with executions in the tenant's segments."""
+    agent_ids, found = set(agent_ids), set()
+    if not agent_ids:
+        return found
+    for segment_agent_ids in await db.scalars(
+        select(ExecutionSegment.agent_ids).filter(ExecutionSegment.tenant_id == tenant_id)
+    ):
+        found.update(agent_ids.intersection(segment_agent_ids))
+    return found
+
+
+async def merge_segments(db, tenant_id: str, executions, segments, limit: int, agent_id: Optional[int] = None,
+                         before=None):
+    """Merges archived rows into `executions` (newest first, at most `limit`).
+
+    `executions` must be the first `limit` hot rows in that order and `segments` the first SEGMENT_BATCH
+    entries of `find_segments(db, tenant_id, before=before)`. Further entries are loaded a batch at a time,
+    only those that can still hold rows for the page; segments older than the last kept row are not read."""
+    while segments:
+        for segment in segments:
+            if len(executions) >= limit and last_key(segment) < execution_key(executions[-1]):
+                return executions
+            if agent_id and agent_id not in segment.agent_ids:
+                continue
+            archived = [
+                execution for execution in await read_segment(segment)
+                if (not agent_id or execution.agent_id == agent_id)
+                and (before is None or execution_key(execution) < tuple(before))
+            ]
+            executions = sorted([*executions, *archived], key=execution_key, reverse=True)[:limit]
+        segments = await find_segments(db, tenant_id, before=before, older_than=last_key(segments[-1]),
+                                       newer_than=execution_key(executions[-1]) if len(executions) >= limit else None,
+                                       limit=SEGMENT_BATCH)
+    return executions
+
+
+async def find_archived_execution(db, tenant_id: str, execution_id: int) -> Optional[ExecutionResponse]:
+    segments = await db.scalars(
+        select(ExecutionSegment).filter(ExecutionSegment.tenant_id == tenant_id,
+                                        ExecutionSegment.min_id <= execution_id,
+                                        ExecutionSegment.max_id >= execution_id)
+    )
+    for segment in segments:
+        for execution in await read_segment(segment):
+            if execution.id == execution_id:
+                return execution
+    return None
+
+
+async def iter_archived(db, tenant_id: str, agent_id: Optional[int] = None,
+                        since: Optional[datetime] = None, until: Optional[datetime] = None):
+    """Yields the matching archived rows one segment at a time, oldest first."""
+    for segment in reversed(await find_segments(db, tenant_id, agent_id)):
+        if (since and segment.last_timestamp < since) or (until and segment.first_timestamp >= until):
+            continue
+        yield [
+            execution for execution in await read_segment(segment)
+            if (not agent_id or execution.agent_id == agent_id)
+            and (not since or execution.timestamp >= since)
+            and (not until or execution.timestamp < until)
+        ]
+
+
+class ExecutionArchiver:
+    """Runs retention every `interval` seconds.
+
+    A Redis key held for one interval makes a single worker per interval do the work."""
+
+    def __init__(self, interval: float = ARCHIVE_INTERVAL):
+        self.interval = interval
+        self._task = None
+
+    def start(self):
+        if any(config.get("retention") for config in API_KEYS.values()):
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    async def _run(self):
+        while True:
+            try:
+                if await redis_client.set(ARCHIVE_LOCK_KEY, uuid.uuid4().hex, nx=True, px=int(self.interval * 1000)):
+                    await archive_executions()
+            except Exception:
+                logger.exception("Execution archiving failed")
+            await asyncio.sleep(self.interval)
+
+
+async def main(tenant_ids=None):
+    await init_models()
+    for tenant_id, archived in (await archive_executions(tenant_ids)).items():
+        print(f"{tenant_id}: archived {archived} executions")
+    await engine.dispose()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Archive executions older than each tenant's retention.")
+    parser.add_argument("--tenant", action="append", help="only this tenant (repeatable)")
+    args = parser.parse_args()
+    asyncio.run(main(args.tenant))
@@ -1,7 +1,7 @@
 from datetime import datetime
-from typing import List, Optional
+from typing import List, Optional, Literal
 
-from pydantic import BaseModel, ConfigDict
+from pydantic import BaseModel, ConfigDict, Field
 
 
 class ToolBase(BaseModel):
@@ -49,6 +49,7 @@ class AgentResponse(BaseModel):
 class AgentRunRequest(BaseModel):
     task: str
     model: str = "gpt-4o"
+    use_cache: bool = True
 
 
 class AgentRunResponse(BaseModel):
@@ -57,18 +58,129 @@ class AgentRunResponse(BaseModel):
     agent_name: str
     prompt: str
     model: str
-    response: str
+    response: Optional[str]
     timestamp: datetime
+    status: str
+    cached: bool = False
 
     model_config = ConfigDict(from_attributes=True)
 
 
+MAX_BATCH_SIZE = 100
+
+
+class AgentBatchRunItem(AgentRunRequest):
+    agent_id: int
+
+
+class AgentBatchRunRequest(BaseModel):
+    items: List[AgentBatchRunItem] = Field(min_length=1, max_length=MAX_BATCH_SIZE)
+
+
+class AgentBatchRunResult(BaseModel):
+    status_code: int
+    detail: Optional[str] = None
+    execution: Optional[AgentRunResponse] = None
+
+
+class AgentBatchRunResponse(BaseModel):
+    results: List[AgentBatchRunResult]
+
+
 class ExecutionResponse(BaseModel):
     id: int
     agent_id: int
     prompt: str
     model: str
-    response: str
+    response: Optional[str]
     timestamp: datetime
+    status: str
+    cached: bool = False
+    error: Optional[str] = None
 
     model_config = ConfigDict(from_attributes=True)
+
+
+class ExecutionSearchResult(ExecutionResponse):
+    rank: float
+
+
+class ExecutionStatsBucket(BaseModel):
+    # agent_id and model are set when the stats are grouped by them.
+    bucket: datetime
+    agent_id: Optional[int] = None
+    model: Optional[str] = None
+    runs: int
+    succeeded: int
+    failed: int
+    cached: int
+    prompt_tokens: int
+    response_tokens: int
+
+
+MAX_BULK_SIZE = 1000
+# atomic: any invalid item rejects the whole request; partial: valid items are applied, invalid ones reported.
+BulkMode = Literal["atomic", "partial"]
+
+
+class ToolBulkCreateRequest(BaseModel):
+    items: List[ToolBase] = Field(min_length=1, max_length=MAX_BULK_SIZE)
+    mode: BulkMode = "atomic"
+
+
+class ToolBulkUpdateItem(ToolUpdate):
+    id: int
+
+
+class ToolBulkUpdateRequest(BaseModel):
+    items: List[ToolBulkUpdateItem] = Field(min_length=1, max_length=MAX_BULK_SIZE)
+    mode: BulkMode = "atomic"
+
+
+class ToolBulkResult(BaseModel):
+    status_code: int
+    detail: Optional[str] = None
+    tool: Optional[ToolResponse] = None
+
+
+class ToolBulkResponse(BaseModel):
+    results: List[ToolBulkResult]
+
+
+class AgentBulkCreateRequest(BaseModel):
+    items: List[AgentBase] = Field(min_length=1, max_length=MAX_BULK_SIZE)
+    mode: BulkMode = "atomic"
+
+
+class AgentBulkUpdateItem(AgentUpdate):
+    id: int
+
+
+class AgentBulkUpdateRequest(BaseModel):
+    items: List[AgentBulkUpdateItem] = Field(min_length=1, max_length=MAX_BULK_SIZE)
+    mode: BulkMode = "atomic"
+
+
+class AgentBulkResult(BaseModel):
+    status_code: int
+    detail: Optional[str] = None
+    agent: Optional[AgentResponse] = None
+
+
+class AgentBulkResponse(BaseModel):
+    results: List[AgentBulkResult]
+
+
+class BulkDeleteRequest(BaseModel):
+    ids: List[int] = Field(min_length=1, max_length=MAX_BULK_SIZE)
+    mode: BulkMode = "atomic"
+
+
+class BulkDeleteResult(BaseModel):
+    id: int
+    status_code: int
+    detail: Optional[str] = None
+
+
+class BulkDeleteResponse(BaseModel):
+    results: List[BulkDeleteResult]
@@ -0,0 +1,120 @@
+"""Latency of filtered and paged GET /agents and GET /tools, with and without the name indexes.
+
+Seeds `--agents` agents for a dedicated tenant, each using two of `--agents / 10` tools (once; reruns
+reuse them). It then times an exact name, a case-insensitive name prefix, the agents of a tool, the tools
+of an agent, a first page and a page deep into the list. The same requests run again after dropping the
+(tenant_id, name), (tenant_id, lower(name)) and agent_tools (tool_id, agent_id) indexes, which are
+recreated afterwards.
+
+Usage:
+    python -m benchmarks.agent_listing --agents 100000
+"""
+import argparse
+import asyncio
+import statistics
+import time
+from datetime import timedelta
+
+import httpx
+from sqlalchemy import select, func, insert
+
+from database import SessionLocal, engine
+from main import app
+from models import Agent, Tool, agent_tools
+from utils import API_KEYS, encode_id_cursor
+
+BENCH_TENANT = "tenant_bench_listing"
+BATCH = 10_000
+NAME_INDEXES = [index for table in (Agent.__table__, Tool.__table__, agent_tools) for index in table.indexes
+                if index.name.endswith(("_name", "_tool_id"))]
+
+
+async def seed(agents):
+    async with SessionLocal() as db:
+        existing = await db.scalar(select(func.count()).select_from(Agent).filter(Agent.tenant_id == BENCH_TENANT))
+        if existing >= agents:
+            return
+        tools = max(agents // 10, 2)
+        await db.execute(insert(Tool.__table__), [
+            {"tenant_id": BENCH_TENANT, "name": f"Tool-{i:06d}", "description": "bench"} for i in range(tools)
+        ])
+        tool_ids = (await db.scalars(select(Tool.id).filter(Tool.tenant_id == BENCH_TENANT)
+                                     .order_by(Tool.id))).all()
+        for offset in range(existing, agents, BATCH):
+            await db.execute(insert(Agent.__table__), [
+                {"tenant_id": BENCH_TENANT, "name": f"Agent-{i:06d}", "role": "bench", "description": "bench"}
+                for i in range(offset, min(offset + BATCH, agents))
+            ])
+        agent_ids = (await db.scalars(select(Agent.id).filter(Agent.tenant_id == BENCH_TENANT)
+                                      .order_by(Agent.id))).all()
+        links = [{"agent_id": agent_id, "tool_id": tool_ids[(i + k) % len(tool_ids)]}
+                 for i, agent_id in enumerate(agent_ids) for k in (0, 1)]
+        for offset in range(0, len(links), BATCH):
+            await db.execute(insert(agent_tools), links[offset:offset + BATCH])
+        await db.commit()
+
+
+async def timed(call, repeat):
+    samples = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        result = await call()
+        samples.append((time.perf_counter() - started) * 1000)
+    return statistics.median(samples), result
+
+
+async def run_requests(client, requests, repeat):
+    async def get(path, params):
+        response = await client.get(path, params=params, headers={"X-API-Key": BENCH_TENANT})
+        response.raise_for_status()
+        return response
+
+    results = []
+    for label, path, params in requests:
+        latency, response = await timed(lambda: get(path, params), repeat)
+        results.append((label, latency, len(response.json())))
+    return results
+
+
+async def main(agents, repeat):
+    API_KEYS[BENCH_TENANT] = {"request_limit": 10 ** 9, "limit_window": timedelta(days=1)}
+    async with app.router.lifespan_context(app):
+        await seed(agents)
+        transport = httpx.ASGITransport(app=app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://bench") as client:
+            page = (await client.get("/agents", params={"page_size": 100},
+                                     headers={"X-API-Key": BENCH_TENANT})).headers["X-Next-Cursor"]
+            async with SessionLocal() as db:
+                middle = await db.scalar(select(Agent.id).filter(Agent.tenant_id == BENCH_TENANT)
+                                         .order_by(Agent.id).offset(agents // 2).limit(1))
+            deep = encode_id_cursor(middle)
+            requests = [
+                ("agents, exact name", "/agents", {"name": f"Agent-{agents // 2:06d}"}),
+                ("agents, name prefix", "/agents", {"name": f"agent-{agents // 200:04d}", "match": "prefix"}),
+                ("agents, tool name", "/agents", {"tool_name": "Tool-000042", "page_size": 100}),
+                ("tools, agent name", "/tools", {"agent_name": f"Agent-{agents // 2:06d}"}),
+                ("agents, page 2 of 100", "/agents", {"page_size": 100, "cursor": page}),
+                ("agents, page at the middle", "/agents", {"page_size": 100, "cursor": deep}),
+            ]
+            indexed = await run_requests(client, requests, repeat)
+            async with engine.begin() as conn:
+                for index in NAME_INDEXES:
+                    await conn.run_sync(index.drop)
+            try:
+                unindexed = await run_requests(client, requests, repeat)
+            finally:
+                async with engine.begin() as conn:
+                    for index in NAME_INDEXES:
+                        await conn.run_sync(index.create)
+
+    print(f"{'listing (' + str(agents) + ' agents)':<30}{'indexed':>12}{'no index':>12}{'rows':>8}")
+    for (label, indexed_ms, rows), (_, unindexed_ms, _) in zip(indexed, unindexed):
+        print(f"{label:<30}{indexed_ms:>9.1f} ms{unindexed_ms:>9.1f} ms{rows:>8}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--agents", type=int, default=100_000)
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+    asyncio.run(main(args.agents, args.repeat))
@@ -0,0 +1,94 @@
+"""Latency of GET /executions for shallow and deep pages, OFFSET vs keyset cursor.
+
+Seeds `--rows` executions for a dedicated tenant (once; reruns reuse them), then times the first page,
+an OFFSET page at `--depth` and the keyset page at the same depth. Keyset pages should cost about the
+same as the first page; OFFSET pages grow with depth.
+
+Usage:
+    python -m benchmarks.execution_pagination --rows 1000000 --depth 0.9
+"""
+import argparse
+import asyncio
+import statistics
+import time
+from datetime import datetime, timedelta
+
+import httpx
+from sqlalchemy import select, func, insert
+
+from database import SessionLocal
+from main import app
+from models import Agent, Execution
+from utils import API_KEYS, encode_cursor
+
+BENCH_TENANT = "tenant_bench_pages"
+BATCH = 10_000
+
+
+async def seed(rows):
+    async with SessionLocal() as db:
+        existing = await db.scalar(select(func.count()).select_from(Execution)
+                                   .filter(Execution.tenant_id == BENCH_TENANT))
+        if existing >= rows:
+            return
+        agent = Agent(tenant_id=BENCH_TENANT, name="bench", role="bench", description="bench")
+        db.add(agent)
+        await db.flush()
+        start = datetime.utcnow() - timedelta(seconds=rows)
+        for offset in range(existing, rows, BATCH):
+            await db.execute(insert(Execution.__table__), [
+                {"tenant_id": BENCH_TENANT, "agent_id": agent.id, "prompt": f"prompt {i}", "model": "gpt-4o",
+                 "response": f"response {i}", "timestamp": start + timedelta(seconds=i)}
+                for i in range(offset, min(offset + BATCH, rows))
+            ])
+        await db.commit()
+
+
+async def cursor_at(position):
+    # Cursor of the row just before `position`, i.e. the one a client would hold after paging there.
+    async with SessionLocal() as db:
+        row = (await db.execute(
+            select(Execution.timestamp, Execution.id)
+            .filter(Execution.tenant_id == BENCH_TENANT)
+            .order_by(Execution.timestamp.desc(), Execution.id.desc())
+            .offset(position - 1).limit(1)
+        )).one()
+    return encode_cursor(row.timestamp, row.id)
+
+
+async def timed(client, params, repeat):
+    samples = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        response = await client.get("/executions", params=params, headers={"X-API-Key": BENCH_TENANT})
+        samples.append((time.perf_counter() - started) * 1000)
+        response.raise_for_status()
+    return statistics.median(samples)
+
+
+async def main(rows, depth, page_size, repeat):
+    API_KEYS[BENCH_TENANT] = {"request_limit": 10 ** 9, "limit_window": timedelta(days=1)}
+    async with app.router.lifespan_context(app):
+        await seed(rows)
+        page = max(1, int(rows * depth) // page_size)
+        cursor = await cursor_at((page - 1) * page_size) if page > 1 else None
+        transport = httpx.ASGITransport(app=app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://bench") as client:
+            first = await timed(client, {"page_size": page_size}, repeat)
+            offset = await timed(client, {"page": page, "page_size": page_size}, repeat)
+            keyset = await timed(client, {"cursor": cursor, "page_size": page_size} if cursor
+                                 else {"page_size": page_size}, repeat)
+    print(f"rows={rows} page_size={page_size} deep page={page}")
+    print(f"first page          {first:8.2f} ms")
+    print(f"deep page (offset)  {offset:8.2f} ms")
+    print(f"deep page (cursor)  {keyset:8.2f} ms")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--rows", type=int, default=1_000_000)
+    parser.add_argument("--depth", type=float, default=0.9)
+    parser.add_argument("--page-size", type=int, default=50)
+    parser.add_argument("--repeat", type=int, default=20)
+    args = parser.parse_args()
+    asyncio.run(main(args.rows, args.depth, args.page_size, args.repeat))
@@ -0,0 +1,113 @@
+"""Latency of GET /executions/search for rare and common words, vs a LIKE scan over the execution table.
+
+Seeds `--rows` executions for a dedicated tenant with prompts and responses drawn from a Zipf-distributed
+vocabulary (once; reruns reuse them), indexes them with the `python -m search` code and reports how long
+that took. It then times searches for a rare word, a common word (matched by most executions, so it stops
+after EXECUTION_SEARCH_MAX_CANDIDATES matches with a 400), two words, and their page after a cursor, next to a
+`LIKE '%word%'` count over the stored text, which is what searching without the index costs.
+
+Usage:
+    python -m benchmarks.execution_search --rows 1000000
+"""
+import argparse
+import asyncio
+import random
+import statistics
+import time
+from datetime import datetime, timedelta
+
+import httpx
+from sqlalchemy import select, func, insert, or_
+
+import search
+from database import SessionLocal
+from main import app
+from models import Agent, Execution
+from utils import API_KEYS
+
+BENCH_TENANT = "tenant_bench_search"
+BATCH = 10_000
+VOCABULARY = [f"term{rank}" for rank in range(1, 20_001)]
+WEIGHTS = [1 / rank for rank in range(1, len(VOCABULARY) + 1)]
+
+
+def words(rng, count):
+    return " ".join(rng.choices(VOCABULARY, WEIGHTS, k=count))
+
+
+async def seed(rows):
+    async with SessionLocal() as db:
+        existing = await db.scalar(select(func.count()).select_from(Execution)
+                                   .filter(Execution.tenant_id == BENCH_TENANT))
+        if existing >= rows:
+            return False
+        agent = Agent(tenant_id=BENCH_TENANT, name="bench", role="bench", description="bench")
+        db.add(agent)
+        await db.flush()
+        rng = random.Random(existing)
+        start = datetime.utcnow() - timedelta(seconds=rows)
+        for offset in range(existing, rows, BATCH):
+            await db.execute(insert(Execution.__table__), [
+                {"tenant_id": BENCH_TENANT, "agent_id": agent.id, "prompt": words(rng, 12), "model": "gpt-4o",
+                 "response": words(rng, 40), "timestamp": start + timedelta(seconds=i)}
+                for i in range(offset, min(offset + BATCH, rows))
+            ])
+        await db.commit()
+    return True
+
+
+async def like_count(word):
+    async with SessionLocal() as db:
+        return await db.scalar(
+            select(func.count()).select_from(Execution)
+            .filter(Execution.tenant_id == BENCH_TENANT,
+                    or_(Execution.stored_prompt.like(f"%{word} %"), Execution.stored_response.like(f"%{word} %")))
+        )
+
+
+async def timed(call, repeat):
+    samples = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        result = await call()
+        samples.append((time.perf_counter() - started) * 1000)
+    return statistics.median(samples), result
+
+
+async def main(rows, page_size, repeat):
+    API_KEYS[BENCH_TENANT] = {"request_limit": 10 ** 9, "limit_window": timedelta(days=1)}
+    async with app.router.lifespan_context(app):
+        if await seed(rows):
+            started = time.perf_counter()
+            indexed = await search.reindex([BENCH_TENANT])
+            elapsed = time.perf_counter() - started
+            print(f"index: {indexed} executions in {elapsed:.1f} s ({indexed / elapsed:,.0f} executions/s)")
+
+        transport = httpx.ASGITransport(app=app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://bench") as client:
+            async def get(params):
+                response = await client.get("/executions/search", params={"page_size": page_size, **params},
+                                            headers={"X-API-Key": BENCH_TENANT})
+                return response
+
+            first = await get({"q": "term2 term30"})
+            queries = [
+                ("rare word", {"q": "term15000"}, "term15000"),
+                ("common word", {"q": "term1"}, "term1"),
+                ("two words", {"q": "term2 term30"}, None),
+                ("two words, page 2", {"q": "term2 term30", "cursor": first.headers.get("X-Next-Cursor")}, None),
+            ]
+            print(f"{'search (' + str(rows) + ' executions)':<34}{'index':>12}{'LIKE scan':>12}")
+            for label, params, like_word in queries:
+                index_ms, _ = await timed(lambda: get(params), repeat)
+                like_ms = (await timed(lambda: like_count(like_word), 1))[0] if like_word else None
+                print(f"{label:<34}{index_ms:>9.1f} ms" + (f"{like_ms:>9.1f} ms" if like_ms is not None else ""))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--rows", type=int, default=1_000_000)
+    parser.add_argument("--page-size", type=int, default=20)
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+    asyncio.run(main(args.rows, args.page_size, args.repeat))
@@ -0,0 +1,115 @@
+"""Latency of per-day execution stats: GET /executions/stats (rollups) vs GROUP BY over the execution table.
+
+Seeds `--rows` executions for a dedicated tenant spread over `--days` days, across a few agents and two
+models (once; reruns reuse them), rebuilds its rollups with the backfill command's code and reports how
+long that took. It then times the stats for the whole range grouped by agent and model, from the rollups
+and from an ad-hoc GROUP BY computing the run counts. The GROUP BY grows with the executions; the
+rollups grow only with the buckets.
+
+Usage:
+    python -m benchmarks.execution_stats --rows 1000000 --days 30
+"""
+import argparse
+import asyncio
+import statistics
+import time
+from datetime import datetime, timedelta
+
+import httpx
+from sqlalchemy import select, func, insert, case
+
+import rollups
+from database import SessionLocal, engine
+from main import app
+from models import Agent, Execution, EXECUTION_SUCCEEDED, EXECUTION_FAILED
+from utils import API_KEYS
+
+BENCH_TENANT = "tenant_bench_stats"
+BATCH = 10_000
+AGENTS = 5
+MODELS = ["gpt-4o", "claude-3-opus"]
+
+
+async def seed(rows, days):
+    async with SessionLocal() as db:
+        existing = await db.scalar(select(func.count()).select_from(Execution)
+                                   .filter(Execution.tenant_id == BENCH_TENANT))
+        if existing >= rows:
+            return
+        agents = [Agent(tenant_id=BENCH_TENANT, name=f"bench {i}", role="bench", description="bench")
+                  for i in range(AGENTS)]
+        db.add_all(agents)
+        await db.flush()
+        start = datetime.utcnow() - timedelta(days=days)
+        spacing = timedelta(days=days) / rows
+        for offset in range(existing, rows, BATCH):
+            await db.execute(insert(Execution.__table__), [
+                {"tenant_id": BENCH_TENANT, "agent_id": agents[i % AGENTS].id, "prompt": f"prompt {i}",
+                 "model": MODELS[i % len(MODELS)], "response": f"response {i}",
+                 "status": EXECUTION_FAILED if i % 50 == 0 else EXECUTION_SUCCEEDED,
+                 "timestamp": start + spacing * i}
+                for i in range(offset, min(offset + BATCH, rows))
+            ])
+        await db.commit()
+
+
+def day_of(column):
+    return func.date_trunc("day", column) if engine.dialect.name == "postgresql" else func.date(column)
+
+
+async def group_by_stats(since):
+    day = day_of(Execution.timestamp)
+    async with SessionLocal() as db:
+        return (await db.execute(
+            select(day, Execution.agent_id, Execution.model, func.count(),
+                   func.sum(case((Execution.status == EXECUTION_SUCCEEDED, 1), else_=0)),
+                   func.sum(case((Execution.status == EXECUTION_FAILED, 1), else_=0)))
+            .filter(Execution.tenant_id == BENCH_TENANT, Execution.timestamp >= since)
+            .group_by(day, Execution.agent_id, Execution.model)
+        )).all()
+
+
+async def timed(call, repeat):
+    samples = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        result = await call()
+        samples.append((time.perf_counter() - started) * 1000)
+    return statistics.median(samples), result
+
+
+async def main(rows, days, repeat):
+    API_KEYS[BENCH_TENANT] = {"request_limit": 10 ** 9, "limit_window": timedelta(days=1)}
+    async with app.router.lifespan_context(app):
+        await seed(rows, days)
+        started = time.perf_counter()
+        counted = await rollups.rebuild_tenant(BENCH_TENANT)
+        rebuild_seconds = time.perf_counter() - started
+        print(f"backfill: {counted} executions in {rebuild_seconds:.1f} s "
+              f"({counted / rebuild_seconds:,.0f} executions/s)")
+
+        since = (datetime.utcnow() - timedelta(days=days + 1)).replace(hour=0, minute=0, second=0, microsecond=0)
+        params = {"granularity": "day", "since": since.isoformat(), "group_by": ["agent_id", "model"]}
+        transport = httpx.ASGITransport(app=app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://bench") as client:
+            async def stats():
+                response = await client.get("/executions/stats", params=params, headers={"X-API-Key": BENCH_TENANT})
+                response.raise_for_status()
+                return response.json()
+
+            rollup_ms, buckets = await timed(stats, repeat)
+        group_by_ms, groups = await timed(lambda: group_by_stats(since), repeat)
+        assert sum(bucket["runs"] for bucket in buckets) == sum(group[3] for group in groups) == counted
+
+    print(f"{'stats (' + str(rows) + ' executions)':<36}{'latency':>12}{'rows read':>12}")
+    print(f"{'GET /executions/stats (rollups)':<36}{rollup_ms:>9.1f} ms{len(buckets):>12}")
+    print(f"{'GROUP BY over executions':<36}{group_by_ms:>9.1f} ms{counted:>12}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--rows", type=int, default=1_000_000)
+    parser.add_argument("--days", type=int, default=30)
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+    asyncio.run(main(args.rows, args.days, args.repeat))
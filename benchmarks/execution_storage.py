@@ -0,0 +1,70 @@
+"""Stored prompt and response bytes per execution, full text vs prompt template + task (+ zstd responses).
+
+Creates an agent with a `--description-bytes` long description and three tools, records `--runs`
+executions through POST /agents/{id}/run, and compares the bytes the old layout would store (full
+prompt and response text) with what is stored now, the shared template counted once.
+
+Usage (Postgres and Redis running, see README):
+    python -m benchmarks.execution_storage --runs 1000 --description-bytes 2000
+    EXECUTION_RESPONSE_COMPRESSION=zstd python -m benchmarks.execution_storage --runs 1000
+"""
+import argparse
+import asyncio
+from datetime import timedelta
+
+import httpx
+from sqlalchemy import select
+
+import compression
+from database import SessionLocal
+from main import app
+from migrate_executions import stored_size
+from models import Execution
+from utils import API_KEYS
+
+BENCH_TENANT = "tenant_bench_storage"
+
+
+async def main(runs, description_bytes):
+    API_KEYS[BENCH_TENANT] = {"request_limit": 10 ** 9, "limit_window": timedelta(days=1)}
+    headers = {"X-API-Key": BENCH_TENANT}
+    transport = httpx.ASGITransport(app=app)
+    async with app.router.lifespan_context(app):
+        async with httpx.AsyncClient(transport=transport, base_url="http://bench") as client:
+            tool_ids = [(await client.post("/tools", json={"name": f"tool {i}", "description": "Looks things up " * 8},
+                                           headers=headers)).json()["id"]
+                        for i in range(3)]
+            description = ("Answers questions about the quarterly reports. " * description_bytes)[:description_bytes]
+            agent = (await client.post("/agents",
+                                       json={"name": "bench", "role": "analyst", "description": description,
+                                             "tool_ids": tool_ids},
+                                       headers=headers)).json()
+            execution_ids = []
+            for i in range(runs):
+                response = await client.post(f"/agents/{agent['id']}/run",
+                                             json={"task": f"Summarise report number {i}", "model": "gpt-4o"},
+                                             headers=headers)
+                execution_ids.append(response.json()["execution_id"])
+
+        async with SessionLocal() as db:
+            executions = (await db.scalars(select(Execution).filter(Execution.id.in_(execution_ids)))).all()
+            templates = {execution.prompt_template_id: execution.prompt_template for execution in executions}
+
+    full_text = sum(len(execution.prompt.encode()) + len((execution.response or "").encode())
+                    for execution in executions)
+    stored = sum(stored_size(execution) for execution in executions) + sum(
+        len(template.prefix.encode()) + len(template.suffix.encode())
+        for template in templates.values() if template is not None
+    )
+    print(f"response compression: {compression.RESPONSE_COMPRESSION}")
+    print(f"full text   {full_text / len(executions):10.1f} bytes/execution")
+    print(f"stored      {stored / len(executions):10.1f} bytes/execution "
+          f"({100 * (1 - stored / full_text):.1f}% saved, {len(templates)} template(s))")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--runs", type=int, default=1000)
+    parser.add_argument("--description-bytes", type=int, default=2000)
+    args = parser.parse_args()
+    asyncio.run(main(args.runs, args.description_bytes))
@@ -0,0 +1,66 @@
+"""Sustained POST /agents/{id}/run throughput with and without the execution write-behind buffer.
+
+Keeps `--concurrency` run requests in flight for `--duration` seconds in each mode: `direct`
+(one INSERT and commit per run), `buffered` and `flushed` write-behind (see README). The buffered
+rows are flushed when the app shuts down, so every mode ends with the same rows on disk.
+
+Usage (Postgres and Redis running, see README):
+    python -m benchmarks.execution_write_behind --duration 10 --concurrency 64
+"""
+import argparse
+import asyncio
+import time
+from datetime import timedelta
+
+import httpx
+
+from main import app
+from utils import API_KEYS
+from write_behind import execution_write_behind, DURABILITY_BUFFERED, DURABILITY_FLUSHED
+
+BENCH_TENANT = "tenant_bench"
+MODES = ["direct", DURABILITY_BUFFERED, DURABILITY_FLUSHED]
+
+
+async def run_mode(mode, duration, concurrency):
+    execution_write_behind.enabled = mode != "direct"
+    if execution_write_behind.enabled:
+        execution_write_behind.durability = mode
+    transport = httpx.ASGITransport(app=app)
+    async with app.router.lifespan_context(app):
+        async with httpx.AsyncClient(transport=transport, base_url="http://bench") as client:
+            agent = (await client.post("/agents",
+                                       json={"name": "bench", "role": "bench", "description": "bench"},
+                                       headers={"X-API-Key": BENCH_TENANT})).json()
+            completed = 0
+            deadline = time.perf_counter() + duration
+
+            async def worker():
+                nonlocal completed
+                while time.perf_counter() < deadline:
+                    response = await client.post(f"/agents/{agent['id']}/run",
+                                                 json={"task": f"Task {completed}", "model": "gpt-4o"},
+                                                 headers={"X-API-Key": BENCH_TENANT})
+                    response.raise_for_status()
+                    completed += 1
+
+            started = time.perf_counter()
+            await asyncio.gather(*(worker() for _ in range(concurrency)))
+            elapsed = time.perf_counter() - started
+        shutdown_started = time.perf_counter()
+    print(f"{mode:<9} {completed / elapsed:10.1f} req/s   shutdown {time.perf_counter() - shutdown_started:6.3f}s")
+
+
+async def main(duration, concurrency, modes):
+    API_KEYS[BENCH_TENANT] = {"request_limit": 10 ** 9, "limit_window": timedelta(days=1)}
+    for mode in modes:
+        await run_mode(mode, duration, concurrency)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--duration", type=float, default=10)
+    parser.add_argument("--concurrency", type=int, default=64)
+    parser.add_argument("--modes", nargs="+", choices=MODES, default=MODES)
+    args = parser.parse_args()
+    asyncio.run(main(args.duration, args.concurrency, args.modes))
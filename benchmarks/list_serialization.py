@@ -0,0 +1,117 @@
+"""Latency of 10k-row list responses: selected columns encoded with orjson vs ORM rows validated per row.
+
+Seeds `--rows` tools, agents (two tools each) and executions for a dedicated tenant (once; reruns reuse
+them), then times GET /tools, GET /agents and GET /executions on the app next to the same three lists
+served the previous way, ORM objects returned through `response_model`, from a second app. Both answer
+with the same bytes, which is checked first.
+
+Usage (Postgres and Redis running, see README):
+    python -m benchmarks.list_serialization --rows 10000 --repeat 5
+"""
+import argparse
+import asyncio
+import statistics
+import time
+from datetime import datetime, timedelta
+from typing import List
+
+import httpx
+from fastapi import FastAPI
+from sqlalchemy import select, func, insert
+from sqlalchemy.orm import selectinload
+
+from base_model import AgentResponse, ExecutionResponse, ToolResponse
+from database import SessionLocal
+from main import app
+from models import Agent, Execution, Tool, agent_tools
+from routers import executions
+from utils import API_KEYS
+
+BENCH_TENANT = "tenant_bench_lists"
+BATCH = 5000
+
+legacy = FastAPI()
+
+
+@legacy.get("/tools", response_model=List[ToolResponse])
+async def legacy_tools():
+    async with SessionLocal() as db:
+        return (await db.scalars(select(Tool).filter(Tool.tenant_id == BENCH_TENANT))).all()
+
+
+@legacy.get("/agents", response_model=List[AgentResponse])
+async def legacy_agents():
+    async with SessionLocal() as db:
+        return (await db.scalars(select(Agent).options(selectinload(Agent.tools))
+                                 .filter(Agent.tenant_id == BENCH_TENANT).order_by(Agent.id))).all()
+
+
+@legacy.get("/executions", response_model=List[ExecutionResponse])
+async def legacy_executions(page_size: int):
+    async with SessionLocal() as db:
+        return (await db.scalars(select(Execution).filter(Execution.tenant_id == BENCH_TENANT)
+                                 .order_by(Execution.timestamp.desc(), Execution.id.desc())
+                                 .limit(page_size))).all()
+
+
+async def seed(rows):
+    async with SessionLocal() as db:
+        if await db.scalar(select(func.count()).select_from(Agent).filter(Agent.tenant_id == BENCH_TENANT)) >= rows:
+            return
+        for offset in range(0, rows, BATCH):
+            count = min(BATCH, rows - offset)
+            tool_ids = (await db.scalars(insert(Tool).returning(Tool.id), [
+                {"tenant_id": BENCH_TENANT, "name": f"tool {offset + i}", "description": "Looks things up " * 4}
+                for i in range(count)
+            ])).all()
+            agent_ids = (await db.scalars(insert(Agent).returning(Agent.id), [
+                {"tenant_id": BENCH_TENANT, "name": f"agent {offset + i}", "role": "analyst",
+                 "description": "Answers questions about the quarterly reports."}
+                for i in range(count)
+            ])).all()
+            await db.execute(insert(agent_tools), [
+                {"agent_id": agent_id, "tool_id": tool_ids[(i + shift) % count]}
+                for i, agent_id in enumerate(agent_ids) for shift in (0, 1)
+            ])
+            start = datetime.utcnow() - timedelta(seconds=rows)
+            await db.execute(insert(Execution.__table__), [
+                {"tenant_id": BENCH_TENANT, "agent_id": agent_ids[i], "prompt": f"Summarise report {offset + i}",
+                 "model": "gpt-4o", "response": f"Report {offset + i} in one line.",
+                 "timestamp": start + timedelta(seconds=offset + i)}
+                for i in range(count)
+            ])
+        await db.commit()
+
+
+async def timed(client, url, repeat):
+    samples = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        response = await client.get(url, headers={"X-API-Key": BENCH_TENANT})
+        samples.append((time.perf_counter() - started) * 1000)
+        response.raise_for_status()
+    return statistics.median(samples), response.content
+
+
+async def main(rows, repeat):
+    API_KEYS[BENCH_TENANT] = {"request_limit": 10 ** 9, "limit_window": timedelta(days=1)}
+    executions.MAX_PAGE_SIZE = max(executions.MAX_PAGE_SIZE, rows)
+    async with app.router.lifespan_context(app):
+        await seed(rows)
+        async with httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url="http://bench") as fast, \
+                httpx.AsyncClient(transport=httpx.ASGITransport(app=legacy), base_url="http://bench") as slow:
+            print(f"{'list (' + str(rows) + ' rows)':<22}{'validated':>12}{'fast':>12}{'speedup':>10}")
+            for label, url in [("GET /tools", "/tools"), ("GET /agents", "/agents"),
+                               ("GET /executions", f"/executions?page_size={rows}")]:
+                slow_ms, slow_body = await timed(slow, url, repeat)
+                fast_ms, fast_body = await timed(fast, url, repeat)
+                assert fast_body == slow_body, f"{label}: response bytes differ"
+                print(f"{label:<22}{slow_ms:>9.1f} ms{fast_ms:>9.1f} ms{slow_ms / fast_ms:>9.1f}x")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--rows", type=int, default=10000)
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+    asyncio.run(main(args.rows, args.repeat))
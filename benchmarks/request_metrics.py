@@ -0,0 +1,114 @@
+"""Cost per request of the request metrics (latency histograms and per-request database statement timing).
+
+Runs the same sequential requests against the app with `REQUEST_METRICS=0` and `=1`, each in its own
+process since the setting is read at import, and prints the mean time per request (best of `--rounds`)
+and the difference. Sequential requests keep the database and Redis from hiding the overhead behind
+queueing. The end-to-end difference is small next to run-to-run noise, so the middleware and the
+per-statement hook are also timed on their own, in process.
+
+Usage (Postgres and Redis running, see README):
+    python -m benchmarks.request_metrics --requests 2000 --rounds 5
+"""
+import argparse
+import asyncio
+import json
+import os
+import subprocess
+import sys
+import time
+from datetime import timedelta
+
+import httpx
+
+BENCH_TENANT = "tenant_bench_metrics"
+# (label, method, path) with {tool_id} filled in: a cached read, a list query and an unmatched path.
+REQUESTS = [
+    ("GET /tools/{tool_id}", "GET", "/tools/{tool_id}"),
+    ("GET /tools", "GET", "/tools?page_size=10"),
+    ("GET /missing", "GET", "/missing"),
+]
+
+
+async def measure(total, rounds):
+    from main import app
+    from utils import API_KEYS
+
+    API_KEYS[BENCH_TENANT] = {"request_limit": 10 ** 9, "limit_window": timedelta(days=1)}
+    headers = {"X-API-Key": BENCH_TENANT}
+    results = {}
+    transport = httpx.ASGITransport(app=app)
+    async with app.router.lifespan_context(app):
+        async with httpx.AsyncClient(transport=transport, base_url="http://bench") as client:
+            tool = (await client.post("/tools", json={"name": "bench tool", "description": "bench"},
+                                      headers=headers)).json()
+            for label, method, path in REQUESTS:
+                url = path.format(tool_id=tool["id"])
+                for _ in range(min(100, total)):
+                    await client.request(method, url, headers=headers)
+                for _ in range(rounds):
+                    started = time.perf_counter()
+                    for _ in range(total):
+                        await client.request(method, url, headers=headers)
+                    elapsed = (time.perf_counter() - started) / total
+                    results[label] = min(results.get(label, elapsed), elapsed)
+    return results
+
+
+def run_child(total, rounds, enabled):
+    env = {**os.environ, "REQUEST_METRICS": "1" if enabled else "0"}
+    output = subprocess.run([sys.executable, "-m", "benchmarks.request_metrics", "--requests", str(total),
+                             "--rounds", str(rounds), "--child"],
+                            env=env, check=True, capture_output=True, text=True).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+
+async def instrumentation_cost(iterations):
+    """Seconds per request added by the middleware, and per statement by the statement hook."""
+    from instrumentation import RequestMetricsMiddleware, record_query
+
+    async def endpoint(scope, receive, send):
+        await send({"type": "http.response.start", "status": 200, "headers": []})
+        await send({"type": "http.response.body", "body": b""})
+
+    async def send(message):
+        pass
+
+    scope = {"type": "http", "method": "GET", "route": argparse.Namespace(path="/tools/{tool_id}"),
+             "headers": [(b"x-api-key", BENCH_TENANT.encode())]}
+    middleware = RequestMetricsMiddleware(endpoint)
+    timings = []
+    for app in (endpoint, middleware):
+        started = time.perf_counter()
+        for _ in range(iterations):
+            await app(dict(scope), None, send)
+        timings.append((time.perf_counter() - started) / iterations)
+
+    connection = argparse.Namespace(info={"query_start": []})
+    started = time.perf_counter()
+    for _ in range(iterations):
+        connection.info["query_start"].append(time.perf_counter())
+        record_query(connection, "SELECT 1")
+    return timings[1] - timings[0], (time.perf_counter() - started) / iterations
+
+
+def main(total, rounds):
+    off, on = run_child(total, rounds, False), run_child(total, rounds, True)
+    print(f"{'request':<22}{'metrics off':>14}{'metrics on':>14}{'overhead':>14}")
+    for label, _, _ in REQUESTS:
+        print(f"{label:<22}{off[label] * 1e6:>11.1f} us{on[label] * 1e6:>11.1f} us"
+              f"{(on[label] - off[label]) * 1e6:>11.1f} us")
+    per_request, per_statement = asyncio.run(instrumentation_cost(100000))
+    print(f"middleware alone: {per_request * 1e6:.2f} us/request, "
+          f"statement hook alone: {per_statement * 1e6:.2f} us/statement")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--requests", type=int, default=2000, help="requests per endpoint and round")
+    parser.add_argument("--rounds", type=int, default=5)
+    parser.add_argument("--child", action="store_true", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.child:
+        print(json.dumps(asyncio.run(measure(args.requests, args.rounds))))
+    else:
+        main(args.requests, args.rounds)
@@ -0,0 +1,93 @@
+"""Throughput of POST /agents/{id}/run under increasing concurrency, async vs blocking DB sessions.
+
+Runs the app in-process (one event loop, i.e. one uvicorn worker) and fires a fixed number of
+run requests at several concurrency levels. Each level also runs against a baseline app whose run
+handler does the same database work through a blocking (synchronous) session, as the app did before
+AsyncSession. With non-blocking sessions, requests/s should grow with concurrency until the database
+saturates; with the blocking session it stays flat, since every query stalls the event loop.
+
+Usage (Postgres and Redis running, see README):
+    python -m benchmarks.run_agent_concurrency --requests 500 --concurrency 1 8 32 64
+"""
+import argparse
+import asyncio
+import time
+from datetime import datetime, timedelta
+
+import httpx
+from fastapi import FastAPI, HTTPException
+from sqlalchemy import create_engine, make_url, select
+from sqlalchemy.orm import selectinload, sessionmaker
+
+from base_model import AgentResponse, AgentRunRequest, AgentRunResponse
+from database import URL_DATABASE
+from llm import call_llm
+from main import app
+from models import Agent, Execution
+from prompts import generate_prompt
+from utils import API_KEYS, check_tenant_limit
+
+BENCH_TENANT = "tenant_bench"
+
+# The same database through its synchronous driver (psycopg2, sqlite3).
+sync_url = make_url(URL_DATABASE)
+BlockingSession = sessionmaker(bind=create_engine(sync_url.set(drivername=sync_url.get_backend_name())))
+
+blocking = FastAPI()
+
+
+@blocking.post("/agents/{agent_id}/run", response_model=AgentRunResponse)
+async def blocking_run_agent(agent_id: int, request: AgentRunRequest):
+    if not (await check_tenant_limit(BENCH_TENANT)).allowed:
+        raise HTTPException(status_code=429, detail="Rate limit exceeded")
+    with BlockingSession() as db:
+        agent = db.scalar(select(Agent).options(selectinload(Agent.tools))
+                          .filter(Agent.id == agent_id, Agent.tenant_id == BENCH_TENANT))
+        if not agent:
+            raise HTTPException(status_code=404, detail="Agent not found")
+        prompt = generate_prompt(AgentResponse.model_validate(agent), request.task)
+        execution = Execution(tenant_id=BENCH_TENANT, agent_id=agent_id, prompt=prompt, model=request.model,
+                              response=await call_llm(prompt, request.model), timestamp=datetime.utcnow())
+        db.add(execution)
+        db.commit()
+        return AgentRunResponse(execution_id=execution.id, agent_id=agent_id, agent_name=agent.name,
+                                prompt=prompt, model=execution.model, response=execution.response,
+                                timestamp=execution.timestamp, status=execution.status, cached=execution.cached)
+
+
+async def run_level(client, agent_id, total, concurrency):
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def one(i):
+        async with semaphore:
+            response = await client.post(f"/agents/{agent_id}/run",
+                                         json={"task": f"Task {i}", "model": "gpt-4o"},
+                                         headers={"X-API-Key": BENCH_TENANT})
+            response.raise_for_status()
+
+    started = time.perf_counter()
+    await asyncio.gather(*(one(i) for i in range(total)))
+    return total / (time.perf_counter() - started)
+
+
+async def main(total, levels):
+    API_KEYS[BENCH_TENANT] = {"request_limit": 10 ** 9, "limit_window": timedelta(days=1)}
+    async with app.router.lifespan_context(app):
+        async with httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url="http://bench") as client, \
+                httpx.AsyncClient(transport=httpx.ASGITransport(app=blocking), base_url="http://bench") as baseline:
+            agent = (await client.post("/agents",
+                                       json={"name": "bench", "role": "bench", "description": "bench"},
+                                       headers={"X-API-Key": BENCH_TENANT})).json()
+            print(f"{'concurrency':<12}{'async':>14}{'blocking':>14}{'gain':>8}")
+            for concurrency in levels:
+                rps = await run_level(client, agent["id"], total, concurrency)
+                baseline_rps = await run_level(baseline, agent["id"], total, concurrency)
+                print(f"{concurrency:<12}{rps:>8.1f} req/s{baseline_rps:>8.1f} req/s{rps / baseline_rps:>7.1f}x")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--requests", type=int, default=500)
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 8, 32, 64])
+    args = parser.parse_args()
+    asyncio.run(main(args.requests, args.concurrency))
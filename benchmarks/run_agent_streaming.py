@@ -0,0 +1,84 @@
+"""Time to first byte and total time of /agents/{id}/run vs /agents/{id}/run/stream.
+
+Uses the mock provider with simulated first-token and per-chunk latency, so it runs without a model.
+
+Usage:
+    python -m benchmarks.run_agent_streaming --requests 20 --first-token-delay 0.2 --chunk-delay 0.02
+"""
+import argparse
+import asyncio
+import json
+import statistics
+import time
+from datetime import timedelta
+
+import httpx
+
+from llm import MockLLMProvider, set_llm_provider
+from main import app
+from utils import API_KEYS
+
+BENCH_TENANT = "tenant_bench_stream"
+
+
+async def measure(path, body):
+    # httpx's ASGI transport buffers whole responses, so drive the ASGI app directly and timestamp
+    # the first non-empty body message.
+    payload = json.dumps(body).encode()
+    scope = {
+        "type": "http", "asgi": {"version": "3.0"}, "http_version": "1.1", "method": "POST",
+        "scheme": "http", "path": path, "raw_path": path.encode(), "query_string": b"", "root_path": "",
+        "headers": [(b"content-type", b"application/json"), (b"x-api-key", BENCH_TENANT.encode())],
+        "client": ("bench", 0), "server": ("bench", 80),
+    }
+    disconnected = asyncio.Event()
+    request_sent = False
+
+    async def receive():
+        nonlocal request_sent
+        if not request_sent:
+            request_sent = True
+            return {"type": "http.request", "body": payload, "more_body": False}
+        await disconnected.wait()
+        return {"type": "http.disconnect"}
+
+    first_byte = None
+
+    async def send(message):
+        nonlocal first_byte
+        if message["type"] == "http.response.start" and message["status"] != 200:
+            raise RuntimeError(f"{path} answered {message['status']}")
+        if message["type"] == "http.response.body" and message.get("body") and first_byte is None:
+            first_byte = time.perf_counter() - started
+
+    started = time.perf_counter()
+    await app(scope, receive, send)
+    total = time.perf_counter() - started
+    disconnected.set()
+    return first_byte * 1000, total * 1000
+
+
+async def main(requests, first_token_delay, chunk_delay):
+    API_KEYS[BENCH_TENANT] = {"request_limit": 10 ** 9, "limit_window": timedelta(days=1)}
+    set_llm_provider(MockLLMProvider(first_token_delay=first_token_delay, chunk_delay=chunk_delay))
+    transport = httpx.ASGITransport(app=app)
+    async with app.router.lifespan_context(app):
+        async with httpx.AsyncClient(transport=transport, base_url="http://bench") as client:
+            agent = (await client.post("/agents",
+                                       json={"name": "bench", "role": "bench", "description": "bench"},
+                                       headers={"X-API-Key": BENCH_TENANT})).json()
+            for name, url in (("run", f"/agents/{agent['id']}/run"),
+                              ("run/stream", f"/agents/{agent['id']}/run/stream")):
+                samples = [await measure(url, {"task": f"Task {i}"}) for i in range(requests)]
+                ttfb = statistics.median(sample[0] for sample in samples)
+                total = statistics.median(sample[1] for sample in samples)
+                print(f"{name:<12} ttfb p50 {ttfb:8.1f} ms   total p50 {total:8.1f} ms")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--requests", type=int, default=20)
+    parser.add_argument("--first-token-delay", type=float, default=0.2)
+    parser.add_argument("--chunk-delay", type=float, default=0.02)
+    args = parser.parse_args()
+    asyncio.run(main(args.requests, args.first_token_delay, args.chunk_delay))
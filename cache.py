@@ -0,0 +1,403 @@
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import time
+from collections import OrderedDict, defaultdict
+
+from redis.exceptions import RedisError
+from sqlalchemy import event, select
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.orm import Session, selectinload, make_transient_to_detached
+
+from base_model import AgentResponse, ToolResponse
+from concurrency import concurrency_limiter
+from llm import call_llm
+from metrics import llm_cache_requests, definition_cache_requests
+from database import engine
+from models import Agent, Tool, PromptTemplate, agent_tools
+from prompts import CompiledPrompt, compile_prompt
+from singleflight import llm_single_flight_group
+from utils import API_KEYS, redis_client
+
+logger = logging.getLogger(__name__)
+
+LLM_CACHE_KEY = "llm_cache"
+LLM_CACHE_SIZE = int(os.getenv("LLM_CACHE_SIZE", "1024"))
+
+DEFINITION_CACHE_KEY = "definition_cache"
+DEFINITION_CACHE_CHANNEL = "definition_cache:invalidate"
+DEFINITION_CACHE_SIZE = int(os.getenv("DEFINITION_CACHE_SIZE", "4096"))
+DEFINITION_CACHE_TTL = float(os.getenv("DEFINITION_CACHE_TTL", "300"))
+DEFINITION_CACHE_REDIS = os.getenv("DEFINITION_CACHE_REDIS", "0") == "1"
+PROMPT_TEMPLATE_CACHE_SIZE = int(os.getenv("PROMPT_TEMPLATE_CACHE_SIZE", "4096"))
+COMPILED_PROMPT_CACHE_SIZE = int(os.getenv("COMPILED_PROMPT_CACHE_SIZE", "4096"))
+
+
+class LRUCache:
+    """Size-bounded in-process cache; entries may carry their own time to live in seconds.
+
+    Each entry counts `weight` (1 by default) against `maxsize`, so a cache can be bounded by, say, bytes."""
+
+    def __init__(self, maxsize: int):
+        self.maxsize = maxsize
+        self.size = 0
+        self._entries = OrderedDict()
+
+    def get(self, key):
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        value, expires_at, _ = entry
+        if expires_at is not None and expires_at <= time.monotonic():
+            self.pop(key)
+            return None
+        self._entries.move_to_end(key)
+        return value
+
+    def set(self, key, value, ttl: float = None, weight: int = 1):
+        self.pop(key)
+        self._entries[key] = (value, time.monotonic() + ttl if ttl is not None else None, weight)
+        self.size += weight
+        while self.size > self.maxsize:
+            self.size -= self._entries.popitem(last=False)[1][2]
+
+    def pop(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self.size -= entry[2]
+
+    def clear(self):
+        self._entries.clear()
+        self.size = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class ResponseCache:
+    """Model responses keyed on sha256(model, prompt), per tenant: in-process LRU in front of Redis.
+
+    Only tenants with `response_cache_ttl` in API_KEYS use it. Redis errors count as misses."""
+
+    def __init__(self, maxsize: int = LLM_CACHE_SIZE):
+        self.local = LRUCache(maxsize)
+
+    @staticmethod
+    def ttl(tenant_id):
+        ttl = API_KEYS.get(tenant_id, {}).get("response_cache_ttl")
+        return ttl.total_seconds() if ttl else None
+
+    @staticmethod
+    def key(tenant_id, prompt, model):
+        digest = hashlib.sha256(f"{model}\0{prompt}".encode()).hexdigest()
+        return f"{LLM_CACHE_KEY}:{tenant_id}:{digest}"
+
+    async def get(self, tenant_id, prompt, model):
+        key = self.key(tenant_id, prompt, model)
+        response = self.local.get(key)
+        if response is not None:
+            llm_cache_requests.inc(tenant=tenant_id, result="hit_local")
+            return response
+        response, remaining_ms = None, -1
+        try:
+            async with redis_client.pipeline(transaction=False) as pipe:
+                response, remaining_ms = await pipe.get(key).pttl(key).execute()
+        except RedisError:
+            logger.warning("LLM cache lookup failed", exc_info=True)
+        if response is None:
+            llm_cache_requests.inc(tenant=tenant_id, result="miss")
+            return None
+        llm_cache_requests.inc(tenant=tenant_id, result="hit_redis")
+        # The local copy must not outlive the Redis entry it came from.
+        self.local.set(key, response, remaining_ms / 1000 if remaining_ms > 0 else self.ttl(tenant_id))
+        return response
+
+    async def set(self, tenant_id, prompt, model, response):
+        ttl = self.ttl(tenant_id)
+        key = self.key(tenant_id, prompt, model)
+        self.local.set(key, response, ttl)
+        try:
+            await redis_client.set(key, response, ex=max(1, int(ttl)))
+        except RedisError:
+            logger.warning("LLM cache store failed", exc_info=True)
+
+
+response_cache = ResponseCache()
+
+
+async def coalesced_call_llm(tenant_id: str, agent_id: int, prompt: str, model: str, wait_for_slot: bool = True):
+    """Model call shared by all concurrent runs with the same (tenant, agent, prompt, model).
+
+    Only the run that makes the call holds one of the tenant's run slots; runs waiting on it hold none,
+    and get its 429 or 503 if it gets no slot. With `wait_for_slot=False` a busy tenant raises RunSlotBusy."""
+    async def call():
+        async with concurrency_limiter.slot(tenant_id, wait_for_slot):
+            return await call_llm(prompt, model)
+
+    key = json.dumps([tenant_id, agent_id, model, prompt])
+    return await llm_single_flight_group.do(key, call, tenant_id)
+
+
+async def cached_call_llm(tenant_id: str, agent_id: int, prompt: str, model: str, use_cache: bool = True,
+                          wait_for_slot: bool = True):
+    """Returns (response, cached). Goes to the model when the tenant has no cache TTL or the caller
+    asked to bypass the cache; fresh responses are stored for later runs. Cache hits take no run slot."""
+    if not use_cache or not response_cache.ttl(tenant_id):
+        llm_cache_requests.inc(tenant=tenant_id, result="bypass")
+        return await coalesced_call_llm(tenant_id, agent_id, prompt, model, wait_for_slot), False
+    response = await response_cache.get(tenant_id, prompt, model)
+    if response is not None:
+        return response, True
+    response = await coalesced_call_llm(tenant_id, agent_id, prompt, model, wait_for_slot)
+    await response_cache.set(tenant_id, prompt, model, response)
+    return response, False
+
+
+# Sets each entry KEYS[2i-1] to ARGV[2i+1] (for ARGV[1] seconds) only if its version KEYS[2i] still equals
+# ARGV[2i], i.e. no worker invalidated it since the value was read from the database. A missing version is "0".
+# Version keys expire like the entries, which is far longer than a load from the database takes.
+FILL_DEFINITIONS_SCRIPT = redis_client.register_script("""
+local ttl = tonumber(ARGV[1])
+for i = 1, #KEYS / 2 do
+    if (redis.call('GET', KEYS[2 * i]) or '0') == ARGV[2 * i] then
+        redis.call('SET', KEYS[2 * i - 1], ARGV[2 * i + 1], 'EX', ttl)
+    end
+end
+return 0
+""")
+
+
+# Compiled prompts per agent, under the agent's definition cache key so invalidating the definition drops them.
+# Entries keep the definition they were compiled from and are only used for an equal one.
+compiled_prompts = LRUCache(COMPILED_PROMPT_CACHE_SIZE)
+
+
+class DefinitionCache:
+    """Tenant-scoped read-through cache of AgentResponse / ToolResponse objects.
+
+    Entries live in an in-process LRU and, with `use_redis`, in Redis. Writers call `invalidate` after
+    committing; it drops the entries here and in Redis and publishes the keys so every worker's
+    `listen` task drops its local copies too. Entries also expire after `ttl` seconds, which bounds
+    staleness if an invalidation message is lost.
+
+    A per-key generation guards the local tier and a per-key version counter in Redis guards the Redis
+    tier: a read that started before an invalidation, here or on any other worker, does not store what it
+    loaded. Readers take both with `snapshot` before loading from the database."""
+
+    def __init__(self, maxsize: int = DEFINITION_CACHE_SIZE, ttl: float = DEFINITION_CACHE_TTL,
+                 use_redis: bool = DEFINITION_CACHE_REDIS):
+        self.local = LRUCache(maxsize)
+        self.ttl = ttl
+        self.use_redis = use_redis
+        self._generations = defaultdict(int)
+
+    @staticmethod
+    def key(kind, tenant_id, definition_id):
+        return f"{DEFINITION_CACHE_KEY}:{kind}:{tenant_id}:{definition_id}"
+
+    @staticmethod
+    def version_key(key):
+        return f"{key}:version"
+
+    def generation(self, key):
+        return self._generations.get(key, 0)
+
+    async def snapshot(self, keys):
+        """{key: (generation, Redis version)} to pass to `fill` once `keys` are loaded. The version is None
+        when the Redis tier is off or unreachable, which keeps the load out of Redis."""
+        versions = [None] * len(keys)
+        if self.use_redis and keys:
+            try:
+                versions = [version or "0" for version in
+                            await redis_client.mget([self.version_key(key) for key in keys])]
+            except RedisError:
+                logger.warning("Definition cache version lookup failed", exc_info=True)
+        return {key: (self.generation(key), version) for key, version in zip(keys, versions)}
+
+    async def get_many(self, kind, tenant_id, ids, schema):
+        """Returns {id: definition} for the ids found in either tier."""
+        found = {}
+        missing = []
+        for definition_id in ids:
+            value = self.local.get(self.key(kind, tenant_id, definition_id))
+            if value is not None:
+                found[definition_id] = value
+            else:
+                missing.append(definition_id)
+        definition_cache_requests.inc(len(found), kind=kind, result="hit_local")
+
+        if missing and self.use_redis:
+            keys = [self.key(kind, tenant_id, definition_id) for definition_id in missing]
+            try:
+                values = await redis_client.mget(keys)
+            except RedisError:
+                logger.warning("Definition cache lookup failed", exc_info=True)
+                values = [None] * len(keys)
+            for definition_id, key, value in zip(missing, keys, values):
+                if value is not None:
+                    found[definition_id] = schema.model_validate_json(value)
+                    self.local.set(key, found[definition_id], self.ttl)
+                    definition_cache_requests.inc(kind=kind, result="hit_redis")
+        definition_cache_requests.inc(len(ids) - len(found), kind=kind, result="miss")
+        return found
+
+    async def fill(self, kind, tenant_id, definitions, seen):
+        """Stores definitions loaded from the database; `seen` is what `snapshot` returned before the load."""
+        stored = {}
+        for definition in definitions:
+            key = self.key(kind, tenant_id, definition.id)
+            generation, version = seen.get(key, (0, None))
+            if self.generation(key) == generation:
+                self.local.set(key, definition, self.ttl)
+                if version is not None:
+                    stored[key] = (version, definition.model_dump_json())
+        if stored:
+            try:
+                await FILL_DEFINITIONS_SCRIPT(
+                    keys=[name for key in stored for name in (key, self.version_key(key))],
+                    args=[max(1, int(self.ttl))] + [arg for version_value in stored.values() for arg in version_value],
+                    client=redis_client
+                )
+            except RedisError:
+                logger.warning("Definition cache store failed", exc_info=True)
+
+    def _evict(self, keys):
+        for key in keys:
+            self._generations[key] += 1
+            self.local.pop(key)
+            compiled_prompts.pop(key)
+
+    async def invalidate(self, tenant_id, agent_ids=(), tool_ids=()):
+        keys = [self.key("agent", tenant_id, agent_id) for agent_id in agent_ids] + \
+               [self.key("tool", tenant_id, tool_id) for tool_id in tool_ids]
+        if not keys:
+            return
+        self._evict(keys)
+        try:
+            async with redis_client.pipeline(transaction=False) as pipe:
+                if self.use_redis:
+                    pipe.delete(*keys)
+                    for key in keys:
+                        pipe.incr(self.version_key(key))
+                        pipe.expire(self.version_key(key), max(1, int(self.ttl)))
+                pipe.publish(DEFINITION_CACHE_CHANNEL, json.dumps(keys))
+                await pipe.execute()
+        except RedisError:
+            logger.warning("Definition cache invalidation failed to reach other workers", exc_info=True)
+
+    async def listen(self):
+        """Evicts keys invalidated by other workers; runs for the lifetime of the app."""
+        while True:
+            pubsub = redis_client.pubsub()
+            try:
+                await pubsub.subscribe(DEFINITION_CACHE_CHANNEL)
+                # Anything cached before (re)subscribing may have missed an invalidation.
+                self.local.clear()
+                while True:
+                    message = await pubsub.get_message(ignore_subscribe_messages=True, timeout=1)
+                    if message:
+                        self._evict(json.loads(message["data"]))
+            except RedisError:
+                logger.warning("Definition cache listener lost Redis, retrying", exc_info=True)
+                await asyncio.sleep(1)
+            finally:
+                await pubsub.aclose()
+
+
+definition_cache = DefinitionCache()
+
+
+async def get_agent_definitions(db, tenant_id, agent_ids):
+    """{agent_id: AgentResponse} for the tenant's agents among `agent_ids`, loading cache misses in one query."""
+    agents = await definition_cache.get_many("agent", tenant_id, agent_ids, AgentResponse)
+    missing = [agent_id for agent_id in agent_ids if agent_id not in agents]
+    if missing:
+        seen = await definition_cache.snapshot([definition_cache.key("agent", tenant_id, agent_id)
+                                                for agent_id in missing])
+        loaded = (await db.scalars(
+            select(Agent)
+            .options(selectinload(Agent.tools))
+            .filter(Agent.id.in_(missing), Agent.tenant_id == tenant_id)
+        )).all()
+        loaded = [AgentResponse.model_validate(agent) for agent in loaded]
+        await definition_cache.fill("agent", tenant_id, loaded, seen)
+        agents.update((agent.id, agent) for agent in loaded)
+    return agents
+
+
+async def get_agent_definition(db, tenant_id, agent_id):
+    return (await get_agent_definitions(db, tenant_id, [agent_id])).get(agent_id)
+
+
+async def get_tool_definition(db, tenant_id, tool_id):
+    tools = await definition_cache.get_many("tool", tenant_id, [tool_id], ToolResponse)
+    if tool_id in tools:
+        return tools[tool_id]
+    seen = await definition_cache.snapshot([definition_cache.key("tool", tenant_id, tool_id)])
+    tool = await db.scalar(select(Tool).filter(Tool.tenant_id == tenant_id, Tool.id == tool_id))
+    if not tool:
+        return None
+    tool = ToolResponse.model_validate(tool)
+    await definition_cache.fill("tool", tenant_id, [tool], seen)
+    return tool
+
+
+async def invalidate_tools(db, tenant_id, tool_ids):
+    """Invalidates tools and every agent that embeds one of them; returns those agents' ids."""
+    agent_ids = set((await db.scalars(
+        select(agent_tools.c.agent_id).filter(agent_tools.c.tool_id.in_(tool_ids))
+    )).all())
+    await definition_cache.invalidate(tenant_id, agent_ids=agent_ids, tool_ids=tool_ids)
+    return agent_ids
+
+
+# Ids of prompt templates known to be stored. Templates are never changed or deleted.
+_stored_prompt_templates = LRUCache(PROMPT_TEMPLATE_CACHE_SIZE)
+# Session.info key of the templates a session inserted; they count as stored once its outer transaction
+# commits (releasing a savepoint also fires after_commit).
+NEW_PROMPT_TEMPLATES = "new_prompt_templates"
+
+
+@event.listens_for(Session, "after_commit")
+def _mark_prompt_templates_stored(session):
+    if session.in_nested_transaction():
+        return
+    for template_id in session.info.pop(NEW_PROMPT_TEMPLATES, ()):
+        _stored_prompt_templates.set(template_id, True)
+
+
+@event.listens_for(Session, "after_rollback")
+def _forget_prompt_templates(session):
+    if not session.in_nested_transaction():
+        session.info.pop(NEW_PROMPT_TEMPLATES, None)
+
+
+def get_compiled_prompt(tenant_id: str, agent: AgentResponse) -> CompiledPrompt:
+    key = definition_cache.key("agent", tenant_id, agent.id)
+    entry = compiled_prompts.get(key)
+    if entry is not None and (entry[0] is agent or entry[0] == agent):
+        return entry[1]
+    compiled = compile_prompt(agent)
+    compiled_prompts.set(key, (agent, compiled))
+    return compiled
+
+
+async def get_prompt_template(db, compiled: CompiledPrompt) -> PromptTemplate:
+    """The stored template for a compiled prompt, attached to `db`.
+
+    On first use the template is inserted in a savepoint on the connection of `db`, so a run never holds
+    a second pooled connection; it is stored once the caller commits."""
+    if not _stored_prompt_templates.get(compiled.template_id):
+        dialect_insert = postgresql.insert if engine.dialect.name == "postgresql" else sqlite.insert
+        async with db.begin_nested():
+            await db.execute(
+                dialect_insert(PromptTemplate)
+                .values(id=compiled.template_id, prefix=compiled.prefix, suffix=compiled.suffix)
+                .on_conflict_do_nothing()
+            )
+        db.info.setdefault(NEW_PROMPT_TEMPLATES, set()).add(compiled.template_id)
+    template = PromptTemplate(id=compiled.template_id, prefix=compiled.prefix, suffix=compiled.suffix)
+    make_transient_to_detached(template)
+    return await db.merge(template, load=False)
@@ -0,0 +1,23 @@
+import os
+from typing import Optional, Tuple
+
+import zstandard
+
+# "zstd" stores new execution responses zstd-compressed when that makes them smaller; "none" stores plain text.
+RESPONSE_COMPRESSION = os.getenv("EXECUTION_RESPONSE_COMPRESSION", "none")
+RESPONSE_COMPRESSION_LEVEL = int(os.getenv("EXECUTION_RESPONSE_COMPRESSION_LEVEL", "3"))
+
+
+def compress_response(response: Optional[str]) -> Tuple[Optional[str], Optional[bytes]]:
+    """Splits a response into the (text, compressed) column pair; exactly one is set unless it is None."""
+    if response is None or RESPONSE_COMPRESSION != "zstd":
+        return response, None
+    data = response.encode()
+    compressed = zstandard.ZstdCompressor(level=RESPONSE_COMPRESSION_LEVEL).compress(data)
+    if len(compressed) >= len(data):
+        return response, None
+    return None, compressed
+
+
+def decompress_response(compressed: bytes) -> str:
+    return zstandard.ZstdDecompressor().decompress(compressed).decode()
@@ -0,0 +1,190 @@
+import asyncio
+import logging
+import math
+import os
+import uuid
+from collections import defaultdict
+from contextlib import asynccontextmanager
+
+from fastapi import HTTPException
+from redis.exceptions import RedisError
+
+from metrics import concurrency_decisions
+from utils import API_KEYS, redis_client
+
+logger = logging.getLogger(__name__)
+
+CONCURRENCY_KEY = "concurrency"
+CONCURRENCY_CHANNEL = "concurrency_released"
+CONCURRENCY_SLOT_TTL = float(os.getenv("CONCURRENCY_SLOT_TTL", "300"))
+CONCURRENCY_POLL_INTERVAL = float(os.getenv("CONCURRENCY_POLL_INTERVAL", "0.1"))
+
+SLOT_GRANTED, SLOT_QUEUED, SLOT_REJECTED = 1, 0, -1
+
+# Run slots held per tenant (scored by lease expiry) and the tenant's waiters (scored by arrival), both
+# timed with the Redis server clock. A waiter gets a slot once it is within the first `free` waiters, so
+# each tenant's queue is served in arrival order. Returns SLOT_GRANTED, SLOT_QUEUED or SLOT_REJECTED.
+ACQUIRE_SLOT_SCRIPT = redis_client.register_script("""
+local holders = KEYS[1]
+local waiters = KEYS[2]
+local limit = tonumber(ARGV[1])
+local max_queue = tonumber(ARGV[2])
+local token = ARGV[3]
+local slot_ttl = tonumber(ARGV[4])
+local wait_ttl = tonumber(ARGV[5])
+local time = redis.call('TIME')
+local now = tonumber(time[1]) * 1000 + math.floor(tonumber(time[2]) / 1000)
+
+redis.call('ZREMRANGEBYSCORE', holders, '-inf', now)
+redis.call('ZREMRANGEBYSCORE', waiters, '-inf', now - wait_ttl)
+local free = limit - redis.call('ZCARD', holders)
+local rank = redis.call('ZRANK', waiters, token)
+local granted
+if rank then
+    granted = rank < free
+    if granted then
+        redis.call('ZREM', waiters, token)
+    end
+elseif free > 0 and redis.call('ZCARD', waiters) == 0 then
+    granted = true
+elseif redis.call('ZCARD', waiters) >= max_queue then
+    return -1
+else
+    redis.call('ZADD', waiters, now, token)
+    redis.call('PEXPIRE', waiters, wait_ttl)
+    return 0
+end
+if not granted then
+    return 0
+end
+redis.call('ZADD', holders, now + slot_ttl, token)
+redis.call('PEXPIRE', holders, slot_ttl)
+return 1
+""")
+
+
+class RunSlotBusy(HTTPException):
+    """No run slot was free for a caller that does not wait for one; `released` is set at the tenant's next
+    slot release."""
+
+    def __init__(self, released: asyncio.Event):
+        super().__init__(status_code=429, detail="Too many concurrent runs")
+        self.released = released
+
+
+class TenantConcurrencyLimiter:
+    """Caps each tenant's runs in flight across all workers, from `max_concurrency` in API_KEYS.
+
+    A run over the cap waits in the tenant's queue of at most `max_queue` runs for up to `queue_timeout`;
+    a full queue is answered with 429 right away and a wait that runs out with 503. Other tenants never
+    wait behind that queue. Slots are leases of `slot_ttl` seconds so a worker that dies does not keep
+    them; runs longer than that stop counting against the cap. If Redis is unreachable runs are let through.
+
+    Waiters retry when a slot is released (pub/sub, see `listen`) or every `poll_interval` seconds."""
+
+    def __init__(self, slot_ttl: float = CONCURRENCY_SLOT_TTL, poll_interval: float = CONCURRENCY_POLL_INTERVAL):
+        self.slot_ttl = slot_ttl
+        self.poll_interval = poll_interval
+        self._released = defaultdict(asyncio.Event)
+
+    @staticmethod
+    def keys(tenant_id):
+        return [f"{CONCURRENCY_KEY}:{tenant_id}:holders", f"{CONCURRENCY_KEY}:{tenant_id}:waiters"]
+
+    @asynccontextmanager
+    async def slot(self, tenant_id: str, wait: bool = True):
+        token = await self.acquire(tenant_id, wait)
+        try:
+            yield
+        finally:
+            await self.release(tenant_id, token)
+
+    async def acquire(self, tenant_id: str, wait: bool = True):
+        """Waits for a run slot and returns its token (None when the tenant has no cap).
+
+        With `wait=False` the caller never joins the tenant's queue and gets RunSlotBusy unless a slot is
+        free right away with no queued run ahead of it."""
+        tenant = API_KEYS[tenant_id]
+        limit = tenant.get("max_concurrency")
+        if not limit:
+            return None
+        timeout = tenant.get("queue_timeout")
+        timeout = timeout.total_seconds() if timeout else self.slot_ttl
+        token = uuid.uuid4().hex
+        args = [limit, tenant.get("max_queue", 0) if wait else 0, token, int(self.slot_ttl * 1000),
+                int((timeout + self.poll_interval * 10) * 1000)]
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + timeout
+        queued = granted = False
+        try:
+            while True:
+                released = self._released[tenant_id]
+                status = await ACQUIRE_SLOT_SCRIPT(keys=self.keys(tenant_id), args=args, client=redis_client)
+                if status == SLOT_GRANTED:
+                    granted = True
+                    concurrency_decisions.inc(tenant=tenant_id, outcome="queued" if queued else "immediate")
+                    return token
+                if status == SLOT_REJECTED:
+                    concurrency_decisions.inc(tenant=tenant_id, outcome="rejected")
+                    if not wait:
+                        raise RunSlotBusy(released)
+                    raise HTTPException(status_code=429, detail="Too many concurrent runs",
+                                        headers={"Retry-After": str(max(1, math.ceil(timeout)))})
+                queued = True
+                if (remaining := deadline - loop.time()) <= 0:
+                    concurrency_decisions.inc(tenant=tenant_id, outcome="timeout")
+                    raise HTTPException(status_code=503, detail="Timed out waiting for a run slot",
+                                        headers={"Retry-After": "1"})
+                try:
+                    await asyncio.wait_for(released.wait(), min(self.poll_interval, remaining))
+                except asyncio.TimeoutError:
+                    pass
+        except RedisError:
+            logger.warning("Concurrency limiter unavailable, letting the run through", exc_info=True)
+            concurrency_decisions.inc(tenant=tenant_id, outcome="unavailable")
+            return None
+        finally:
+            # A waiter that gives up (timeout, disconnect) must leave the queue, or it would hold back the
+            # waiters behind it until its entry expires.
+            if queued and not granted:
+                try:
+                    await redis_client.zrem(self.keys(tenant_id)[1], token)
+                except RedisError:
+                    pass
+
+    async def release(self, tenant_id: str, token):
+        if token is None:
+            return
+        try:
+            async with redis_client.pipeline(transaction=False) as pipe:
+                pipe.zrem(self.keys(tenant_id)[0], token)
+                pipe.publish(CONCURRENCY_CHANNEL, tenant_id)
+                await pipe.execute()
+        except RedisError:
+            logger.warning("Run slot release failed, it expires with its lease", exc_info=True)
+        self._wake(tenant_id)
+
+    async def listen(self):
+        """Wakes this worker's waiters when another worker releases a slot; runs for the lifetime of the app."""
+        while True:
+            pubsub = redis_client.pubsub()
+            try:
+                await pubsub.subscribe(CONCURRENCY_CHANNEL)
+                while True:
+                    message = await pubsub.get_message(ignore_subscribe_messages=True, timeout=1)
+                    if message:
+                        self._wake(message["data"])
+            except RedisError:
+                logger.warning("Concurrency listener lost Redis, retrying", exc_info=True)
+                await asyncio.sleep(1)
+            finally:
+                await pubsub.aclose()
+
+    def _wake(self, tenant_id):
+        # Waiters hold the event they saw before their last attempt; a fresh one is used for the next round.
+        event = self._released.pop(tenant_id, None)
+        if event:
+            event.set()
+
+
+concurrency_limiter = TenantConcurrencyLimiter()
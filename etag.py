@@ -0,0 +1,82 @@
+import hashlib
+import logging
+import uuid
+from typing import Awaitable, Callable, Optional
+
+from fastapi import Request, Response
+from redis.exceptions import RedisError
+
+from utils import redis_client
+
+logger = logging.getLogger(__name__)
+
+VERSION_KEY = "resource_version"
+
+
+async def bump_versions(tenant_id: str, *resources: str):
+    """Marks tenant resources as changed. Call after the change is committed.
+
+    Resources are collections ("agents", "tools", "executions") or single items ("agent:1")."""
+    try:
+        async with redis_client.pipeline(transaction=False) as pipe:
+            for resource in resources:
+                pipe.hincrby(f"{VERSION_KEY}:{tenant_id}", resource, 1)
+            await pipe.execute()
+    except RedisError:
+        logger.warning("Resource version bump failed", exc_info=True)
+
+
+async def resource_etag(request: Request, tenant_id: str, resource: str, variant: str = "") -> Optional[str]:
+    """Strong ETag for `request` from the resource's version counter, without touching the database.
+
+    The query string is part of the tag, so each filter or page has its own; `variant` adds inputs the
+    query string does not show, such as defaults that depend on the time. Returns None when Redis
+    is unavailable; the response is then sent in full without an ETag."""
+    key = f"{VERSION_KEY}:{tenant_id}"
+    try:
+        epoch, version = await redis_client.hmget(key, "epoch", resource)
+        if epoch is None:
+            # A lost hash restarts the counters; a fresh epoch keeps old tags from matching reused versions.
+            await redis_client.hsetnx(key, "epoch", uuid.uuid4().hex)
+            epoch, version = await redis_client.hmget(key, "epoch", resource)
+    except RedisError:
+        logger.warning("Resource version lookup failed", exc_info=True)
+        return None
+    tagged = f"{epoch}\0{resource}\0{version or 0}\0{request.url.path}\0{request.url.query}"
+    if variant:
+        tagged += f"\0{variant}"
+    digest = hashlib.sha256(tagged.encode()).hexdigest()
+    return f'"{digest[:32]}"'
+
+
+def if_none_match_tags(request: Request):
+    if_none_match = request.headers.get("if-none-match")
+    if not if_none_match:
+        return []
+    return [tag.strip().removeprefix("W/") for tag in if_none_match.split(",")]
+
+
+async def is_not_modified(request: Request, etag: Optional[str], exists: Optional[Callable[[], Awaitable]] = None):
+    if not etag:
+        return False
+    tags = if_none_match_tags(request)
+    if etag in tags:
+        return True
+    # "*" matches any current representation, so it must not answer for an item that does not exist.
+    return "*" in tags and (exists is None or bool(await exists()))
+
+
+async def conditional_get(request: Request, response: Response, tenant_id: str, resource: str,
+                          exists: Optional[Callable[[], Awaitable]] = None, variant: str = ""):
+    """Returns a 304 response if the client's copy is current; otherwise sets the ETag on `response`
+    and returns None so the handler builds the body.
+
+    For a single item, pass `exists` (an async callable, truthy when the item is found): `If-None-Match: *`
+    then gets a 304 only for an item that exists, and the handler answers 404 for one that does not.
+    `variant` is passed on to `resource_etag`."""
+    etag = await resource_etag(request, tenant_id, resource, variant)
+    if await is_not_modified(request, etag, exists):
+        return Response(status_code=304, headers={"ETag": etag})
+    if etag:
+        response.headers["ETag"] = etag
+    return None
@@ -0,0 +1,105 @@
+"""Per-request metrics: latency by route and tenant, and the database statements each request ran.
+
+Statements are attributed to the request through a context variable, which SQLAlchemy carries into the
+greenlets that run them. Tasks started by a request (e.g. streaming runs) inherit it, so statements they
+run after the response is sent are not counted."""
+import os
+import time
+from contextvars import ContextVar
+
+from sqlalchemy import event
+
+from metrics import db_query_duration, http_request_db_queries, http_request_db_seconds, \
+    http_request_duration, http_requests
+from utils import API_KEYS
+
+REQUEST_METRICS = os.getenv("REQUEST_METRICS", "1") == "1"
+
+QUERY_OPERATIONS = {"SELECT", "INSERT", "UPDATE", "DELETE"}
+
+_request_queries = ContextVar("request_queries", default=None)
+
+
+class QueryStats:
+    __slots__ = ("count", "seconds")
+
+    def __init__(self):
+        self.count = 0
+        self.seconds = 0.0
+
+
+class RequestMetricsMiddleware:
+    """ASGI middleware observing every HTTP request, streamed responses until their last chunk."""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        status = 500
+
+        async def send_with_status(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+
+        queries = QueryStats()
+        token = _request_queries.set(queries)
+        start = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            elapsed = time.perf_counter() - start
+            _request_queries.reset(token)
+            route = scope.get("route")
+            route = route.path if route is not None else "unmatched"
+            tenant = request_tenant(scope)
+            http_request_duration.observe(elapsed, method=scope["method"], route=route, tenant=tenant)
+            http_requests.inc(method=scope["method"], route=route, tenant=tenant, status=status)
+            http_request_db_queries.observe(queries.count, route=route)
+            http_request_db_seconds.observe(queries.seconds, route=route)
+
+
+def request_tenant(scope) -> str:
+    # Only known keys become label values, so arbitrary keys cannot grow the number of series.
+    for name, value in scope["headers"]:
+        if name == b"x-api-key":
+            tenant_id = value.decode("latin-1")
+            return tenant_id if tenant_id in API_KEYS else ""
+    return ""
+
+
+def query_operation(statement: str) -> str:
+    operation = statement.lstrip()[:6].upper()
+    return operation if operation in QUERY_OPERATIONS else "OTHER"
+
+
+def instrument_engine(engine):
+    """Times every statement run through `engine` (an AsyncEngine)."""
+
+    @event.listens_for(engine.sync_engine, "before_cursor_execute")
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault("query_start", []).append(time.perf_counter())
+
+    @event.listens_for(engine.sync_engine, "after_cursor_execute")
+    def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        record_query(conn, statement)
+
+    @event.listens_for(engine.sync_engine, "handle_error")
+    def handle_error(context):
+        if context.connection is not None and context.statement is not None:
+            record_query(context.connection, context.statement)
+
+
+def record_query(conn, statement: str):
+    starts = conn.info.get("query_start")
+    if not starts:
+        return
+    elapsed = time.perf_counter() - starts.pop()
+    db_query_duration.observe(elapsed, operation=query_operation(statement))
+    queries = _request_queries.get()
+    if queries is not None:
+        queries.count += 1
+        queries.seconds += elapsed
@@ -0,0 +1,79 @@
+import asyncio
+import os
+from abc import ABC, abstractmethod
+from typing import AsyncIterator
+
+from metrics import llm_call_duration
+
+
+class LLMProvider(ABC):
+    """Interface for model backends. Subclasses implement both methods; a backend without a separate
+    completion call can return `super().complete(...)`, which joins the stream."""
+
+    @abstractmethod
+    def stream(self, prompt: str, model: str) -> AsyncIterator[str]:
+        """Yields the response in chunks; implement as an async generator."""
+
+    @abstractmethod
+    async def complete(self, prompt: str, model: str) -> str:
+        return "".join([chunk async for chunk in self.stream(prompt, model)])
+
+
+class MockLLMProvider(LLMProvider):
+    """Offline provider answering with the first prompt line.
+
+    `first_token_delay` and `chunk_delay` (seconds) simulate model latency for tests and benchmarks."""
+
+    def __init__(self, chunk_size: int = 8, first_token_delay: float = 0.0, chunk_delay: float = 0.0):
+        self.chunk_size = chunk_size
+        self.first_token_delay = first_token_delay
+        self.chunk_delay = chunk_delay
+
+    @staticmethod
+    def respond(prompt: str, model: str):
+        mock_res = prompt.split("\n")[0].strip()
+        return f"[mock-response from {model}]: {mock_res}"
+
+    async def stream(self, prompt: str, model: str) -> AsyncIterator[str]:
+        text = self.respond(prompt, model)
+        if self.first_token_delay:
+            await asyncio.sleep(self.first_token_delay)
+        for start in range(0, len(text), self.chunk_size):
+            if start and self.chunk_delay:
+                await asyncio.sleep(self.chunk_delay)
+            yield text[start:start + self.chunk_size]
+
+    async def complete(self, prompt: str, model: str) -> str:
+        if not self.first_token_delay and not self.chunk_delay:
+            return self.respond(prompt, model)
+        return await super().complete(prompt, model)
+
+
+LLM_PROVIDERS = {
+    "mock": lambda: MockLLMProvider(
+        first_token_delay=float(os.getenv("MOCK_LLM_FIRST_TOKEN_DELAY", "0")),
+        chunk_delay=float(os.getenv("MOCK_LLM_CHUNK_DELAY", "0"))
+    ),
+}
+
+_provider = LLM_PROVIDERS[os.getenv("LLM_PROVIDER", "mock")]()
+
+
+def get_llm_provider() -> LLMProvider:
+    return _provider
+
+
+def set_llm_provider(provider: LLMProvider):
+    global _provider
+    _provider = provider
+
+
+async def call_llm(prompt: str, model: str) -> str:
+    with llm_call_duration.time(model=model, mode="complete"):
+        return await _provider.complete(prompt, model)
+
+
+async def stream_llm(prompt: str, model: str) -> AsyncIterator[str]:
+    with llm_call_duration.time(model=model, mode="stream"):
+        async for chunk in _provider.stream(prompt, model):
+            yield chunk
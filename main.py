@@ -1,13 +1,43 @@
-from fastapi import FastAPI
+import asyncio
+from contextlib import asynccontextmanager
+
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, PlainTextResponse
+from sqlalchemy.exc import TimeoutError as PoolTimeout
 from starlette.middleware.cors import CORSMiddleware
 
-import models
-from database import engine
+from archive import ExecutionArchiver
+from cache import definition_cache
+from concurrency import concurrency_limiter
+from database import engine, init_models
+from instrumentation import REQUEST_METRICS, RequestMetricsMiddleware, instrument_engine
+from metrics import render_metrics
 from routers import tools, agents, executions
+from worker import ExecutionWorkerPool
+from utils import RedisPoolTimeout
+from write_behind import execution_write_behind
+
 
-models.Base.metadata.create_all(bind=engine)
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    await init_models()
+    await execution_write_behind.start()
+    worker_pool = ExecutionWorkerPool()
+    worker_pool.start()
+    archiver = ExecutionArchiver()
+    archiver.start()
+    listeners = [asyncio.create_task(definition_cache.listen()), asyncio.create_task(concurrency_limiter.listen())]
+    yield
+    for listener in listeners:
+        listener.cancel()
+    await asyncio.gather(*listeners, return_exceptions=True)
+    await archiver.stop()
+    await worker_pool.stop()
+    await execution_write_behind.stop()
+    await engine.dispose()
 
-app = FastAPI(title="Mini Agent Platform")
+
+app = FastAPI(title="Mini Agent Platform", lifespan=lifespan)
 
 app.add_middleware(
     CORSMiddleware,
@@ -17,9 +47,26 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-app.include_router(tools.router, prefix="/tools", tags=["tools"])
-app.include_router(agents.router, prefix="/agents", tags=["agents"])
-app.include_router(executions.router, prefix="/executions", tags=["executions"])
+if REQUEST_METRICS:
+    app.add_middleware(RequestMetricsMiddleware)
+    instrument_engine(engine)
+
+app.include_router(tools.router)
+app.include_router(agents.router)
+app.include_router(executions.router)
+
+
+@app.exception_handler(PoolTimeout)
+@app.exception_handler(RedisPoolTimeout)
+async def pool_timeout_handler(request: Request, exc: Exception):
+    # Every connection of the worker's pool stayed busy for the whole pool timeout.
+    return JSONResponse(status_code=503, content={"detail": "Service busy, try again"},
+                        headers={"Retry-After": "1"})
+
+
+@app.get("/metrics", response_class=PlainTextResponse, include_in_schema=False)
+async def get_metrics():
+    return render_metrics()
 
 if __name__ == "__main__":
     import uvicorn
@@ -0,0 +1,234 @@
+from bisect import bisect_left
+from collections import defaultdict
+from contextlib import contextmanager
+from threading import Lock
+from time import perf_counter
+
+REGISTRY = []
+
+
+class Counter:
+    def __init__(self, name: str, documentation: str, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = defaultdict(float)
+        self._lock = Lock()
+        REGISTRY.append(self)
+
+    def inc(self, amount: float = 1, **labels):
+        key = tuple(labels.get(name, "") for name in self.labelnames)
+        with self._lock:
+            self._values[key] += amount
+
+    def value(self, **labels):
+        return self._values.get(tuple(labels.get(name, "") for name in self.labelnames), 0)
+
+    def collect(self):
+        yield f"# HELP {self.name} {self.documentation}"
+        yield f"# TYPE {self.name} counter"
+        for key, value in sorted(self._values.items()):
+            yield f"{self.name}{format_labels(self.labelnames, key)} {value:g}"
+
+
+class Gauge:
+    """A value that can go up and down. `callbacks` are run on collect to refresh values read from elsewhere."""
+
+    def __init__(self, name: str, documentation: str, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._callbacks = []
+        REGISTRY.append(self)
+
+    def set(self, value: float, **labels):
+        self._values[tuple(labels.get(name, "") for name in self.labelnames)] = value
+
+    def add_callback(self, callback):
+        self._callbacks.append(callback)
+
+    def value(self, **labels):
+        for callback in self._callbacks:
+            callback()
+        return self._values.get(tuple(labels.get(name, "") for name in self.labelnames), 0)
+
+    def collect(self):
+        for callback in self._callbacks:
+            callback()
+        yield f"# HELP {self.name} {self.documentation}"
+        yield f"# TYPE {self.name} gauge"
+        for key, value in sorted(self._values.items()):
+            yield f"{self.name}{format_labels(self.labelnames, key)} {value:g}"
+
+
+class Histogram:
+    DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+    def __init__(self, name: str, documentation: str, labelnames=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(sorted(buckets))
+        # Per label set: count per bucket (not cumulative; the last entry is +Inf), then sum.
+        self._values = {}
+        self._lock = Lock()
+        REGISTRY.append(self)
+
+    def observe(self, value: float, **labels):
+        key = tuple(labels.get(name, "") for name in self.labelnames)
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            counts, total = self._values.get(key) or ([0] * (len(self.buckets) + 1), 0.0)
+            counts[index] += 1
+            self._values[key] = (counts, total + value)
+
+    @contextmanager
+    def time(self, **labels):
+        """Observes the seconds spent in the block, also when it raises."""
+        start = perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(perf_counter() - start, **labels)
+
+    def count(self, **labels):
+        values = self._values.get(tuple(labels.get(name, "") for name in self.labelnames))
+        return sum(values[0]) if values else 0
+
+    def sum(self, **labels):
+        values = self._values.get(tuple(labels.get(name, "") for name in self.labelnames))
+        return values[1] if values else 0
+
+    def totals(self):
+        """(count, sum) over every label set."""
+        values = list(self._values.values())
+        return sum(sum(counts) for counts, _ in values), sum(total for _, total in values)
+
+    def collect(self):
+        yield f"# HELP {self.name} {self.documentation}"
+        yield f"# TYPE {self.name} histogram"
+        for key, (counts, total) in sorted(self._values.items()):
+            cumulative = 0
+            for bound, count in zip((*self.buckets, "+Inf"), counts):
+                cumulative += count
+                labels = format_labels((*self.labelnames, "le"), (*key, f"{bound:g}" if bound != "+Inf" else bound))
+                yield f"{self.name}_bucket{labels} {cumulative}"
+            yield f"{self.name}_sum{format_labels(self.labelnames, key)} {total:g}"
+            yield f"{self.name}_count{format_labels(self.labelnames, key)} {cumulative}"
+
+
+def format_labels(names, values):
+    if not names:
+        return ""
+    pairs = ",".join(f'{name}="{value}"' for name, value in zip(names, values))
+    return "{" + pairs + "}"
+
+
+def render_metrics():
+    lines = []
+    for metric in REGISTRY:
+        lines.extend(metric.collect())
+    return "\n".join(lines) + "\n"
+
+
+rate_limit_decisions = Counter(
+    "rate_limit_decisions_total",
+    "Rate limit decisions by tenant, the tier that answered (local or redis) and outcome.",
+    ("tenant", "tier", "outcome")
+)
+
+llm_cache_requests = Counter(
+    "llm_cache_requests_total",
+    "LLM response cache lookups by tenant and result (hit_local, hit_redis, miss, bypass).",
+    ("tenant", "result")
+)
+
+llm_single_flight = Counter(
+    "llm_single_flight_total",
+    "Model calls by single-flight role: leader (made the call), follower_local / follower_redis "
+    "(shared an in-flight call in this process / another worker) and fallback (leader failed or timed out).",
+    ("tenant", "role")
+)
+
+definition_cache_requests = Counter(
+    "definition_cache_requests_total",
+    "Agent and tool definition cache lookups by kind and result (hit_local, hit_redis, miss).",
+    ("kind", "result")
+)
+
+concurrency_decisions = Counter(
+    "tenant_concurrency_decisions_total",
+    "Run slot requests by tenant and outcome (immediate, queued, rejected, timeout, unavailable).",
+    ("tenant", "outcome")
+)
+
+pool_connections = Gauge(
+    "pool_connections",
+    "Connections per pool (database, redis) by state: in_use, idle, and for the database overflow (open beyond "
+    "the pool size).",
+    ("pool", "state")
+)
+
+pool_wait_seconds = Histogram(
+    "pool_wait_seconds",
+    "Time to get a connection from the pool, including opening a new one.",
+    ("pool",)
+)
+
+pool_overflow = Counter(
+    "pool_overflow_total",
+    "Database connections opened beyond the pool size.",
+    ("pool",)
+)
+
+pool_timeouts = Counter(
+    "pool_timeouts_total",
+    "Requests for a connection that gave up waiting for one (answered with 503).",
+    ("pool",)
+)
+
+http_request_duration = Histogram(
+    "http_request_duration_seconds",
+    "Request latency by method, route template and tenant (empty for requests without a valid API key).",
+    ("method", "route", "tenant")
+)
+
+http_requests = Counter(
+    "http_requests_total",
+    "Requests by method, route template, tenant and response status.",
+    ("method", "route", "tenant", "status")
+)
+
+http_request_db_queries = Histogram(
+    "http_request_db_queries",
+    "Database statements executed per request, by route template.",
+    ("route",),
+    buckets=(0, 1, 2, 3, 5, 10, 20, 50, 100)
+)
+
+http_request_db_seconds = Histogram(
+    "http_request_db_seconds",
+    "Time spent executing database statements per request, by route template.",
+    ("route",)
+)
+
+db_query_duration = Histogram(
+    "db_query_duration_seconds",
+    "Database statement latency by operation (SELECT, INSERT, UPDATE, DELETE, OTHER).",
+    ("operation",)
+)
+
+redis_call_duration = Histogram(
+    "redis_call_duration_seconds",
+    "Redis round-trip latency by operation (rate_limit).",
+    ("operation",)
+)
+
+llm_call_duration = Histogram(
+    "llm_call_duration_seconds",
+    "Model call latency by model and mode (complete, or stream until the last chunk). Cached and coalesced "
+    "runs make no call.",
+    ("model", "mode"),
+    buckets=(0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+)
@@ -0,0 +1,113 @@
+"""Moves executions stored with a full prompt to the prompt-template layout, optionally compressing
+responses, and reports the bytes saved per execution.
+
+Rows whose prompt is not in the original generated format are left as they are. Safe to rerun.
+
+Usage:
+    python -m migrate_executions [--batch-size 1000] [--compress-responses]
+"""
+import argparse
+import asyncio
+import logging
+
+from sqlalchemy import select, or_, and_
+
+import compression
+from cache import get_prompt_template
+from database import SessionLocal, engine, init_models
+from models import Execution, PromptTemplate
+from prompts import CompiledPrompt, count_tokens, template_id
+
+logger = logging.getLogger(__name__)
+
+# Full prompts were stored in the original prompt format: the text after the task and the start of the
+# task line do not depend on the agent.
+PROMPT_SUFFIX = "\n    Please complete the task using the information and tools available to you.\n    "
+TASK_LINE = "    Task: "
+
+
+def split_prompt(prompt: str):
+    """(prefix, task) with `prefix + task + PROMPT_SUFFIX == prompt`, or None for a prompt of another shape.
+
+    The task is taken from the last task line, which is exact unless the task itself contains one; the
+    split is lossless either way."""
+    if not prompt.endswith(PROMPT_SUFFIX):
+        return None
+    head, line, task = prompt[:len(prompt) - len(PROMPT_SUFFIX)].rpartition(TASK_LINE)
+    if not line:
+        return None
+    return head + line, task
+
+
+def stored_size(execution: Execution) -> int:
+    return sum(len(value.encode()) if isinstance(value, str) else len(value)
+               for value in (execution.stored_prompt, execution.task, execution.stored_response,
+                             execution.response_zstd)
+               if value is not None)
+
+
+async def migrate(batch_size: int = 1000, compress_responses: bool = False) -> dict:
+    needs_migration = Execution.stored_prompt.is_not(None)
+    if compress_responses:
+        compression.RESPONSE_COMPRESSION = "zstd"
+        needs_migration = or_(needs_migration,
+                              and_(Execution.stored_response.is_not(None), Execution.response_zstd.is_(None)))
+    migrated = bytes_before = bytes_after = 0
+    new_templates, seen_templates = 0, set()
+    last_id = 0
+    while True:
+        async with SessionLocal() as db:
+            executions = (await db.scalars(
+                select(Execution).filter(Execution.id > last_id, needs_migration)
+                .order_by(Execution.id).limit(batch_size)
+            )).all()
+            if not executions:
+                break
+            for execution in executions:
+                before = stored_size(execution)
+                if execution.stored_prompt is not None and (parts := split_prompt(execution.stored_prompt)):
+                    prefix, task = parts
+                    compiled = CompiledPrompt(prefix, PROMPT_SUFFIX, template_id(prefix, PROMPT_SUFFIX),
+                                              count_tokens(prefix + PROMPT_SUFFIX), 0)
+                    if compiled.template_id not in seen_templates:
+                        seen_templates.add(compiled.template_id)
+                        if not await db.get(PromptTemplate, compiled.template_id):
+                            new_templates += 1
+                            bytes_after += len(prefix.encode()) + len(PROMPT_SUFFIX.encode())
+                    template = await get_prompt_template(db, compiled)
+                    execution.prompt_template, execution.prompt_template_id = template, template.id
+                    execution.task, execution.stored_prompt = task, None
+                if compress_responses and execution.stored_response is not None:
+                    execution.response = execution.stored_response
+                bytes_before += before
+                bytes_after += stored_size(execution)
+            migrated += len(executions)
+            last_id = executions[-1].id
+            await db.commit()
+        logger.info("Migrated %s executions", migrated)
+    return {"executions": migrated, "bytes_before": bytes_before, "bytes_after": bytes_after,
+            "new_templates": new_templates}
+
+
+async def main(batch_size, compress_responses):
+    logging.basicConfig(level=logging.INFO)
+    await init_models()
+    result = await migrate(batch_size, compress_responses)
+    await engine.dispose()
+    if result["executions"]:
+        print(f"migrated {result['executions']} executions, prompt and response bytes "
+              f"{result['bytes_before']} -> {result['bytes_after']} "
+              f"({result['bytes_before'] / result['executions']:.0f} -> "
+              f"{result['bytes_after'] / result['executions']:.0f} per execution, "
+              f"including {result['new_templates']} new templates)")
+    else:
+        print("nothing to migrate")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Migrate executions to deduplicated prompt storage.")
+    parser.add_argument("--batch-size", type=int, default=1000)
+    parser.add_argument("--compress-responses", action="store_true",
+                        help="also zstd-compress stored responses where that makes them smaller")
+    args = parser.parse_args()
+    asyncio.run(main(args.batch_size, args.compress_responses))
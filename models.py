@@ -1,19 +1,40 @@
 from datetime import datetime
 
-from sqlalchemy import Integer, Column, String, ForeignKey, Table, Text, DateTime
+from sqlalchemy import Integer, Column, String, ForeignKey, Table, Text, DateTime, Index, Boolean, false, JSON, \
+    LargeBinary, BigInteger, DDL, event, func
 from sqlalchemy.orm import relationship
 
+from compression import compress_response, decompress_response
 from database import Base
 
+EXECUTION_QUEUED = "queued"
+EXECUTION_RUNNING = "running"
+EXECUTION_SUCCEEDED = "succeeded"
+EXECUTION_FAILED = "failed"
+EXECUTION_FINISHED = (EXECUTION_SUCCEEDED, EXECUTION_FAILED)
 
 agent_tools = Table(
     "agent_tools",
     Base.metadata,
     Column("agent_id", Integer, ForeignKey("agent.id"), primary_key=True),
     Column("tool_id", Integer, ForeignKey("tool.id"), primary_key=True),
+    # The primary key serves lookups by agent; this one serves "agents using a tool".
+    Index("ix_agent_tools_tool_id", "tool_id", "agent_id"),
 )
 
 
+def name_indexes(table_name: str, name: Column):
+    """Indexes for listing a tenant's rows by exact name and by case-insensitive name prefix.
+
+    text_pattern_ops lets PostgreSQL answer `lower(name) LIKE 'prefix%'` from the index whatever the
+    database collation."""
+    return (
+        Index(f"ix_{table_name}_tenant_name", "tenant_id", name),
+        Index(f"ix_{table_name}_tenant_lower_name", "tenant_id", func.lower(name).label("lower_name"),
+              postgresql_ops={"lower_name": "text_pattern_ops"}),
+    )
+
+
 class Agent(Base):
     __tablename__ = "agent"
 
@@ -24,6 +45,8 @@ class Agent(Base):
     tenant_id = Column(String, index=True, nullable=False)
     tools = relationship("Tool", secondary=agent_tools)
 
+    __table_args__ = name_indexes("agent", name)
+
 
 class Tool(Base):
     __tablename__ = "tool"
@@ -33,15 +56,136 @@ class Tool(Base):
     description = Column(Text, nullable=False)
     tenant_id = Column(String, index=True, nullable=False)
 
+    __table_args__ = name_indexes("tool", name)
+
+
+class PromptTemplate(Base):
+    """The text around the task in a generated prompt, stored once per distinct content.
+
+    The id is a hash of the content (prompts.template_id), so rows are never updated and can be shared by
+    any number of executions."""
+    __tablename__ = "prompt_template"
+
+    id = Column(String(64), primary_key=True)
+    prefix = Column(Text, nullable=False)
+    suffix = Column(Text, nullable=False)
+
+    def render(self, task: str) -> str:
+        return f"{self.prefix}{task}{self.suffix}"
+
 
 class Execution(Base):
+    """An agent run.
+
+    The prompt is stored as a PromptTemplate reference plus the task and rebuilt on access; rows written
+    before that keep the full text in the `prompt` column. The response may be stored zstd-compressed in
+    `response_zstd` instead of `response` (see compression.py). Use the `prompt` and `response` properties
+    rather than the stored columns."""
     __tablename__ = "execution"
 
     id = Column(Integer, primary_key=True)
     tenant_id = Column(String, index=True, nullable=False)
     agent_id = Column(Integer, ForeignKey("agent.id"), nullable=False)
-    prompt = Column(Text, nullable=False)
+    stored_prompt = Column("prompt", Text)
+    prompt_template_id = Column(String(64), ForeignKey("prompt_template.id"))
+    task = Column(Text)
     model = Column(String, nullable=False)
-    response = Column(Text, nullable=False)
+    stored_response = Column("response", Text)
+    response_zstd = Column(LargeBinary)
     timestamp = Column(DateTime, default=datetime.utcnow)
+    status = Column(String, nullable=False, default=EXECUTION_SUCCEEDED, server_default=EXECUTION_SUCCEEDED)
+    error = Column(Text)
+    cached = Column(Boolean, nullable=False, default=False, server_default=false())
+
+    # Keyset pagination walks executions newest-first on (timestamp, id) within a tenant,
+    # optionally narrowed to one agent.
+    __table_args__ = (
+        Index("ix_execution_tenant_timestamp_id", "tenant_id", "timestamp", "id"),
+        Index("ix_execution_tenant_agent_timestamp_id", "tenant_id", "agent_id", "timestamp", "id"),
+    )
+
+    prompt_template = relationship(PromptTemplate, lazy="selectin")
+
+    @property
+    def prompt(self) -> str:
+        if self.prompt_template is not None:
+            return self.prompt_template.render(self.task)
+        return self.stored_prompt
+
+    @prompt.setter
+    def prompt(self, prompt: str):
+        self.prompt_template, self.prompt_template_id, self.task, self.stored_prompt = None, None, None, prompt
+
+    @property
+    def response(self):
+        if self.response_zstd is not None:
+            return decompress_response(self.response_zstd)
+        return self.stored_response
+
+    @response.setter
+    def response(self, response):
+        self.stored_response, self.response_zstd = compress_response(response)
+
+
+class ExecutionRollup(Base):
+    """Totals of the finished executions created in one bucket of time, per agent and model (see rollups.py).
+
+    `bucket` is the start of the minute, hour or day named by `granularity`."""
+    __tablename__ = "execution_rollup"
+
+    tenant_id = Column(String, primary_key=True)
+    granularity = Column(String(6), primary_key=True)
+    bucket = Column(DateTime, primary_key=True)
+    agent_id = Column(Integer, primary_key=True)
+    model = Column(String, primary_key=True)
+    runs = Column(Integer, nullable=False, default=0)
+    succeeded = Column(Integer, nullable=False, default=0)
+    failed = Column(Integer, nullable=False, default=0)
+    cached = Column(Integer, nullable=False, default=0)
+    prompt_tokens = Column(BigInteger, nullable=False, default=0)
+    response_tokens = Column(BigInteger, nullable=False, default=0)
+
+
+class ExecutionSegment(Base):
+    """Index entry for a file of archived executions (see archive.py).
+
+    Rows in a segment are ordered by (timestamp, id); `first_*` and `last_*` are the keys of its first
+    and last row, `min_id`/`max_id` bound the ids it holds for lookups by id."""
+    __tablename__ = "execution_segment"
+
+    id = Column(Integer, primary_key=True)
+    tenant_id = Column(String, nullable=False)
+    path = Column(String, nullable=False)
+    row_count = Column(Integer, nullable=False)
+    agent_ids = Column(JSON, nullable=False)
+    first_timestamp = Column(DateTime, nullable=False)
+    first_id = Column(Integer, nullable=False)
+    last_timestamp = Column(DateTime, nullable=False)
+    last_id = Column(Integer, nullable=False)
+    min_id = Column(Integer, nullable=False)
+    max_id = Column(Integer, nullable=False)
+    created_at = Column(DateTime, default=datetime.utcnow)
+
+    __table_args__ = (
+        Index("ix_execution_segment_tenant_last", "tenant_id", "last_timestamp", "last_id"),
+    )
+
 
+# The execution search index (see search.py) has no model: on PostgreSQL it is a tsvector column in a GIN
+# index led by tenant_id (btree_gin indexes the plain column), on SQLite an FTS5 table keyed by rowid =
+# execution id. Created with the other tables; the tenant-less GIN index of earlier versions is dropped.
+for statement, dialect in [
+    ("CREATE EXTENSION IF NOT EXISTS btree_gin", "postgresql"),
+    ("CREATE TABLE IF NOT EXISTS execution_search ("
+     "execution_id INTEGER PRIMARY KEY REFERENCES execution (id), "
+     "tenant_id VARCHAR NOT NULL, "
+     "document TSVECTOR NOT NULL)", "postgresql"),
+    ("CREATE INDEX IF NOT EXISTS ix_execution_search_tenant_document ON execution_search "
+     "USING gin (tenant_id, document)", "postgresql"),
+    ("DROP INDEX IF EXISTS ix_execution_search_document", "postgresql"),
+    ("CREATE INDEX IF NOT EXISTS ix_execution_search_tenant_id ON execution_search (tenant_id, execution_id)",
+     "postgresql"),
+    ("CREATE VIRTUAL TABLE IF NOT EXISTS execution_search "
+     "USING fts5(tenant_id UNINDEXED, document, tokenize='porter unicode61')", "sqlite"),
+]:
+    event.listen(Base.metadata, "after_create", DDL(statement).execute_if(dialect=dialect))
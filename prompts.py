@@ -0,0 +1,67 @@
+import hashlib
+import math
+import os
+from typing import List, NamedTuple
+
+from base_model import AgentResponse, ToolResponse
+
+# 0 means no budget. Tokens are estimated at CHARS_PER_TOKEN characters each, which is close for
+# English text with the common tokenizers; the budget is a guard, not an exact limit.
+PROMPT_TOKEN_BUDGET = int(os.getenv("PROMPT_TOKEN_BUDGET", "0"))
+CHARS_PER_TOKEN = 4
+
+PROMPT_SUFFIX = "\nPlease complete the task using the information and tools available to you.\n"
+
+
+class CompiledPrompt(NamedTuple):
+    """The static text around the task for one version of an agent."""
+    prefix: str
+    suffix: str
+    template_id: str
+    tokens: int
+    omitted_tools: int
+
+    def render(self, task: str) -> str:
+        return f"{self.prefix}{task}{self.suffix}"
+
+
+def count_tokens(text: str) -> int:
+    return math.ceil(len(text) / CHARS_PER_TOKEN)
+
+
+def template_id(prefix: str, suffix: str) -> str:
+    """Content address of a prompt template (see models.PromptTemplate)."""
+    return hashlib.sha256(f"{prefix}\0{suffix}".encode()).hexdigest()
+
+
+def format_tool(tool: ToolResponse) -> str:
+    return f"- {tool.name}: {tool.description}"
+
+
+def format_prefix(agent: AgentResponse, tool_lines: List[str]) -> str:
+    tools = "\n".join(tool_lines) if tool_lines else "No tools available"
+    return (f"You are {agent.name}, {agent.role}.\n"
+            f"Description: {agent.description}\n"
+            f"Available tools:\n{tools}\n"
+            f"Task: ")
+
+
+def compile_prompt(agent: AgentResponse, token_budget: int = PROMPT_TOKEN_BUDGET) -> CompiledPrompt:
+    """Renders everything in the agent's prompt except the task.
+
+    With a token budget, tools are dropped from the end of the catalog until the static text fits,
+    and a closing line says how many were left out. Name, role and description are never cut."""
+    tool_lines = [format_tool(tool) for tool in agent.tools]
+    prefix = format_prefix(agent, tool_lines)
+    omitted = 0
+    if token_budget:
+        while tool_lines and count_tokens(prefix + PROMPT_SUFFIX) > token_budget:
+            tool_lines.pop()
+            omitted += 1
+            prefix = format_prefix(agent, tool_lines + [f"- ... {omitted} more tools not listed"])
+    return CompiledPrompt(prefix, PROMPT_SUFFIX, template_id(prefix, PROMPT_SUFFIX),
+                          count_tokens(prefix + PROMPT_SUFFIX), omitted)
+
+
+def generate_prompt(agent: AgentResponse, task: str) -> str:
+    return compile_prompt(agent).render(task)
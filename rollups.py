@@ -0,0 +1,159 @@
+"""Execution rollups: run counts and token volumes per tenant, agent and model in minute, hour and day buckets.
+
+Every write that finishes an execution adds it to its three buckets in the same transaction, so
+GET /executions/stats reads a row per bucket instead of scanning executions. An execution counts in the
+buckets of its timestamp (when it was created) once it has succeeded or failed. Archiving executions
+does not change the rollups.
+
+Usage (rebuild the rollups from the executions table and the archive, e.g. for executions recorded
+before rollups existed):
+    python -m rollups [--tenant tenant_b]
+"""
+import argparse
+import asyncio
+import logging
+from datetime import datetime, timedelta
+from typing import Iterable, List
+
+from sqlalchemy import select, delete, text, union
+from sqlalchemy.dialects import postgresql, sqlite
+
+from archive import iter_archived
+from database import SessionLocal, engine, init_models
+from models import Execution, ExecutionRollup, ExecutionSegment, EXECUTION_FINISHED, EXECUTION_SUCCEEDED, \
+    EXECUTION_FAILED
+from prompts import count_tokens
+
+logger = logging.getLogger(__name__)
+
+GRANULARITIES = {
+    "minute": timedelta(minutes=1),
+    "hour": timedelta(hours=1),
+    "day": timedelta(days=1),
+}
+COUNTERS = ("runs", "succeeded", "failed", "cached", "prompt_tokens", "response_tokens")
+BACKFILL_BATCH_SIZE = 1000
+
+
+def bucket_start(timestamp: datetime, granularity: str) -> datetime:
+    if granularity == "minute":
+        return timestamp.replace(second=0, microsecond=0)
+    if granularity == "hour":
+        return timestamp.replace(minute=0, second=0, microsecond=0)
+    return timestamp.replace(hour=0, minute=0, second=0, microsecond=0)
+
+
+def execution_usage(tenant_id: str, execution) -> dict:
+    """What a finished execution (an Execution or an archived ExecutionResponse) adds to its buckets."""
+    return {
+        "tenant_id": tenant_id,
+        "agent_id": execution.agent_id,
+        "model": execution.model,
+        "timestamp": execution.timestamp,
+        "runs": 1,
+        "succeeded": int(execution.status == EXECUTION_SUCCEEDED),
+        "failed": int(execution.status == EXECUTION_FAILED),
+        "cached": int(bool(execution.cached)),
+        "prompt_tokens": count_tokens(execution.prompt or ""),
+        "response_tokens": count_tokens(execution.response or ""),
+    }
+
+
+def aggregate(usages: Iterable[dict], rows: dict = None) -> dict:
+    """Sums `usages` into `rows`, keyed by (tenant_id, granularity, bucket, agent_id, model)."""
+    rows = {} if rows is None else rows
+    for usage in usages:
+        for granularity in GRANULARITIES:
+            key = (usage["tenant_id"], granularity, bucket_start(usage["timestamp"], granularity),
+                   usage["agent_id"], usage["model"])
+            totals = rows.get(key)
+            if totals is None:
+                rows[key] = {counter: usage[counter] for counter in COUNTERS}
+            else:
+                for counter in COUNTERS:
+                    totals[counter] += usage[counter]
+    return rows
+
+
+async def add_rollups(db, rows: dict):
+    """Adds aggregated `rows` to the stored buckets with one upsert run per row; `db` is a session or a
+    connection.
+
+    Rows are written in key order, so concurrent writers lock shared buckets in the same order."""
+    if not rows:
+        return
+    table = ExecutionRollup.__table__
+    dialect_insert = postgresql.insert if engine.dialect.name == "postgresql" else sqlite.insert
+    statement = dialect_insert(table)
+    statement = statement.on_conflict_do_update(
+        index_elements=[column.name for column in table.primary_key],
+        set_={counter: table.c[counter] + statement.excluded[counter] for counter in COUNTERS}
+    )
+    await db.execute(statement, [
+        {"tenant_id": tenant_id, "granularity": granularity, "bucket": bucket, "agent_id": agent_id,
+         "model": model, **totals}
+        for (tenant_id, granularity, bucket, agent_id, model), totals in sorted(rows.items())
+    ])
+
+
+async def record_executions(db, executions: List[Execution]):
+    """Adds the finished ones of `executions` to the rollups; call before committing them."""
+    await add_rollups(db, aggregate(execution_usage(execution.tenant_id, execution)
+                                    for execution in executions if execution.status in EXECUTION_FINISHED))
+
+
+async def rebuild_tenant(tenant_id: str) -> int:
+    """Recomputes the tenant's rollups from its executions, hot and archived; returns how many were counted.
+
+    Runs in one transaction. On PostgreSQL it locks the rollup table against writes and the segment
+    index against archiving, so runs finishing meanwhile wait and are added after the rebuild, once."""
+    rows, counted = {}, 0
+    async with SessionLocal() as db:
+        if engine.dialect.name == "postgresql":
+            await db.execute(text("LOCK TABLE execution_rollup IN SHARE ROW EXCLUSIVE MODE"))
+            await db.execute(text("LOCK TABLE execution_segment IN SHARE MODE"))
+        await db.execute(delete(ExecutionRollup).filter(ExecutionRollup.tenant_id == tenant_id))
+        async for executions in iter_archived(db, tenant_id):
+            aggregate((execution_usage(tenant_id, execution) for execution in executions
+                       if execution.status in EXECUTION_FINISHED), rows)
+            counted += len(executions)
+        result = await db.stream_scalars(
+            select(Execution)
+            .filter(Execution.tenant_id == tenant_id, Execution.status.in_(EXECUTION_FINISHED))
+            .execution_options(yield_per=BACKFILL_BATCH_SIZE)
+        )
+        async for executions in result.partitions():
+            aggregate((execution_usage(tenant_id, execution) for execution in executions), rows)
+            counted += len(executions)
+        await add_rollups(db, rows)
+        await db.commit()
+    return counted
+
+
+async def rebuild(tenant_ids=None) -> dict:
+    """Rebuilds every tenant that has executions, or only `tenant_ids`."""
+    if tenant_ids is None:
+        async with SessionLocal() as db:
+            tenant_ids = sorted((await db.scalars(union(
+                select(Execution.tenant_id).distinct(), select(ExecutionSegment.tenant_id).distinct()
+            ))).all())
+    counted = {}
+    for tenant_id in tenant_ids:
+        counted[tenant_id] = await rebuild_tenant(tenant_id)
+        logger.info("Rebuilt rollups of %s from %s executions", tenant_id, counted[tenant_id])
+    return counted
+
+
+async def main(tenant_ids=None):
+    logging.basicConfig(level=logging.INFO)
+    await init_models()
+    for tenant_id, counted in (await rebuild(tenant_ids)).items():
+        print(f"{tenant_id}: rolled up {counted} executions")
+    await engine.dispose()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Rebuild execution rollups from the stored executions.")
+    parser.add_argument("--tenant", action="append", help="only this tenant (repeatable)")
+    args = parser.parse_args()
+    asyncio.run(main(args.tenant))
@@ -1,40 +1,227 @@
+import asyncio
+import json
+import logging
 from datetime import datetime
 from typing import Optional, List
 
-from fastapi import HTTPException, APIRouter
-from sqlalchemy.orm import joinedload
+from fastapi import HTTPException, APIRouter, Response, Query, Request
+from fastapi.responses import StreamingResponse
+from sqlalchemy import select, insert, delete
+from sqlalchemy.orm import selectinload
 
-from base_model import AgentBase, AgentUpdate, AgentRunRequest, AgentResponse, AgentRunResponse
-from models import Agent, Tool, Execution
-from utils import generate_prompt, mock_llm_call, check_tenant_limit, db_dependency, api_key_dependency, \
-    SUPPORTED_MODELS
+from archive import archived_agent_ids
+from base_model import AgentBase, AgentUpdate, AgentRunRequest, AgentResponse, AgentRunResponse, \
+    AgentBatchRunRequest, AgentBatchRunResponse, AgentBatchRunResult, AgentBulkCreateRequest, \
+    AgentBulkUpdateRequest, AgentBulkResult, AgentBulkResponse, BulkDeleteRequest, BulkDeleteResult, \
+    BulkDeleteResponse, ToolResponse
+from database import SessionLocal
+from etag import bump_versions, conditional_get
+from cache import cached_call_llm, response_cache, definition_cache, get_agent_definition, \
+    get_agent_definitions, get_prompt_template, get_compiled_prompt
+from concurrency import concurrency_limiter
+from llm import stream_llm
+from models import Agent, Tool, Execution, PromptTemplate, agent_tools, EXECUTION_QUEUED, EXECUTION_RUNNING, \
+    EXECUTION_SUCCEEDED, EXECUTION_FAILED
+from rollups import record_executions
+from search import index_executions
+from serialization import json_list_response, model_columns, model_fields
+from utils import check_tenant_limit, db_dependency, api_key_dependency, \
+    SUPPORTED_MODELS, rate_limit_headers, reserve_tenant_limit, release_tenant_limit, check_bulk_errors, \
+    decode_id_cursor, encode_id_cursor, name_filter, NameMatch, MAX_PAGE_SIZE
+from worker import enqueue_execution
+from write_behind import execution_write_behind
 
-router = APIRouter()
+logger = logging.getLogger(__name__)
+
+router = APIRouter(prefix="/agents", tags=["agents"])
+
+AGENT_FIELDS = model_fields(AgentResponse, exclude=("tools",))
+TOOL_FIELDS = model_fields(ToolResponse)
+
+# Streamed runs keep going after a client disconnects; hold their tasks so they are not garbage collected.
+_background_runs = set()
 
 
 @router.get("", response_model=List[AgentResponse])
 async def get_agents(db: db_dependency,
                      tenant_id: api_key_dependency,
+                     request: Request,
+                     response: Response,
                      tool_name: Optional[str] = None,
-                     name: Optional[str] = None):
-    result = db.query(Agent) \
-        .options(joinedload(Agent.tools)) \
-        .filter(Agent.tenant_id == tenant_id)
+                     name: Optional[str] = None,
+                     match: NameMatch = "exact",
+                     cursor: Optional[str] = None,
+                     page_size: Optional[int] = Query(None, ge=1, le=MAX_PAGE_SIZE)):
+    """Agents in id order, optionally only those named `name` or using a tool named `tool_name`.
+
+    `match=prefix` turns both filters into case-insensitive prefix matches. With `page_size` the list comes
+    one page at a time: pass the `X-Next-Cursor` header of a response as `cursor` to get the next page."""
+    if not_modified := await conditional_get(request, response, tenant_id, "agents"):
+        return not_modified
+    query = select(*model_columns(Agent, AGENT_FIELDS)).filter(Agent.tenant_id == tenant_id)
     if tool_name:
-        result = result.join(Agent.tools).filter(Tool.name == tool_name)
+        # A semi-join, so an agent with several matching tools is listed once; the database can start
+        # from the matching tools through the name index instead of checking every agent.
+        query = query.filter(Agent.id.in_(
+            select(agent_tools.c.agent_id)
+            .join(Tool, Tool.id == agent_tools.c.tool_id)
+            .filter(Tool.tenant_id == tenant_id, name_filter(Tool.name, tool_name, match))
+        ))
     if name:
-        result = result.filter(Agent.name == name)
-    agents = result.all()
+        query = query.filter(name_filter(Agent.name, name, match))
+    if cursor is not None:
+        query = query.filter(Agent.id > decode_id_cursor(cursor))
+    query = query.order_by(Agent.id)
+    if page_size is not None:
+        query = query.limit(page_size + 1)
+    agents = (await db.execute(query)).all()
     if not agents:
-        return HTTPException(status_code=404, detail="Agents not found")
-    return agents
+        raise HTTPException(status_code=404, detail="Agents not found")
+    if page_size is not None and len(agents) > page_size:
+        agents = agents[:page_size]
+        response.headers["X-Next-Cursor"] = encode_id_cursor(agents[-1].id)
+        query = query.limit(page_size)
+
+    # The tools of every listed agent in one query, with the page query as a subquery.
+    agent_ids = query.with_only_columns(Agent.id)
+    tools = {}
+    for row in await db.execute(select(agent_tools.c.agent_id, *model_columns(Tool, TOOL_FIELDS))
+                                .join(Tool, Tool.id == agent_tools.c.tool_id)
+                                .filter(agent_tools.c.agent_id.in_(agent_ids))
+                                .order_by(Tool.id)):
+        tools.setdefault(row[0], []).append(dict(zip(TOOL_FIELDS, row[1:])))
+    return json_list_response([{**dict(zip(AGENT_FIELDS, agent)), "tools": tools.get(agent.id, [])}
+                               for agent in agents], response)
+
+
+async def load_tools(db, tenant_id, tool_ids):
+    tools = (await db.scalars(select(Tool).filter(Tool.id.in_(tool_ids), Tool.tenant_id == tenant_id))).all()
+    return {tool.id: tool for tool in tools}
+
+
+def missing_tools(tool_ids, tools):
+    return len(set(tool_ids)) != len(tool_ids) or any(tool_id not in tools for tool_id in tool_ids)
+
+
+# Bulk routes are declared before the /{agent_id} routes, which would otherwise match "bulk".
+@router.post("/bulk", response_model=AgentBulkResponse)
+async def create_agents_bulk(request: AgentBulkCreateRequest, db: db_dependency, tenant_id: api_key_dependency):
+    """Creates agents in one transaction: one query validates every referenced tool, one multi-row
+    INSERT ... RETURNING adds the agents and one more adds their agent_tools rows."""
+    tools = await load_tools(db, tenant_id, {tool_id for item in request.items for tool_id in item.tool_ids})
+    errors = {index: (400, "One or more tools not found")
+              for index, item in enumerate(request.items) if missing_tools(item.tool_ids, tools)}
+    check_bulk_errors(request.mode, errors)
+
+    valid = [index for index in range(len(request.items)) if index not in errors]
+    created = {}
+    if valid:
+        agent_ids = (await db.scalars(
+            insert(Agent).returning(Agent.id, sort_by_parameter_order=True),
+            [{"tenant_id": tenant_id, **request.items[index].model_dump(exclude={"tool_ids"})} for index in valid]
+        )).all()
+        links = [{"agent_id": agent_id, "tool_id": tool_id}
+                 for index, agent_id in zip(valid, agent_ids) for tool_id in request.items[index].tool_ids]
+        if links:
+            await db.execute(insert(agent_tools), links)
+        await db.commit()
+        await bump_versions(tenant_id, "agents", "tools")
+        for index, agent_id in zip(valid, agent_ids):
+            item = request.items[index]
+            created[index] = AgentResponse(
+                id=agent_id,
+                tenant_id=tenant_id,
+                name=item.name,
+                role=item.role,
+                description=item.description,
+                tools=[ToolResponse.model_validate(tools[tool_id]) for tool_id in item.tool_ids]
+            )
+    return AgentBulkResponse(results=[
+        AgentBulkResult(status_code=errors[index][0], detail=errors[index][1]) if index in errors
+        else AgentBulkResult(status_code=200, agent=created[index])
+        for index in range(len(request.items))
+    ])
+
+
+@router.put("/bulk", response_model=AgentBulkResponse)
+async def update_agents_bulk(request: AgentBulkUpdateRequest, db: db_dependency, tenant_id: api_key_dependency):
+    agents = (await db.scalars(
+        select(Agent)
+        .options(selectinload(Agent.tools))
+        .filter(Agent.tenant_id == tenant_id, Agent.id.in_({item.id for item in request.items}))
+    )).all()
+    agents = {agent.id: agent for agent in agents}
+    tools = await load_tools(db, tenant_id, {tool_id for item in request.items for tool_id in item.tool_ids or []})
+    errors = {}
+    for index, item in enumerate(request.items):
+        if item.id not in agents:
+            errors[index] = (404, "Agent not found")
+        elif item.tool_ids and missing_tools(item.tool_ids, tools):
+            errors[index] = (400, "One or more tools not found")
+    check_bulk_errors(request.mode, errors)
+
+    updated = set()
+    for index, item in enumerate(request.items):
+        if index in errors:
+            continue
+        agent = agents[item.id]
+        if item.name:
+            agent.name = item.name
+        if item.role:
+            agent.role = item.role
+        if item.description:
+            agent.description = item.description
+        if item.tool_ids:
+            agent.tools = [tools[tool_id] for tool_id in item.tool_ids]
+        updated.add(item.id)
+    await db.commit()
+    await definition_cache.invalidate(tenant_id, agent_ids=updated)
+    await bump_versions(tenant_id, "agents", "tools", *(f"agent:{agent_id}" for agent_id in updated))
+    return AgentBulkResponse(results=[
+        AgentBulkResult(status_code=errors[index][0], detail=errors[index][1]) if index in errors
+        else AgentBulkResult(status_code=200, agent=agents[item.id])
+        for index, item in enumerate(request.items)
+    ])
+
+
+@router.delete("/bulk", response_model=BulkDeleteResponse)
+async def delete_agents_bulk(request: BulkDeleteRequest, db: db_dependency, tenant_id: api_key_dependency):
+    existing = set((await db.scalars(
+        select(Agent.id).filter(Agent.tenant_id == tenant_id, Agent.id.in_(request.ids))
+    )).all())
+    with_executions = await agents_with_executions(db, tenant_id, existing)
+    errors = {}
+    for index, agent_id in enumerate(request.ids):
+        if agent_id not in existing:
+            errors[index] = (404, "Agent not found")
+        elif agent_id in with_executions:
+            errors[index] = (400, "Cannot delete agent, it has executions.")
+    check_bulk_errors(request.mode, errors)
+
+    deleted = existing - with_executions
+    if deleted:
+        await db.execute(delete(agent_tools).filter(agent_tools.c.agent_id.in_(deleted)))
+        await db.execute(delete(Agent).filter(Agent.tenant_id == tenant_id, Agent.id.in_(deleted)))
+        await db.commit()
+        await definition_cache.invalidate(tenant_id, agent_ids=deleted)
+        await bump_versions(tenant_id, "agents", "tools", *(f"agent:{agent_id}" for agent_id in deleted))
+    return BulkDeleteResponse(results=[
+        BulkDeleteResult(id=agent_id, status_code=errors[index][0], detail=errors[index][1]) if index in errors
+        else BulkDeleteResult(id=agent_id, status_code=200)
+        for index, agent_id in enumerate(request.ids)
+    ])
 
 
 @router.get("/{agent_id}", response_model=AgentResponse)
-async def get_agent_by_id(agent_id: int, db: db_dependency, tenant_id: api_key_dependency):
-    result = db.query(Agent) \
-        .options(joinedload(Agent.tools)) \
-        .filter(Agent.id == agent_id, Agent.tenant_id == tenant_id).first()
+async def get_agent_by_id(agent_id: int,
+                          db: db_dependency,
+                          tenant_id: api_key_dependency,
+                          request: Request,
+                          response: Response):
+    if not_modified := await conditional_get(request, response, tenant_id, f"agent:{agent_id}",
+                                             exists=lambda: get_agent_definition(db, tenant_id, agent_id)):
+        return not_modified
+    result = await get_agent_definition(db, tenant_id, agent_id)
     if not result:
         raise HTTPException(status_code=404, detail="Agent not found.")
     return result
@@ -42,11 +229,19 @@ async def get_agent_by_id(agent_id: int, db: db_dependency, tenant_id: api_key_d
 
 @router.delete("/{agent_id}")
 async def delete_agent_by_id(agent_id: int, db: db_dependency, tenant_id: api_key_dependency):
-    agent = db.query(Agent).filter(Agent.tenant_id == tenant_id, Agent.id == agent_id).first()
+    agent = await db.scalar(
+        select(Agent)
+        .options(selectinload(Agent.tools))
+        .filter(Agent.tenant_id == tenant_id, Agent.id == agent_id)
+    )
     if not agent:
         raise HTTPException(status_code=404, detail="Agent not found")
-    db.delete(agent)
-    db.commit()
+    if await agents_with_executions(db, tenant_id, [agent_id]):
+        raise HTTPException(status_code=400, detail="Cannot delete agent, it has executions.")
+    await db.delete(agent)
+    await db.commit()
+    await definition_cache.invalidate(tenant_id, agent_ids=[agent_id])
+    await bump_versions(tenant_id, "agents", "tools", f"agent:{agent_id}")
     return {"detail": f"Deleted agent: {agent_id}"}
 
 
@@ -55,7 +250,11 @@ async def update_agent_by_id(agent_id: int,
                              agent_update: AgentUpdate,
                              db: db_dependency,
                              tenant_id: api_key_dependency):
-    agent = db.query(Agent).filter(Agent.tenant_id == tenant_id, Agent.id == agent_id).first()
+    agent = await db.scalar(
+        select(Agent)
+        .options(selectinload(Agent.tools))
+        .filter(Agent.tenant_id == tenant_id, Agent.id == agent_id)
+    )
     if not agent:
         raise HTTPException(status_code=404, detail="Agent not found")
     if agent_update.name:
@@ -65,18 +264,24 @@ async def update_agent_by_id(agent_id: int,
     if agent_update.description:
         agent.description = agent_update.description
     if agent_update.tool_ids:
-        tools = db.query(Tool).filter(Tool.id.in_(agent_update.tool_ids), Tool.tenant_id == tenant_id).all()
+        tools = (await db.scalars(
+            select(Tool).filter(Tool.id.in_(agent_update.tool_ids), Tool.tenant_id == tenant_id)
+        )).all()
         if len(tools) != len(agent_update.tool_ids):
             raise HTTPException(status_code=400, detail="One or more tools not found")
         agent.tools = tools
-    db.commit()
-    db.refresh(agent)
+    await db.commit()
+    await definition_cache.invalidate(tenant_id, agent_ids=[agent_id])
+    await bump_versions(tenant_id, "agents", "tools", f"agent:{agent_id}")
+    await db.refresh(agent, attribute_names=["name", "role", "description", "tools"])
     return agent
 
 
 @router.post("", response_model=AgentResponse)
 async def create_agent(agent: AgentBase, db: db_dependency, tenant_id: api_key_dependency):
-    tools = db.query(Tool).filter(Tool.id.in_(agent.tool_ids), Tool.tenant_id == tenant_id).all()
+    tools = (await db.scalars(
+        select(Tool).filter(Tool.id.in_(agent.tool_ids), Tool.tenant_id == tenant_id)
+    )).all()
     if len(tools) != len(agent.tool_ids):
         raise HTTPException(status_code=400, detail="One or more tools not found")
 
@@ -88,8 +293,8 @@ async def create_agent(agent: AgentBase, db: db_dependency, tenant_id: api_key_d
         tools=tools
     )
     db.add(db_agent)
-    db.commit()
-    db.refresh(db_agent)
+    await db.commit()
+    await bump_versions(tenant_id, "agents", "tools")
     return AgentResponse(
         id=db_agent.id,
         tenant_id=tenant_id,
@@ -101,37 +306,292 @@ async def create_agent(agent: AgentBase, db: db_dependency, tenant_id: api_key_d
 
 
 @router.post("/{agent_id}/run", response_model=AgentRunResponse)
-async def run_agent(agent_id: int, request: AgentRunRequest, db: db_dependency, tenant_id: api_key_dependency):
-    if not check_tenant_limit(tenant_id):
-        raise HTTPException(status_code=429, detail="Rate limit exceeded")
+async def run_agent(agent_id: int,
+                    request: AgentRunRequest,
+                    response: Response,
+                    db: db_dependency,
+                    tenant_id: api_key_dependency,
+                    run_async: bool = Query(False, alias="async")):
+    """Runs the agent and returns the execution.
+
+    With `async=true` the execution is queued for the worker pool and returned right away with
+    status 202 and `status="queued"`; poll `GET /executions/{execution_id}` for the result. A tenant with
+    `max_queue` jobs already queued gets 429 instead."""
+    agent, template, prompt = await prepare_run(agent_id, request, response, db, tenant_id)
+    db_execution = new_execution(tenant_id, agent_id, template, request.task, request.model)
+    if run_async:
+        db_execution.status = EXECUTION_QUEUED
+    else:
+        # Committing stores a first-use prompt template and gives the connection back to the pool while
+        # waiting for a run slot and for the model; the write-behind buffer also needs its own connections
+        # to allocate ids and flush.
+        await db.commit()
+        db_execution.response, db_execution.cached = await cached_call_llm(
+            tenant_id, agent_id, prompt, request.model, request.use_cache
+        )
+        if execution_write_behind.active:
+            return run_response(await execution_write_behind.add(db_execution), agent.name)
+    db.add(db_execution)
+    await db.flush()
+    await record_executions(db, [db_execution])
+    await index_executions(db, [db_execution])
+    await db.commit()
+    await bump_versions(tenant_id, "executions")
+    if run_async:
+        try:
+            await enqueue_execution(db_execution.id, tenant_id, request.use_cache)
+        except HTTPException:
+            # The tenant's queue is full, so the run never happens; drop its execution too.
+            await db.delete(db_execution)
+            await db.commit()
+            await bump_versions(tenant_id, "executions", f"execution:{db_execution.id}")
+            raise
+        response.status_code = 202
+
+    return run_response(db_execution, agent.name)
+
+
+@router.post("/{agent_id}/run/stream", response_class=StreamingResponse)
+async def run_agent_stream(agent_id: int,
+                           request: AgentRunRequest,
+                           response: Response,
+                           db: db_dependency,
+                           tenant_id: api_key_dependency):
+    """Runs the agent and streams the model output as server-sent events.
+
+    Events: `execution` (the running execution, sent first), then `chunk` events with `{"text": ...}`,
+    then `done` with the final execution, or `error` with `{"detail": ...}`. The model call runs to
+    completion and the execution is saved even if the client disconnects mid-stream."""
+    agent, template, prompt = await prepare_run(agent_id, request, response, db, tenant_id)
+    # As in run_agent, committing stores a first-use template and frees the connection while waiting for a slot.
+    await db.commit()
+    slot = await concurrency_limiter.acquire(tenant_id)
+    try:
+        db_execution = new_execution(tenant_id, agent_id, template, request.task, request.model,
+                                     status=EXECUTION_RUNNING)
+        db.add(db_execution)
+        await db.commit()
+        await bump_versions(tenant_id, "executions")
+    except BaseException:
+        await concurrency_limiter.release(tenant_id, slot)
+        raise
 
-    agent = db.query(Agent) \
-        .options(joinedload(Agent.tools)) \
-        .filter(Agent.id == agent_id, Agent.tenant_id == tenant_id).first()
+    chunks = asyncio.Queue()
+    task = asyncio.create_task(
+        stream_execution(db_execution.id, tenant_id, prompt, request.model, request.use_cache, chunks, slot)
+    )
+    _background_runs.add(task)
+    task.add_done_callback(_background_runs.discard)
+
+    async def events():
+        yield sse_event("execution", run_response(db_execution, agent.name).model_dump(mode="json"))
+        while (chunk := await chunks.get()) is not None:
+            yield sse_event("chunk", {"text": chunk})
+        try:
+            execution = await task
+        except Exception:
+            yield sse_event("error", {"detail": "Failed to save the execution"})
+            return
+        if execution.status == EXECUTION_SUCCEEDED:
+            yield sse_event("done", run_response(execution, agent.name).model_dump(mode="json"))
+        else:
+            yield sse_event("error", {"detail": execution.error})
+
+    return StreamingResponse(
+        events(),
+        media_type="text/event-stream",
+        headers={**response.headers, "Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+
+@router.post("/run:batch", response_model=AgentBatchRunResponse)
+async def run_agents_batch(request: AgentBatchRunRequest,
+                           response: Response,
+                           db: db_dependency,
+                           tenant_id: api_key_dependency):
+    """Runs many (agent_id, task, model) items in one call.
+
+    Agents come from the definition cache with misses loaded in one query, rate-limit tokens are reserved in
+    one step for the items that passed those checks, model calls run concurrently and executions are inserted
+    in one transaction. Results keep the request order; an item that cannot run gets its own status_code and
+    detail (404, 400, 429, 502 or 503) without failing the others, and its token is given back."""
+    agents = await get_agent_definitions(db, tenant_id, list({item.agent_id for item in request.items}))
+
+    results = [None] * len(request.items)
+    runnable = []
+    for index, item in enumerate(request.items):
+        if item.agent_id not in agents:
+            results[index] = AgentBatchRunResult(status_code=404, detail="Agent not found")
+        elif item.model not in SUPPORTED_MODELS:
+            results[index] = AgentBatchRunResult(status_code=400, detail="Request model not supported")
+        else:
+            runnable.append(index)
+
+    reservation = None
+    if runnable:
+        reservation = await reserve_tenant_limit(tenant_id, len(runnable))
+        response.headers.update(rate_limit_headers(reservation.result))
+        for index in runnable[reservation.granted:]:
+            results[index] = AgentBatchRunResult(status_code=429, detail="Rate limit exceeded")
+        runnable = runnable[:reservation.granted]
+
+    templates = {}
+    for agent_id in {request.items[index].agent_id for index in runnable}:
+        templates[agent_id] = await get_prompt_template(db, get_compiled_prompt(tenant_id, agents[agent_id]))
+    prompts = [templates[request.items[index].agent_id].render(request.items[index].task) for index in runnable]
+    llm_responses = []
+    if runnable:
+        # Each model call is a run of its own against the tenant's max_concurrency (items with the same agent,
+        # prompt and model share one); an item whose slot is refused (429) or not freed in time (503) gets that
+        # status, and one whose model call fails gets 502.
+        async def call(index, prompt):
+            try:
+                return await cached_call_llm(tenant_id, request.items[index].agent_id, prompt,
+                                             request.items[index].model, request.items[index].use_cache)
+            except HTTPException as exc:
+                results[index] = AgentBatchRunResult(status_code=exc.status_code, detail=exc.detail)
+            except Exception:
+                logger.exception("Batch model call failed for agent %s", request.items[index].agent_id)
+                results[index] = AgentBatchRunResult(status_code=502, detail="Model call failed")
+
+        await db.commit()
+        llm_responses = await asyncio.gather(*(call(index, prompt) for index, prompt in zip(runnable, prompts)))
+    ran = [(index, llm_response) for index, llm_response in zip(runnable, llm_responses) if llm_response is not None]
+    if reservation and len(ran) < len(runnable):
+        # Items refused a slot or failed by the model did not run, so their tokens go back to the window.
+        await release_tenant_limit(tenant_id, reservation.members[len(ran):])
+        response.headers["X-RateLimit-Remaining"] = str(reservation.result.remaining + len(runnable) - len(ran))
+    timestamp = datetime.utcnow()
+    executions = [
+        new_execution(tenant_id, request.items[index].agent_id, templates[request.items[index].agent_id],
+                      request.items[index].task, request.items[index].model,
+                      response=llm_response, cached=cached, timestamp=timestamp)
+        for index, (llm_response, cached) in ran
+    ]
+    if execution_write_behind.active:
+        await db.close()
+        await execution_write_behind.add_all(executions)
+    else:
+        db.add_all(executions)
+        await db.flush()
+        await record_executions(db, executions)
+        await index_executions(db, executions)
+        await db.commit()
+        if executions:
+            await bump_versions(tenant_id, "executions")
+
+    for (index, _), execution in zip(ran, executions):
+        results[index] = AgentBatchRunResult(
+            status_code=200,
+            execution=run_response(execution, agents[execution.agent_id].name)
+        )
+    return AgentBatchRunResponse(results=results)
+
+
+async def agents_with_executions(db, tenant_id: str, agent_ids) -> set:
+    """Those of `agent_ids` with executions: stored, archived, or still in this worker's write-behind buffer."""
+    agent_ids = set(agent_ids)
+    if not agent_ids:
+        return set()
+    found = set((await db.scalars(
+        select(Execution.agent_id).filter(Execution.agent_id.in_(agent_ids)).distinct()
+    )).all())
+    found |= await archived_agent_ids(db, tenant_id, agent_ids - found)
+    return found | (execution_write_behind.pending_agent_ids() & agent_ids)
+
+
+async def prepare_run(agent_id: int, request: AgentRunRequest, response: Response, db, tenant_id: str):
+    limit = await check_tenant_limit(tenant_id)
+    if not limit.allowed:
+        raise HTTPException(status_code=429, detail="Rate limit exceeded", headers=rate_limit_headers(limit))
+    response.headers.update(rate_limit_headers(limit))
+
+    agent = await get_agent_definition(db, tenant_id, agent_id)
     if not agent:
         raise HTTPException(status_code=404, detail="Agent not found")
-    prompt = generate_prompt(agent, request.task)
     if request.model not in SUPPORTED_MODELS:
         raise HTTPException(status_code=400, detail="Request model not supported")
-    mock_response = mock_llm_call(prompt, request.model)
-    db_execution = Execution(
+    template = await get_prompt_template(db, get_compiled_prompt(tenant_id, agent))
+    return agent, template, template.render(request.task)
+
+
+def new_execution(tenant_id: str, agent_id: int, template: PromptTemplate, task: str, model: str, **values):
+    # prompt_template_id is set next to the relationship, as write-behind inserts the columns of executions
+    # that never reach a session.
+    return Execution(
         tenant_id=tenant_id,
         agent_id=agent_id,
-        prompt=prompt,
-        model=request.model,
-        response=mock_response,
-        timestamp=datetime.utcnow()
+        prompt_template=template,
+        prompt_template_id=template.id,
+        task=task,
+        model=model,
+        **{"timestamp": datetime.utcnow(), **values}
     )
-    db.add(db_execution)
-    db.commit()
-    db.refresh(db_execution)
 
+
+async def stream_execution(execution_id: int,
+                           tenant_id: str,
+                           prompt: str,
+                           model: str,
+                           use_cache: bool,
+                           chunks: asyncio.Queue,
+                           slot: Optional[str] = None):
+    """Drives the model stream into `chunks` (None marks the end) and saves the outcome.
+
+    Runs as its own task with its own session, so neither a disconnect nor the request's session
+    closing stops the execution from being recorded. A response cache hit is sent as a single chunk.
+    Releases the tenant's run `slot` when done."""
+    parts = []
+    status, error, cached = EXECUTION_SUCCEEDED, None, False
+    use_cache = use_cache and response_cache.ttl(tenant_id)
+    try:
+        if use_cache and (hit := await response_cache.get(tenant_id, prompt, model)) is not None:
+            parts.append(hit)
+            chunks.put_nowait(hit)
+            cached = True
+        else:
+            async for chunk in stream_llm(prompt, model):
+                parts.append(chunk)
+                chunks.put_nowait(chunk)
+            if use_cache:
+                await response_cache.set(tenant_id, prompt, model, "".join(parts))
+    except Exception as exc:
+        status, error = EXECUTION_FAILED, str(exc)
+    finally:
+        try:
+            async with SessionLocal() as db:
+                execution = await db.get(Execution, execution_id)
+                execution.response = "".join(parts)
+                execution.status = status
+                execution.error = error
+                execution.cached = cached
+                await record_executions(db, [execution])
+                await index_executions(db, [execution])
+                await db.commit()
+            await bump_versions(tenant_id, "executions", f"execution:{execution_id}")
+        except Exception:
+            logger.exception("Failed to save streamed execution %s", execution_id)
+            raise
+        finally:
+            # Whatever happened to the save, free the slot and end the event stream.
+            await concurrency_limiter.release(tenant_id, slot)
+            chunks.put_nowait(None)
+    return execution
+
+
+def sse_event(event: str, data: dict):
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+
+def run_response(execution: Execution, agent_name: str):
     return AgentRunResponse(
-        execution_id=db_execution.id,
-        agent_id=db_execution.agent_id,
-        agent_name=agent.name,
-        prompt=db_execution.prompt,
-        model=db_execution.model,
-        response=db_execution.response,
-        timestamp=db_execution.timestamp
+        execution_id=execution.id,
+        agent_id=execution.agent_id,
+        agent_name=agent_name,
+        prompt=execution.prompt,
+        model=execution.model,
+        response=execution.response,
+        timestamp=execution.timestamp,
+        status=execution.status,
+        cached=execution.cached
     )
@@ -1,35 +1,268 @@
-from typing import List, Optional
+import csv
+import io
+import json
+from datetime import datetime
+from typing import List, Optional, Literal
 
-from fastapi import APIRouter, HTTPException
+from fastapi import APIRouter, HTTPException, Query, Response, Request
+from fastapi.responses import StreamingResponse
+from sqlalchemy import Row, func, select, tuple_
 
-from base_model import ExecutionResponse
-from models import Execution
-from utils import db_dependency, api_key_dependency
+from archive import find_segments, merge_segments, find_archived_execution, iter_archived, SEGMENT_BATCH
+from base_model import ExecutionResponse, ExecutionSearchResult, ExecutionStatsBucket
+from database import SessionLocal
+from etag import conditional_get
+from models import Execution, ExecutionRollup, EXECUTION_FINISHED
+from rollups import COUNTERS, GRANULARITIES, bucket_start
+from search import search_executions
+from serialization import execution_prompt, execution_response, json_list_response, load_prompt_templates
+from utils import db_dependency, api_key_dependency, encode_cursor, decode_cursor, encode_rank_cursor, \
+    decode_rank_cursor, DEFAULT_PAGE_SIZE, MAX_PAGE_SIZE
+from worker import execution_done_listener
 
-router = APIRouter()
+router = APIRouter(prefix="/executions", tags=["executions"])
+
+EXPORT_COLUMNS = ["id", "agent_id", "prompt", "model", "response", "status", "error", "cached", "timestamp"]
+MAX_WAIT_SECONDS = 30
+EXPORT_BATCH_SIZE = 1000
+# Everything ExecutionResponse is built from, see execution_item.
+EXECUTION_COLUMNS = [Execution.id, Execution.agent_id, Execution.stored_prompt, Execution.prompt_template_id,
+                     Execution.task, Execution.model, Execution.stored_response, Execution.response_zstd,
+                     Execution.timestamp, Execution.status, Execution.cached, Execution.error]
+STATS_DEFAULT_BUCKETS = 60
+STATS_MAX_BUCKETS = 1440
+EXPORT_MEDIA_TYPES = {"ndjson": "application/x-ndjson", "csv": "text/csv"}
 
 
 @router.get("", response_model=List[ExecutionResponse])
 async def get_executions(db: db_dependency,
                          tenant_id: api_key_dependency,
+                         request: Request,
+                         response: Response,
                          agent_id: Optional[int] = None,
-                         page: Optional[int] = None,
+                         cursor: Optional[str] = None,
+                         page: Optional[int] = Query(None, deprecated=True),
                          page_size: Optional[int] = None
                          ):
-    query = db.query(Execution).filter(Execution.tenant_id == tenant_id)
+    """Executions newest first, one page at a time.
+
+    Pages are keyset based: pass the `X-Next-Cursor` header of a response as `cursor` to get the next page.
+    `page` selects an OFFSET page instead and is kept only for existing clients.
+    Archived executions are merged in from their segments."""
+    if not_modified := await conditional_get(request, response, tenant_id, "executions"):
+        return not_modified
+    if page_size is None:
+        page_size = DEFAULT_PAGE_SIZE
+    if page_size < 1 or page_size > MAX_PAGE_SIZE:
+        raise HTTPException(status_code=400, detail=f"page_size must be between 1 and {MAX_PAGE_SIZE}")
+
+    query = select(*EXECUTION_COLUMNS).filter(Execution.tenant_id == tenant_id)
     if agent_id:
         query = query.filter(Execution.agent_id == agent_id)
-    if page is not None and page_size is not None:
-        if page < 1 or page_size < 1:
+    query = query.order_by(Execution.timestamp.desc(), Execution.id.desc())
+
+    offset, before = 0, None
+    if page is not None:
+        if cursor is not None:
+            raise HTTPException(status_code=400, detail="page and cursor cannot be combined")
+        if page < 1:
             raise HTTPException(status_code=400, detail="page and page_size must be positive integers")
         offset = (page - 1) * page_size
-        query = query.offset(offset).limit(page_size)
-    elif page is not None or page_size is not None:
-        raise HTTPException(
-            status_code=400,
-            detail="Both page and page_size must be provided together"
-        )
-    executions = query.all()
+    elif cursor is not None:
+        before = decode_cursor(cursor)
+        query = query.filter(tuple_(Execution.timestamp, Execution.id) < tuple_(*before))
+
+    # One extra row tells whether another page exists without a COUNT query.
+    segments = await find_segments(db, tenant_id, before=before, limit=SEGMENT_BATCH)
+    if segments:
+        # The page may span hot and archived rows, so OFFSET is applied after merging.
+        executions = (await db.execute(query.limit(offset + page_size + 1))).all()
+        executions = (await merge_segments(db, tenant_id, executions, segments, offset + page_size + 1,
+                                           agent_id, before))[offset:]
+    else:
+        executions = (await db.execute(query.offset(offset).limit(page_size + 1))).all()
     if not executions:
         raise HTTPException(status_code=404, detail="Executions not found")
-    return executions
+    if len(executions) > page_size:
+        executions = executions[:page_size]
+        last = executions[-1]
+        response.headers["X-Next-Cursor"] = encode_cursor(last.timestamp, last.id)
+    templates = await load_prompt_templates(
+        db, {execution.prompt_template_id for execution in executions if isinstance(execution, Row)}
+    )
+    return json_list_response([execution_item(execution, templates) for execution in executions], response)
+
+
+def execution_item(execution, templates):
+    """An ExecutionResponse as a dict, from a row of EXECUTION_COLUMNS or an archived ExecutionResponse."""
+    if not isinstance(execution, Row):
+        return dict(execution)
+    return {
+        "id": execution.id,
+        "agent_id": execution.agent_id,
+        "prompt": execution_prompt(execution, templates),
+        "model": execution.model,
+        "response": execution_response(execution),
+        "timestamp": execution.timestamp,
+        "status": execution.status,
+        "cached": execution.cached,
+        "error": execution.error,
+    }
+
+
+def format_export_rows(executions, export_format, writer=None, buffer=None):
+    rows = (
+        (*(getattr(execution, column) for column in EXPORT_COLUMNS[:-1]), execution.timestamp.isoformat())
+        for execution in executions
+    )
+    if export_format == "csv":
+        buffer.seek(0)
+        buffer.truncate()
+        writer.writerows(rows)
+        return buffer.getvalue()
+    return "".join(json.dumps(dict(zip(EXPORT_COLUMNS, row))) + "\n" for row in rows)
+
+
+async def stream_executions(query, export_format, tenant_id, agent_id=None, since=None, until=None):
+    # The export outlives the request's dependencies, so it holds its own session. stream() with
+    # yield_per uses a server-side cursor: only one batch of rows is in memory at a time.
+    async with SessionLocal() as db:
+        buffer = writer = None
+        if export_format == "csv":
+            buffer = io.StringIO()
+            writer = csv.writer(buffer)
+            writer.writerow(EXPORT_COLUMNS)
+            yield buffer.getvalue()
+        # Archived rows are older than the retention horizon, so they come first.
+        async for executions in iter_archived(db, tenant_id, agent_id, since, until):
+            if executions:
+                yield format_export_rows(executions, export_format, writer, buffer)
+        result = await db.stream_scalars(query.execution_options(yield_per=EXPORT_BATCH_SIZE))
+        async for executions in result.partitions():
+            yield format_export_rows(executions, export_format, writer, buffer)
+
+
+@router.get("/export")
+async def export_executions(tenant_id: api_key_dependency,
+                            export_format: Literal["ndjson", "csv"] = Query("ndjson", alias="format"),
+                            agent_id: Optional[int] = None,
+                            since: Optional[datetime] = None,
+                            until: Optional[datetime] = None):
+    """Streams every matching execution, oldest first, as NDJSON or CSV.
+
+    `since` is inclusive and `until` exclusive."""
+    query = select(Execution).filter(Execution.tenant_id == tenant_id)
+    if agent_id:
+        query = query.filter(Execution.agent_id == agent_id)
+    if since:
+        query = query.filter(Execution.timestamp >= since)
+    if until:
+        query = query.filter(Execution.timestamp < until)
+    query = query.order_by(Execution.timestamp, Execution.id)
+
+    return StreamingResponse(
+        stream_executions(query, export_format, tenant_id, agent_id, since, until),
+        media_type=EXPORT_MEDIA_TYPES[export_format],
+        headers={"Content-Disposition": f"attachment; filename=executions.{export_format}"}
+    )
+
+
+@router.get("/search", response_model=List[ExecutionSearchResult])
+async def get_execution_search(db: db_dependency,
+                               tenant_id: api_key_dependency,
+                               request: Request,
+                               response: Response,
+                               q: str = Query(min_length=1),
+                               cursor: Optional[str] = None,
+                               page_size: int = Query(DEFAULT_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE)):
+    """Finished executions whose task, response or error match `q`, best match first.
+
+    Pass the `X-Next-Cursor` header of a response as `cursor` to get the next page. See search.py for the
+    query syntax and what is ranked."""
+    if not_modified := await conditional_get(request, response, tenant_id, "executions"):
+        return not_modified
+    hits = await search_executions(db, tenant_id, q, page_size + 1,
+                                   decode_rank_cursor(cursor) if cursor is not None else None)
+    if not hits:
+        raise HTTPException(status_code=404, detail="No executions match")
+    if len(hits) > page_size:
+        hits = hits[:page_size]
+        response.headers["X-Next-Cursor"] = encode_rank_cursor(hits[-1][1], hits[-1][0])
+    rows = (await db.execute(select(*EXECUTION_COLUMNS).filter(Execution.tenant_id == tenant_id,
+                                                               Execution.id.in_([hit[0] for hit in hits])))).all()
+    rows = {row.id: row for row in rows}
+    templates = await load_prompt_templates(db, {row.prompt_template_id for row in rows.values()})
+    return json_list_response([{**execution_item(rows[execution_id], templates), "rank": rank}
+                               for execution_id, rank in hits if execution_id in rows], response)
+
+
+@router.get("/stats", response_model=List[ExecutionStatsBucket])
+async def get_execution_stats(db: db_dependency,
+                              tenant_id: api_key_dependency,
+                              request: Request,
+                              response: Response,
+                              granularity: Literal["minute", "hour", "day"] = "hour",
+                              since: Optional[datetime] = None,
+                              until: Optional[datetime] = None,
+                              agent_id: Optional[int] = None,
+                              model: Optional[str] = None,
+                              group_by: List[Literal["agent_id", "model"]] = Query([])):
+    """Run counts and token volumes of finished executions per time bucket, oldest first.
+
+    Read from the rollups (see rollups.py), so the cost follows the number of buckets, not of executions.
+    `until` defaults to now and `since` to STATS_DEFAULT_BUCKETS buckets before it; buckets starting in
+    [since, until) are returned, the bucket holding `since` included. Empty buckets are left out."""
+    step = GRANULARITIES[granularity]
+    until = until or datetime.utcnow()
+    since = bucket_start(since or until - step * STATS_DEFAULT_BUCKETS, granularity)
+    if until <= since or (until - since) / step > STATS_MAX_BUCKETS:
+        raise HTTPException(status_code=400,
+                            detail=f"since must be before until and at most {STATS_MAX_BUCKETS} buckets apart")
+    # The default window moves with the clock, so its bucket bounds are part of the tag.
+    window = f"{since.isoformat()}/{bucket_start(until, granularity).isoformat()}"
+    if not_modified := await conditional_get(request, response, tenant_id, "executions", variant=window):
+        return not_modified
+
+    groups = [ExecutionRollup.bucket, *(getattr(ExecutionRollup, column) for column in group_by)]
+    query = (select(*groups, *(func.sum(getattr(ExecutionRollup, counter)).label(counter) for counter in COUNTERS))
+             .filter(ExecutionRollup.tenant_id == tenant_id,
+                     ExecutionRollup.granularity == granularity,
+                     ExecutionRollup.bucket >= since,
+                     ExecutionRollup.bucket < until))
+    if agent_id:
+        query = query.filter(ExecutionRollup.agent_id == agent_id)
+    if model:
+        query = query.filter(ExecutionRollup.model == model)
+    rows = await db.execute(query.group_by(*groups).order_by(*groups))
+    return [row._asdict() for row in rows]
+
+
+@router.get("/{execution_id}", response_model=ExecutionResponse)
+async def get_execution_by_id(execution_id: int,
+                              db: db_dependency,
+                              tenant_id: api_key_dependency,
+                              request: Request,
+                              response: Response,
+                              wait: float = Query(0, ge=0, le=MAX_WAIT_SECONDS)):
+    """Returns one execution. With `wait`, long-polls up to that many seconds for a queued run to finish."""
+    query = select(Execution).filter(Execution.tenant_id == tenant_id, Execution.id == execution_id)
+
+    async def exists():
+        return (await db.scalar(query.with_only_columns(Execution.id))
+                or await find_archived_execution(db, tenant_id, execution_id))
+
+    if not wait and (not_modified := await conditional_get(request, response, tenant_id,
+                                                           f"execution:{execution_id}", exists=exists)):
+        return not_modified
+    execution = await db.scalar(query)
+    if not execution:
+        if archived := await find_archived_execution(db, tenant_id, execution_id):
+            return archived
+        raise HTTPException(status_code=404, detail="Execution not found")
+    if wait and execution.status not in EXECUTION_FINISHED:
+        async with execution_done_listener(execution_id) as wait_done:
+            await db.refresh(execution)
+            if execution.status not in EXECUTION_FINISHED:
+                await wait_done(wait)
+        await db.refresh(execution)
+    return execution
@@ -1,33 +1,144 @@
 from typing import Optional, List
 
-from fastapi import APIRouter, HTTPException
+from fastapi import APIRouter, HTTPException, Query, Request, Response
+from sqlalchemy import select, insert, delete
 
-from base_model import ToolBase, ToolUpdate, ToolResponse
+from base_model import ToolBase, ToolUpdate, ToolResponse, ToolBulkCreateRequest, ToolBulkUpdateRequest, \
+    ToolBulkResult, ToolBulkResponse, BulkDeleteRequest, BulkDeleteResult, BulkDeleteResponse
+from cache import definition_cache, get_tool_definition, invalidate_tools
+from etag import bump_versions, conditional_get
 from models import Tool, agent_tools, Agent
-from utils import db_dependency, api_key_dependency
+from serialization import json_list_response, model_columns, model_fields
+from utils import db_dependency, api_key_dependency, check_bulk_errors, decode_id_cursor, encode_id_cursor, \
+    name_filter, NameMatch, MAX_PAGE_SIZE
 
-router = APIRouter()
+router = APIRouter(prefix="/tools", tags=["tools"])
+
+TOOL_FIELDS = model_fields(ToolResponse)
 
 
 @router.get("", response_model=List[ToolResponse])
 async def get_tools(db: db_dependency,
                     tenant_id: api_key_dependency,
+                    request: Request,
+                    response: Response,
                     agent_name: Optional[str] = None,
-                    name: Optional[str] = None):
-    query = db.query(Tool).filter(Tool.tenant_id == tenant_id)
+                    name: Optional[str] = None,
+                    match: NameMatch = "exact",
+                    cursor: Optional[str] = None,
+                    page_size: Optional[int] = Query(None, ge=1, le=MAX_PAGE_SIZE)):
+    """Tools in id order, optionally only those named `name` or used by an agent named `agent_name`.
+
+    `match=prefix` turns both filters into case-insensitive prefix matches. With `page_size` the list comes
+    one page at a time: pass the `X-Next-Cursor` header of a response as `cursor` to get the next page."""
+    if not_modified := await conditional_get(request, response, tenant_id, "tools"):
+        return not_modified
+    query = select(*model_columns(Tool, TOOL_FIELDS)).filter(Tool.tenant_id == tenant_id)
     if agent_name:
-        query = query.join(agent_tools).join(Agent).filter(Agent.name == agent_name)
+        # A semi-join rather than a join, so a tool used by several matching agents is listed once.
+        query = query.filter(Tool.id.in_(
+            select(agent_tools.c.tool_id)
+            .join(Agent, Agent.id == agent_tools.c.agent_id)
+            .filter(Agent.tenant_id == tenant_id, name_filter(Agent.name, agent_name, match))
+        ))
     if name:
-        query = query.filter(Tool.name == name)
-    tools = query.all()
+        query = query.filter(name_filter(Tool.name, name, match))
+    if cursor is not None:
+        query = query.filter(Tool.id > decode_id_cursor(cursor))
+    query = query.order_by(Tool.id)
+    if page_size is not None:
+        query = query.limit(page_size + 1)
+    tools = (await db.execute(query)).all()
     if not tools:
         raise HTTPException(status_code=404, detail="Tools not found")
-    return tools
+    if page_size is not None and len(tools) > page_size:
+        tools = tools[:page_size]
+        response.headers["X-Next-Cursor"] = encode_id_cursor(tools[-1].id)
+    return json_list_response([dict(zip(TOOL_FIELDS, tool)) for tool in tools], response)
+
+
+# Bulk routes are declared before the /{tool_id} routes, which would otherwise match "bulk".
+@router.post("/bulk", response_model=ToolBulkResponse)
+async def create_tools_bulk(request: ToolBulkCreateRequest, db: db_dependency, tenant_id: api_key_dependency):
+    """Creates all tools with one multi-row INSERT ... RETURNING in one transaction."""
+    created = (await db.scalars(
+        insert(Tool).returning(Tool, sort_by_parameter_order=True),
+        [{"tenant_id": tenant_id, **item.model_dump()} for item in request.items]
+    )).all()
+    await db.commit()
+    await bump_versions(tenant_id, "tools")
+    return ToolBulkResponse(results=[ToolBulkResult(status_code=200, tool=tool) for tool in created])
+
+
+@router.put("/bulk", response_model=ToolBulkResponse)
+async def update_tools_bulk(request: ToolBulkUpdateRequest, db: db_dependency, tenant_id: api_key_dependency):
+    ids = {item.id for item in request.items}
+    tools = (await db.scalars(select(Tool).filter(Tool.tenant_id == tenant_id, Tool.id.in_(ids)))).all()
+    tools = {tool.id: tool for tool in tools}
+    errors = {index: (404, "Tool not found") for index, item in enumerate(request.items) if item.id not in tools}
+    check_bulk_errors(request.mode, errors)
+
+    updated = set()
+    for index, item in enumerate(request.items):
+        if index in errors:
+            continue
+        tool = tools[item.id]
+        if item.name:
+            tool.name = item.name
+        if item.description:
+            tool.description = item.description
+        updated.add(item.id)
+    await db.commit()
+
+    agent_ids = await invalidate_tools(db, tenant_id, updated)
+    await bump_versions(tenant_id, "tools", "agents", *(f"tool:{tool_id}" for tool_id in updated),
+                        *(f"agent:{agent_id}" for agent_id in agent_ids))
+    return ToolBulkResponse(results=[
+        ToolBulkResult(status_code=errors[index][0], detail=errors[index][1]) if index in errors
+        else ToolBulkResult(status_code=200, tool=tools[item.id])
+        for index, item in enumerate(request.items)
+    ])
+
+
+@router.delete("/bulk", response_model=BulkDeleteResponse)
+async def delete_tools_bulk(request: BulkDeleteRequest, db: db_dependency, tenant_id: api_key_dependency):
+    existing = set((await db.scalars(
+        select(Tool.id).filter(Tool.tenant_id == tenant_id, Tool.id.in_(request.ids))
+    )).all())
+    in_use = set((await db.scalars(
+        select(agent_tools.c.tool_id).filter(agent_tools.c.tool_id.in_(existing))
+    )).all())
+    errors = {}
+    for index, tool_id in enumerate(request.ids):
+        if tool_id not in existing:
+            errors[index] = (404, "Tool not found")
+        elif tool_id in in_use:
+            errors[index] = (400, "Cannot delete tool, it is used by agent.")
+    check_bulk_errors(request.mode, errors)
+
+    deleted = existing - in_use
+    if deleted:
+        await db.execute(delete(Tool).filter(Tool.tenant_id == tenant_id, Tool.id.in_(deleted)))
+        await db.commit()
+        await definition_cache.invalidate(tenant_id, tool_ids=deleted)
+        await bump_versions(tenant_id, "tools", *(f"tool:{tool_id}" for tool_id in deleted))
+    return BulkDeleteResponse(results=[
+        BulkDeleteResult(id=tool_id, status_code=errors[index][0], detail=errors[index][1]) if index in errors
+        else BulkDeleteResult(id=tool_id, status_code=200)
+        for index, tool_id in enumerate(request.ids)
+    ])
 
 
 @router.get("/{tool_id}", response_model=ToolResponse)
-async def get_tool_by_id(tool_id: int, db: db_dependency, tenant_id: api_key_dependency):
-    tool = db.query(Tool).filter(Tool.tenant_id == tenant_id, Tool.id == tool_id).first()
+async def get_tool_by_id(tool_id: int,
+                         db: db_dependency,
+                         tenant_id: api_key_dependency,
+                         request: Request,
+                         response: Response):
+    if not_modified := await conditional_get(request, response, tenant_id, f"tool:{tool_id}",
+                                             exists=lambda: get_tool_definition(db, tenant_id, tool_id)):
+        return not_modified
+    tool = await get_tool_definition(db, tenant_id, tool_id)
     if not tool:
         raise HTTPException(status_code=404, detail="Tool not found")
     return tool
@@ -35,28 +146,35 @@ async def get_tool_by_id(tool_id: int, db: db_dependency, tenant_id: api_key_dep
 
 @router.delete("/{tool_id}")
 async def delete_tool_by_id(tool_id: int, db: db_dependency, tenant_id: api_key_dependency):
-    tool = db.query(Tool).filter(Tool.tenant_id == tenant_id, Tool.id == tool_id).first()
+    tool = await db.scalar(select(Tool).filter(Tool.tenant_id == tenant_id, Tool.id == tool_id))
     if not tool:
         raise HTTPException(status_code=404, detail="Tool not found")
-    agents_using_tool = db.query(Agent).join(agent_tools).filter(agent_tools.c.tool_id == tool.id).all()
+    agents_using_tool = (await db.scalars(
+        select(Agent).join(agent_tools).filter(agent_tools.c.tool_id == tool.id)
+    )).all()
     if agents_using_tool:
         raise HTTPException(status_code=400, detail="Cannot delete tool, it is used by agent.")
-    db.delete(tool)
-    db.commit()
+    await db.delete(tool)
+    await db.commit()
+    await definition_cache.invalidate(tenant_id, tool_ids=[tool_id])
+    await bump_versions(tenant_id, "tools", f"tool:{tool_id}")
     return {"detail": f"Deleted tool {tool_id}"}
 
 
 @router.put("/{tool_id}", response_model=ToolResponse)
 async def update_tool_by_id(tool_id: int, tool_update: ToolUpdate, db: db_dependency, tenant_id: api_key_dependency):
-    tool = db.query(Tool).filter(Tool.tenant_id == tenant_id, Tool.id == tool_id).first()
+    tool = await db.scalar(select(Tool).filter(Tool.tenant_id == tenant_id, Tool.id == tool_id))
     if not tool:
         raise HTTPException(status_code=404, detail="Tool not found")
     if tool_update.name:
         tool.name = tool_update.name
     if tool_update.description:
         tool.description = tool_update.description
-    db.commit()
-    db.refresh(tool)
+    await db.commit()
+    agent_ids = await invalidate_tools(db, tenant_id, [tool_id])
+    await bump_versions(tenant_id, "tools", "agents", f"tool:{tool_id}",
+                        *(f"agent:{agent_id}" for agent_id in agent_ids))
+    await db.refresh(tool)
     return tool
 
 
@@ -68,6 +186,7 @@ async def create_tool(tool: ToolBase, db: db_dependency, tenant_id: api_key_depe
         tenant_id=tenant_id
     )
     db.add(db_tool)
-    db.commit()
-    db.refresh(db_tool)
+    await db.commit()
+    await bump_versions(tenant_id, "tools")
+    await db.refresh(db_tool)
     return db_tool
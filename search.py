@@ -0,0 +1,175 @@
+"""Full-text search over executions, ranked and scoped to a tenant.
+
+Each finished execution gets one index row in the transaction that finishes it, with the task (or the
+full prompt of executions stored before prompt templates), the response and the error. The prompt template
+around the task is the agent definition, the same for every run of an agent, so it is not indexed.
+
+On PostgreSQL the row is a tsvector in a GIN index on (tenant_id, document), so a query reads only its
+tenant's postings; it is queried with `websearch_to_tsquery` (quoted phrases, `or`, `-word`) and ranked with
+`ts_rank_cd`. On SQLite it is an FTS5 row, queried for all the words of `q` and ranked by bm25. Ranking needs
+every match, so a query stops reading the index after SEARCH_MAX_CANDIDATES of them and, when there are
+more, fails with TooManyMatches instead of ranking some of them. Archived executions leave the index.
+
+Pages continue after the (rank, id) of the last row of the previous page. PostgreSQL ranks from the
+document alone, so the order is stable. SQLite's bm25 depends on statistics of the whole table, so
+executions indexed or archived between two pages shift every rank, and the next page can skip or repeat
+matches there.
+
+Usage (index executions recorded before search existed, or all of them again after changing
+EXECUTION_SEARCH_CONFIG):
+    python -m search [--tenant tenant_b] [--batch-size 1000]
+"""
+import argparse
+import asyncio
+import logging
+import os
+import re
+from typing import List, Optional, Tuple
+
+from fastapi import HTTPException
+from sqlalchemy import select, text, bindparam
+
+from database import SessionLocal, engine, init_models
+from models import Execution, EXECUTION_FINISHED
+
+logger = logging.getLogger(__name__)
+
+# PostgreSQL text search configuration used to build and query the index.
+SEARCH_CONFIG = os.getenv("EXECUTION_SEARCH_CONFIG", "english")
+SEARCH_MAX_CANDIDATES = int(os.getenv("EXECUTION_SEARCH_MAX_CANDIDATES", "10000"))
+
+INDEX_SQL = {
+    "postgresql": text(
+        "INSERT INTO execution_search (execution_id, tenant_id, document) "
+        "VALUES (:execution_id, :tenant_id, to_tsvector(CAST(:config AS regconfig), :document)) "
+        "ON CONFLICT (execution_id) DO UPDATE SET document = excluded.document"
+    ),
+    "sqlite": text(
+        "INSERT OR REPLACE INTO execution_search (rowid, tenant_id, document) "
+        "VALUES (:execution_id, :tenant_id, :document)"
+    ),
+}
+REMOVE_SQL = {
+    "postgresql": text("DELETE FROM execution_search WHERE execution_id IN :ids"),
+    "sqlite": text("DELETE FROM execution_search WHERE rowid IN :ids"),
+}
+# Up to one more than SEARCH_MAX_CANDIDATES matches of the tenant (:candidates) with their rank, then a page of
+# them, best first; {after} cuts at the cursor on later pages. The outer join always returns a row, so `matched`
+# is read even when the page is empty.
+SEARCH_TEMPLATES = {
+    "postgresql": (
+        "WITH query AS (SELECT websearch_to_tsquery(CAST(:config AS regconfig), :q) AS q), "
+        "candidates AS MATERIALIZED ("
+        " SELECT execution_id, document FROM execution_search, query"
+        " WHERE tenant_id = :tenant_id AND document @@ query.q LIMIT :candidates), "
+        "ranked AS ("
+        " SELECT execution_id, CAST(ts_rank_cd(document, query.q, 1) AS FLOAT) AS rank FROM candidates, query), "
+    ),
+    "sqlite": (
+        "WITH ranked AS MATERIALIZED ("
+        " SELECT rowid AS execution_id, -bm25(execution_search) AS rank FROM execution_search"
+        " WHERE execution_search MATCH :q AND tenant_id = :tenant_id LIMIT :candidates), "
+    ),
+}
+SEARCH_PAGE = (
+    "page AS (SELECT execution_id, rank FROM ranked {after} ORDER BY rank DESC, execution_id DESC LIMIT :limit) "
+    "SELECT matched, execution_id, rank FROM (SELECT count(*) AS matched FROM ranked) AS counted "
+    "LEFT JOIN page ON 1 = 1 ORDER BY rank DESC, execution_id DESC"
+)
+AFTER_CURSOR = "WHERE (rank, execution_id) < (:after_rank, :after_id)"
+SEARCH_SQL = {
+    dialect: {after: text((template + SEARCH_PAGE).format(after=AFTER_CURSOR if after else ""))
+              for after in (False, True)}
+    for dialect, template in SEARCH_TEMPLATES.items()
+}
+
+
+class TooManyMatches(HTTPException):
+    def __init__(self):
+        super().__init__(status_code=400,
+                         detail=f"More than {SEARCH_MAX_CANDIDATES} executions match, narrow the query")
+
+
+def _sql(statements: dict):
+    return statements["postgresql" if engine.dialect.name == "postgresql" else "sqlite"]
+
+
+def search_document(execution) -> str:
+    prompt = execution.task if execution.task is not None else execution.stored_prompt
+    return "\n".join(part for part in (prompt, execution.response, execution.error) if part)
+
+
+def match_query(q: str) -> str:
+    """`q` as an FTS5 query matching rows that contain all its words; empty without words."""
+    return " ".join(f'"{word}"' for word in re.findall(r"\w+", q))
+
+
+async def index_executions(db, executions: List[Execution]):
+    """Adds the finished ones of `executions` to the index; call before committing them.
+
+    `db` is a session or a connection."""
+    rows = [{"execution_id": execution.id, "tenant_id": execution.tenant_id, "config": SEARCH_CONFIG,
+             "document": search_document(execution)}
+            for execution in executions if execution.status in EXECUTION_FINISHED]
+    if rows:
+        await db.execute(_sql(INDEX_SQL), rows)
+
+
+async def remove_executions(db, execution_ids: List[int]):
+    if execution_ids:
+        await db.execute(_sql(REMOVE_SQL).bindparams(bindparam("ids", expanding=True)),
+                         {"ids": list(execution_ids)})
+
+
+async def search_executions(db, tenant_id: str, q: str, limit: int,
+                            after: Optional[Tuple[float, int]] = None) -> List[Tuple[int, float]]:
+    """(execution id, rank) of the tenant's best matches for `q`, best first, after the (rank, id) `after`.
+
+    Raises TooManyMatches when more than SEARCH_MAX_CANDIDATES executions match."""
+    if engine.dialect.name != "postgresql":
+        q = match_query(q)
+        if not q:
+            return []
+    params = {"config": SEARCH_CONFIG, "q": q, "tenant_id": tenant_id, "candidates": SEARCH_MAX_CANDIDATES + 1,
+              "limit": limit}
+    if after is not None:
+        params["after_rank"], params["after_id"] = after
+    rows = (await db.execute(_sql(SEARCH_SQL)[after is not None], params)).all()
+    if rows[0].matched > SEARCH_MAX_CANDIDATES:
+        raise TooManyMatches()
+    return [(row.execution_id, row.rank) for row in rows if row.execution_id is not None]
+
+
+async def reindex(tenant_ids=None, batch_size: int = 1000) -> int:
+    """Indexes every finished execution (of `tenant_ids`), in batches of `batch_size`; returns how many."""
+    query = select(Execution).filter(Execution.status.in_(EXECUTION_FINISHED))
+    if tenant_ids:
+        query = query.filter(Execution.tenant_id.in_(tenant_ids))
+    indexed, last_id = 0, 0
+    while True:
+        async with SessionLocal() as db:
+            executions = (await db.scalars(
+                query.filter(Execution.id > last_id).order_by(Execution.id).limit(batch_size)
+            )).all()
+            if not executions:
+                return indexed
+            await index_executions(db, executions)
+            await db.commit()
+        indexed += len(executions)
+        last_id = executions[-1].id
+        logger.info("Indexed %s executions", indexed)
+
+
+async def main(tenant_ids=None, batch_size=1000):
+    logging.basicConfig(level=logging.INFO)
+    await init_models()
+    print(f"indexed {await reindex(tenant_ids, batch_size)} executions")
+    await engine.dispose()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Index finished executions for search.")
+    parser.add_argument("--tenant", action="append", help="only this tenant (repeatable)")
+    parser.add_argument("--batch-size", type=int, default=1000)
+    args = parser.parse_args()
+    asyncio.run(main(args.tenant, args.batch_size))
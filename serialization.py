@@ -0,0 +1,56 @@
+"""Fast path for large list responses.
+
+List endpoints select only the columns a response model needs and build plain dicts in the model's field
+order, then encode them with orjson. Rows come from our own tables and already satisfy the models, so
+skipping per-row validation does not change the output: the bytes are the same FastAPI would produce
+from the response model."""
+from typing import List, Sequence, Tuple, Type
+
+import orjson
+from fastapi import Response
+from pydantic import BaseModel
+from sqlalchemy import select
+
+from compression import decompress_response
+from models import PromptTemplate
+
+
+def model_fields(model: Type[BaseModel], exclude: Sequence[str] = ()) -> Tuple[str, ...]:
+    return tuple(name for name in model.model_fields if name not in exclude)
+
+
+def model_columns(entity, fields: Sequence[str]) -> List:
+    """The mapped columns of `entity` named like `fields`, for select(*columns)."""
+    return [getattr(entity, name) for name in fields]
+
+
+def json_list_response(items: list, response: Response) -> Response:
+    """`items` encoded as the body, with the headers set on the endpoint's `response` (ETag, cursor)."""
+    headers = {name: value for name, value in response.headers.items()
+               if name not in ("content-length", "content-type")}
+    return Response(content=orjson.dumps(items), media_type="application/json", headers=headers)
+
+
+async def load_prompt_templates(db, template_ids) -> dict:
+    """Prefix and suffix of each template id; a page of executions usually shares a handful."""
+    template_ids = {template_id for template_id in template_ids if template_id is not None}
+    if not template_ids:
+        return {}
+    rows = await db.execute(select(PromptTemplate.id, PromptTemplate.prefix, PromptTemplate.suffix)
+                            .filter(PromptTemplate.id.in_(template_ids)))
+    return {row.id: (row.prefix, row.suffix) for row in rows}
+
+
+def execution_prompt(row, templates: dict) -> str:
+    # Mirrors Execution.prompt for a row of selected columns.
+    template = templates.get(row.prompt_template_id)
+    if template is not None:
+        return f"{template[0]}{row.task}{template[1]}"
+    return row.stored_prompt
+
+
+def execution_response(row):
+    # Mirrors Execution.response.
+    if row.response_zstd is not None:
+        return decompress_response(row.response_zstd)
+    return row.stored_response
@@ -0,0 +1,126 @@
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import uuid
+
+from redis.exceptions import RedisError
+
+from metrics import llm_single_flight
+from utils import redis_client
+
+logger = logging.getLogger(__name__)
+
+SINGLE_FLIGHT_KEY = "single_flight"
+SINGLE_FLIGHT_REDIS = os.getenv("SINGLE_FLIGHT_REDIS", "0") == "1"
+SINGLE_FLIGHT_TIMEOUT = float(os.getenv("SINGLE_FLIGHT_TIMEOUT", "30"))
+# How long a finished result stays readable for followers of that leader that subscribed just after it
+# was published. Results are keyed by the leader's lock token, so later callers never read them.
+RESULT_TTL_MS = 5000
+
+# Takes the lock KEYS[1] for the token ARGV[1] (for ARGV[2] ms) unless another leader holds it, and returns
+# the token of whoever holds it now, so a follower learns which leader's result to wait for.
+ACQUIRE_LOCK_SCRIPT = redis_client.register_script("""
+local holder = redis.call('GET', KEYS[1])
+if holder then
+    return holder
+end
+redis.call('SET', KEYS[1], ARGV[1], 'PX', ARGV[2])
+return ARGV[1]
+""")
+
+RELEASE_LOCK_SCRIPT = redis_client.register_script("""
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('DEL', KEYS[1])
+end
+return 0
+""")
+
+
+class SingleFlight:
+    """Coalesces concurrent calls with the same key into one in-flight call whose result all callers share.
+
+    Inside a process the first caller starts the call and later callers await the same task. With
+    `use_redis`, the first caller across all workers takes a Redis lock and publishes the result; callers
+    in other workers wait for it and fall back to their own call if the leader fails or times out."""
+
+    def __init__(self, use_redis: bool = SINGLE_FLIGHT_REDIS, timeout: float = SINGLE_FLIGHT_TIMEOUT):
+        self.use_redis = use_redis
+        self.timeout = timeout
+        self._calls = {}
+
+    async def do(self, key: str, fn, tenant_id: str = ""):
+        task = self._calls.get(key)
+        if task is None:
+            call = self._redis_do(key, fn, tenant_id) if self.use_redis else self._lead(fn, tenant_id)
+            task = asyncio.ensure_future(call)
+            self._calls[key] = task
+            task.add_done_callback(lambda done: self._calls.pop(key, None) if self._calls.get(key) is done else None)
+        else:
+            llm_single_flight.inc(tenant=tenant_id, role="follower_local")
+        # One caller going away must not cancel the call the others are waiting on.
+        return await asyncio.shield(task)
+
+    @staticmethod
+    async def _lead(fn, tenant_id):
+        llm_single_flight.inc(tenant=tenant_id, role="leader")
+        return await fn()
+
+    async def _redis_do(self, key, fn, tenant_id):
+        digest = hashlib.sha256(key.encode()).hexdigest()
+        lock_key = f"{SINGLE_FLIGHT_KEY}:lock:{digest}"
+        token = uuid.uuid4().hex
+        try:
+            holder = await ACQUIRE_LOCK_SCRIPT(keys=[lock_key], args=[token, int(self.timeout * 1000)],
+                                               client=redis_client)
+        except RedisError:
+            logger.warning("Single-flight lock failed, calling directly", exc_info=True)
+            return await self._lead(fn, tenant_id)
+        result_key = f"{SINGLE_FLIGHT_KEY}:result:{digest}:{holder}"
+        channel = f"{SINGLE_FLIGHT_KEY}:done:{digest}:{holder}"
+
+        if holder == token:
+            outcome = json.dumps({"ok": False})
+            try:
+                result = await self._lead(fn, tenant_id)
+                outcome = json.dumps({"ok": True, "result": result})
+                return result
+            finally:
+                try:
+                    async with redis_client.pipeline(transaction=False) as pipe:
+                        pipe.set(result_key, outcome, px=RESULT_TTL_MS).publish(channel, outcome)
+                        await pipe.execute()
+                    await RELEASE_LOCK_SCRIPT(keys=[lock_key], args=[token], client=redis_client)
+                except RedisError:
+                    logger.warning("Single-flight publish failed", exc_info=True)
+
+        outcome = await self._wait_for_leader(result_key, channel)
+        if outcome and outcome["ok"]:
+            llm_single_flight.inc(tenant=tenant_id, role="follower_redis")
+            return outcome["result"]
+        llm_single_flight.inc(tenant=tenant_id, role="fallback")
+        return await fn()
+
+    async def _wait_for_leader(self, result_key, channel):
+        pubsub = redis_client.pubsub()
+        try:
+            # Subscribe before reading the result key so a publish in between is not missed.
+            await pubsub.subscribe(channel)
+            outcome = await redis_client.get(result_key)
+            loop = asyncio.get_running_loop()
+            deadline = loop.time() + self.timeout
+            while outcome is None and (remaining := deadline - loop.time()) > 0:
+                message = await pubsub.get_message(ignore_subscribe_messages=True, timeout=remaining)
+                if message:
+                    outcome = message["data"]
+            return json.loads(outcome) if outcome else None
+        except RedisError:
+            logger.warning("Single-flight wait failed", exc_info=True)
+            return None
+        finally:
+            await pubsub.unsubscribe()
+            await pubsub.aclose()
+
+
+llm_single_flight_group = SingleFlight()
@@ -1,41 +1,57 @@
+import asyncio
+import csv
+import io
+import json
+import uuid
+from datetime import datetime, timedelta
+from typing import List
+
+import httpx
 import pytest
+from fakeredis import FakeAsyncRedis
+from fastapi import HTTPException
 from fastapi.testclient import TestClient
+from pydantic import TypeAdapter
+from sqlalchemy import insert, select
+from sqlalchemy.ext.asyncio import async_sessionmaker
+from sqlalchemy.orm import selectinload
 
-from database import Base, engine, SessionLocal
+import archive
+import metrics
+import cache
+import compression
+import concurrency
+import database
+import llm
+import migrate_executions
+import rollups
+import search
+import singleflight
+import utils
+import worker
+from base_model import AgentResponse, ExecutionResponse, ToolResponse
+from database import URL_DATABASE, SessionLocal
 from main import app
-from utils import API_KEYS, redis_client
+from models import Agent, Execution, PromptTemplate, Tool
+from prompts import compile_prompt, count_tokens
+from routers import agents
+from utils import API_KEYS, redis_client, check_tenant_limit
+from write_behind import ExecutionWriteBehind, DURABILITY_FLUSHED
 
 
 @pytest.fixture()
-def flush_redis():
-    redis_client.flushdb()
+def flush_redis(client):
+    client.portal.call(redis_client.flushdb)
     yield
-    redis_client.flushdb()
-
-
-@pytest.fixture(scope="session", autouse=True)
-def create_db():
-    Base.metadata.create_all(bind=engine)
-    yield
-
-
-@pytest.fixture(scope="function", autouse=True)
-def db_session():
-    connection = engine.connect()
-    transaction = connection.begin()
-
-    session = SessionLocal(bind=connection)
-    try:
-        yield session
-    finally:
-        session.close()
-        transaction.rollback()
-        connection.close()
+    client.portal.call(redis_client.flushdb)
 
 
 @pytest.fixture(scope="module")
 def client():
-    return TestClient(app)
+    # Entering the client runs the app lifespan (schema creation) and keeps a single
+    # event loop for the module, which the async engine's pooled connections are bound to.
+    with TestClient(app) as client:
+        yield client
 
 
 @pytest.fixture
@@ -48,6 +64,29 @@ def fake_header():
     return {"X-API-Key": "tenant_faker"}
 
 
+def read_sse_events(lines):
+    event = None
+    for line in lines:
+        if line.startswith("event: "):
+            event = line[len("event: "):]
+        elif line.startswith("data: "):
+            yield event, json.loads(line[len("data: "):])
+
+
+def get_all_executions(client, headers):
+    executions, cursor = [], None
+    while True:
+        response = client.get(url="/executions",
+                              params={"cursor": cursor} if cursor else None,
+                              headers=headers)
+        if response.status_code == 404:
+            return executions
+        executions.extend(response.json())
+        cursor = response.headers.get("X-Next-Cursor")
+        if not cursor:
+            return executions
+
+
 @pytest.fixture
 def tools():
     return [
@@ -128,6 +167,44 @@ class TestAgentCRUD:
         assert len(exists_agent_by_tool) + 1 == len(agents_by_tool)
         assert agents_by_tool[0]["name"] == agent1["name"]
 
+    def test_list_filters_and_pages(self, client, real_header):
+        # Names unique to this run, so rows left by earlier runs do not match.
+        key = uuid.uuid4().hex[:8]
+        zeta_tools = [client.post(url="/tools",
+                                  json={"name": f"Zeta{key} {purpose}", "description": purpose},
+                                  headers=real_header).json()
+                      for purpose in ["search", "crawl"]]
+        scouts = [client.post(url="/agents",
+                              json={"name": name, "role": "Scout", "description": "Scouts", "tool_ids": tool_ids},
+                              headers=real_header).json()
+                  for name, tool_ids in [(f"Scout{key} one", [tool["id"] for tool in zeta_tools]),
+                                         (f"scout{key} two", [zeta_tools[0]["id"]])]]
+
+        def ids(url, **params):
+            response = client.get(url=url, params=params, headers=real_header)
+            return [item["id"] for item in response.json()] if response.status_code == 200 else response.status_code
+
+        scout_ids = [agent["id"] for agent in scouts]
+        zeta_ids = [tool["id"] for tool in zeta_tools]
+        assert ids("/agents", tool_name=f"zeta{key}", match="prefix") == scout_ids
+        assert ids("/agents", name=f"SCOUT{key}", match="prefix") == scout_ids
+        assert ids("/agents", name=f"Scout{key} one") == scout_ids[:1]
+        assert ids("/agents", name=f"scout{key} one") == 404
+        assert ids("/tools", agent_name=f"scout{key}", match="prefix") == zeta_ids
+        assert ids("/tools", name=f"zeta{key} s", match="prefix") == zeta_ids[:1]
+        assert ids("/tools", name="%", match="prefix") == 404
+
+        first = client.get(url="/agents", params={"name": f"scout{key}", "match": "prefix", "page_size": 1},
+                           headers=real_header)
+        assert [agent["id"] for agent in first.json()] == scout_ids[:1]
+        assert first.json()[0]["tools"] == zeta_tools
+        second = client.get(url="/agents",
+                            params={"name": f"scout{key}", "match": "prefix", "page_size": 1,
+                                    "cursor": first.headers["X-Next-Cursor"]},
+                            headers=real_header)
+        assert [agent["id"] for agent in second.json()] == scout_ids[1:]
+        assert "X-Next-Cursor" not in second.headers
+
     def test_create_agent_with_wrong_data(self, client, tools, real_header):
         response = client.post(url="/agents",
                                json=tools[0],
@@ -192,6 +269,215 @@ class TestAgentCRUD:
             headers={"X-API-Key": "tenant_c"})
         assert res_run_request.status_code == 429
         assert "Rate limit exceeded" in res_run_request.json().get("detail", "")
+        assert res_run_request.headers["X-RateLimit-Remaining"] == "0"
+        assert int(res_run_request.headers["Retry-After"]) > 0
+
+    def test_run_agent_async(self, client, agent1, real_header, flush_redis):
+        agent = client.post(url="/agents",
+                            json=agent1,
+                            headers=real_header).json()
+        response = client.post(url=f"/agents/{agent['id']}/run?async=true",
+                               json={"task": "Queued task", "model": "gpt-4o"},
+                               headers=real_header)
+        assert response.status_code == 202
+        queued = response.json()
+        assert queued["status"] == "queued"
+        assert queued["response"] is None
+
+        response = client.get(url=f"/executions/{queued['execution_id']}?wait=5",
+                              headers=real_header)
+        assert response.status_code == 200
+        execution = response.json()
+        assert execution["status"] == "succeeded"
+        assert execution["response"].startswith("[mock-response from gpt-4o]")
+
+        response = client.get(url=f"/executions/{queued['execution_id']}",
+                              headers={"X-API-Key": "tenant_b"})
+        assert response.status_code == 404
+
+    def test_run_agent_async_full_queue(self, client, agent1, real_header, flush_redis, monkeypatch):
+        monkeypatch.setitem(API_KEYS["tenant_a"], "max_queue", 0)
+        bumped, bump_versions = [], agents.bump_versions
+
+        async def tracked_bump_versions(tenant_id, *resources):
+            bumped.extend(resources)
+            await bump_versions(tenant_id, *resources)
+
+        monkeypatch.setattr(agents, "bump_versions", tracked_bump_versions)
+        agent = client.post(url="/agents", json=agent1, headers=real_header).json()
+        response = client.post(url=f"/agents/{agent['id']}/run?async=true",
+                               json={"task": "Queued task", "model": "gpt-4o"},
+                               headers=real_header)
+        assert response.status_code == 429
+        assert response.headers["Retry-After"] == "1"
+        # The dropped execution's own ETag must not keep matching.
+        assert any(resource.startswith("execution:") for resource in bumped)
+        response = client.get(url="/executions", params={"agent_id": agent["id"]}, headers=real_header)
+        assert response.status_code == 404
+
+    def test_run_agents_batch(self, client, agent1, agent2, real_header, flush_redis):
+        first = client.post(url="/agents",
+                            json=agent1,
+                            headers={"X-API-Key": "tenant_c"}).json()
+        second = client.post(url="/agents",
+                             json=agent2,
+                             headers={"X-API-Key": "tenant_c"}).json()
+        other_tenant_agent = client.post(url="/agents",
+                                         json=agent1,
+                                         headers=real_header).json()
+        items = [
+            {"agent_id": second["id"], "task": "Task 0"},
+            {"agent_id": other_tenant_agent["id"], "task": "Task 1"},
+            {"agent_id": first["id"], "task": "Task 2", "model": "unknown-model"},
+            {"agent_id": first["id"], "task": "Task 3", "model": "claude-3-opus"},
+            {"agent_id": first["id"], "task": "Task 4"},
+        ]
+        response = client.post(url="/agents/run:batch",
+                               json={"items": items},
+                               headers={"X-API-Key": "tenant_c"})
+        assert response.status_code == 200
+        results = response.json()["results"]
+        assert [result["status_code"] for result in results] == [200, 404, 400, 200, 429]
+        assert results[0]["execution"]["agent_name"] == agent2["name"]
+        assert results[3]["execution"]["model"] == "claude-3-opus"
+        assert "Task 3" in results[3]["execution"]["prompt"]
+        assert response.headers["X-RateLimit-Remaining"] == "0"
+
+        execution = client.get(url=f"/executions/{results[0]['execution']['execution_id']}",
+                               headers={"X-API-Key": "tenant_c"})
+        assert execution.status_code == 200
+
+    def test_run_agents_batch_item_failure(self, client, agent1, flush_redis, monkeypatch):
+        monkeypatch.setitem(API_KEYS, "tenant_batch", {"request_limit": 10, "limit_window": timedelta(minutes=1)})
+        headers = {"X-API-Key": "tenant_batch"}
+        agent = client.post(url="/agents", json=agent1, headers=headers).json()
+        call_llm = agents.cached_call_llm
+
+        async def failing_call_llm(tenant_id, agent_id, prompt, model, use_cache=True):
+            if "Task 1" in prompt:
+                raise RuntimeError("model unavailable")
+            return await call_llm(tenant_id, agent_id, prompt, model, use_cache)
+
+        monkeypatch.setattr(agents, "cached_call_llm", failing_call_llm)
+        executions = len(get_all_executions(client, headers))
+        response = client.post(url="/agents/run:batch",
+                               json={"items": [{"agent_id": agent["id"], "task": f"Task {i}"} for i in range(3)]},
+                               headers=headers)
+        assert response.status_code == 200
+        results = response.json()["results"]
+        assert [result["status_code"] for result in results] == [200, 502, 200]
+        assert results[1] == {"status_code": 502, "detail": "Model call failed", "execution": None}
+        assert len(get_all_executions(client, headers)) == executions + 2
+        # The failed item's token was given back.
+        assert response.headers["X-RateLimit-Remaining"] == "8"
+        assert client.portal.call(check_tenant_limit, "tenant_batch").remaining == 7
+
+    def test_run_agent_stream(self, client, agent1, real_header, flush_redis):
+        agent = client.post(url="/agents",
+                            json=agent1,
+                            headers=real_header).json()
+        with client.stream("POST",
+                           url=f"/agents/{agent['id']}/run/stream",
+                           json={"task": "Streamed task", "model": "gpt-4o"},
+                           headers=real_header) as response:
+            assert response.status_code == 200
+            assert response.headers["content-type"].startswith("text/event-stream")
+            assert "X-RateLimit-Remaining" in response.headers
+            events = list(read_sse_events(response.iter_lines()))
+
+        assert events[0][0] == "execution"
+        assert events[0][1]["status"] == "running"
+        chunks = [data["text"] for event, data in events if event == "chunk"]
+        assert len(chunks) > 1
+        assert events[-1][0] == "done"
+        assert events[-1][1]["response"] == "".join(chunks)
+
+        execution = client.get(url=f"/executions/{events[0][1]['execution_id']}",
+                               headers=real_header).json()
+        assert execution["status"] == "succeeded"
+        assert execution["response"] == "".join(chunks)
+
+    def test_run_agent_stream_save_failure(self, client, agent1, real_header, flush_redis, monkeypatch):
+        monkeypatch.setitem(API_KEYS["tenant_a"], "max_concurrency", 1)
+        released = []
+        release = agents.concurrency_limiter.release
+
+        async def tracked_release(tenant_id, token):
+            released.append(token)
+            await release(tenant_id, token)
+
+        async def failing_index(db, executions):
+            raise RuntimeError("index unavailable")
+
+        monkeypatch.setattr(agents.concurrency_limiter, "release", tracked_release)
+        monkeypatch.setattr(agents, "index_executions", failing_index)
+        agent = client.post(url="/agents", json=agent1, headers=real_header).json()
+        with client.stream("POST",
+                           url=f"/agents/{agent['id']}/run/stream",
+                           json={"task": "Streamed task", "model": "gpt-4o"},
+                           headers=real_header) as response:
+            events = list(read_sse_events(response.iter_lines()))
+
+        assert events[-1] == ("error", {"detail": "Failed to save the execution"})
+        assert len(released) == 1 and released[0] is not None
+
+    def test_run_agent_response_cache(self, client, agent1, real_header, flush_redis, monkeypatch):
+        monkeypatch.setitem(API_KEYS["tenant_a"], "response_cache_ttl", timedelta(minutes=1))
+        monkeypatch.setattr(cache, "response_cache", cache.ResponseCache())
+        agent = client.post(url="/agents",
+                            json=agent1,
+                            headers=real_header).json()
+        body = {"task": "Cached task", "model": "gpt-4o"}
+        hits = cache.llm_cache_requests.value(tenant="tenant_a", result="hit_local")
+
+        first = client.post(url=f"/agents/{agent['id']}/run", json=body, headers=real_header).json()
+        second = client.post(url=f"/agents/{agent['id']}/run", json=body, headers=real_header).json()
+        bypass = client.post(url=f"/agents/{agent['id']}/run", json={**body, "use_cache": False},
+                             headers=real_header).json()
+        assert (first["cached"], second["cached"], bypass["cached"]) == (False, True, False)
+        assert second["response"] == first["response"]
+        assert second["execution_id"] != first["execution_id"]
+        assert cache.llm_cache_requests.value(tenant="tenant_a", result="hit_local") == hits + 1
+
+        execution = client.get(url=f"/executions/{second['execution_id']}", headers=real_header).json()
+        assert execution["cached"] is True
+
+    def test_bulk_agents(self, client, agent1, agent2, tools, real_header):
+        tool = client.post(url="/tools",
+                           json=tools[0],
+                           headers=real_header).json()
+        items = [{**agent1, "tool_ids": [tool["id"]]}, {**agent2, "tool_ids": [1000]}, agent2]
+        response = client.post(url="/agents/bulk",
+                               json={"items": items},
+                               headers=real_header)
+        assert response.status_code == 400
+        assert response.json()["detail"] == [{"index": 1, "status_code": 400,
+                                              "detail": "One or more tools not found"}]
+
+        response = client.post(url="/agents/bulk",
+                               json={"items": items, "mode": "partial"},
+                               headers=real_header)
+        assert response.status_code == 200
+        results = response.json()["results"]
+        assert [result["status_code"] for result in results] == [200, 400, 200]
+        assert results[0]["agent"]["tools"][0]["id"] == tool["id"]
+        created = [results[0]["agent"]["id"], results[2]["agent"]["id"]]
+        agent = client.get(url=f"/agents/{created[0]}", headers=real_header).json()
+        assert agent["tools"][0]["name"] == tool["name"]
+
+        response = client.put(url="/agents/bulk",
+                              json={"items": [{"id": created[0], "role": "Bulk role"},
+                                              {"id": created[1], "tool_ids": [tool["id"]]}]},
+                              headers=real_header)
+        assert response.status_code == 200
+        assert client.get(url=f"/agents/{created[0]}", headers=real_header).json()["role"] == "Bulk role"
+        assert client.get(url=f"/agents/{created[1]}", headers=real_header).json()["tools"][0]["id"] == tool["id"]
+
+        response = client.request("DELETE", url="/agents/bulk",
+                                  json={"ids": created + [100000], "mode": "partial"},
+                                  headers=real_header)
+        assert [result["status_code"] for result in response.json()["results"]] == [200, 200, 404]
+        assert client.get(url=f"/agents/{created[0]}", headers=real_header).status_code == 404
 
     def test_delete_agent(self, client, agent1, real_header):
         agent = client.post(url="/agents",
@@ -204,6 +490,292 @@ class TestAgentCRUD:
                                  headers=real_header)
         assert response.status_code == 404
 
+    def test_agents_with_executions_are_not_deleted(self, client, agent1, real_header, flush_redis):
+        agent = client.post(url="/agents", json=agent1, headers=real_header).json()
+        client.post(url=f"/agents/{agent['id']}/run", json={"task": "Task", "model": "gpt-4o"}, headers=real_header)
+
+        response = client.delete(url=f"/agents/{agent['id']}", headers=real_header)
+        assert response.status_code == 400
+        assert response.json()["detail"] == "Cannot delete agent, it has executions."
+        response = client.request("DELETE", url="/agents/bulk",
+                                  json={"ids": [agent["id"]], "mode": "partial"},
+                                  headers=real_header)
+        assert response.json()["results"][0]["detail"] == "Cannot delete agent, it has executions."
+        assert client.get(url=f"/agents/{agent['id']}", headers=real_header).status_code == 200
+
+
+class TestRateLimit:
+
+    @pytest.mark.asyncio
+    async def test_limit_holds_under_parallel_burst(self, monkeypatch):
+        monkeypatch.setattr(utils, "redis_client", FakeAsyncRedis(decode_responses=True))
+        limit = API_KEYS["tenant_a"]["request_limit"]
+
+        results = await asyncio.gather(*(check_tenant_limit("tenant_a") for _ in range(limit * 5)))
+        assert sum(result.allowed for result in results) == limit
+        assert all(result.remaining == 0 and result.reset_after > 0
+                   for result in results if not result.allowed)
+
+        remaining = sorted(result.remaining for result in results if result.allowed)
+        assert remaining == list(range(limit))
+
+    @pytest.mark.asyncio
+    async def test_local_tier_leases_tokens_without_exceeding_limit(self, monkeypatch):
+        monkeypatch.setattr(utils, "redis_client", FakeAsyncRedis(decode_responses=True))
+        monkeypatch.setitem(API_KEYS, "tenant_b", {**API_KEYS["tenant_b"], "request_limit": 25, "lease_size": 10})
+        workers = [utils.LocalTokenCache(), utils.LocalTokenCache()]
+        redis_calls = utils.rate_limit_decisions.value(tenant="tenant_b", tier="redis", outcome="allowed")
+
+        results = await asyncio.gather(*(workers[i % 2].acquire("tenant_b") for i in range(40)))
+        assert sum(result.allowed for result in results) == 25
+        assert utils.rate_limit_decisions.value(tenant="tenant_b", tier="redis", outcome="allowed") - redis_calls == 3
+
+    @pytest.mark.asyncio
+    async def test_local_tier_returns_unspent_tokens_at_low_request_rates(self, monkeypatch):
+        monkeypatch.setattr(utils, "redis_client", FakeAsyncRedis(decode_responses=True))
+        monkeypatch.setitem(API_KEYS, "tenant_b", {**API_KEYS["tenant_b"], "request_limit": 30, "lease_size": 20,
+                                                   "lease_ttl": timedelta(seconds=10)})
+        clock = [0.0]
+        worker_cache = utils.LocalTokenCache(clock=lambda: clock[0])
+
+        results = []
+        for _ in range(31):
+            results.append(await worker_cache.acquire("tenant_b"))
+            clock[0] += 11
+        assert [result.allowed for result in results] == [True] * 30 + [False]
+
+    @pytest.mark.asyncio
+    async def test_batch_reservation_spends_the_lease_first(self, monkeypatch):
+        monkeypatch.setattr(utils, "redis_client", FakeAsyncRedis(decode_responses=True))
+        monkeypatch.setitem(API_KEYS, "tenant_b", {**API_KEYS["tenant_b"], "request_limit": 25, "lease_size": 10})
+        monkeypatch.setattr(utils, "local_token_cache", utils.LocalTokenCache())
+        assert (await check_tenant_limit("tenant_b")).remaining == 24
+        redis_calls = utils.rate_limit_decisions.value(tenant="tenant_b", tier="redis", outcome="allowed")
+
+        first = await utils.reserve_tenant_limit("tenant_b", 5)
+        assert (first.granted, first.result.remaining) == (5, 19)
+        assert utils.rate_limit_decisions.value(tenant="tenant_b", tier="redis", outcome="allowed") == redis_calls
+
+        second = await utils.reserve_tenant_limit("tenant_b", 30)
+        assert (second.granted, second.result.remaining) == (19, 0)
+
+        # Unused tokens go back to the window, whether they came from the lease or from Redis.
+        await utils.release_tenant_limit("tenant_b", first.members[:2] + second.members[-3:])
+        assert (await utils.reserve_tenant_limit("tenant_b", 30)).granted == 5
+
+
+class TestConcurrencyLimit:
+
+    @pytest.fixture
+    def limited_tenant(self, monkeypatch):
+        monkeypatch.setattr(concurrency, "redis_client", FakeAsyncRedis(decode_responses=True))
+        monkeypatch.setitem(API_KEYS, "tenant_b", {**API_KEYS["tenant_b"], "max_concurrency": 2, "max_queue": 10,
+                                                   "queue_timeout": timedelta(seconds=5)})
+
+    @pytest.mark.asyncio
+    async def test_runs_in_flight_never_exceed_the_cap(self, limited_tenant):
+        workers = [concurrency.TenantConcurrencyLimiter(poll_interval=0.01) for _ in range(2)]
+        in_flight, peak = 0, 0
+
+        async def run(limiter):
+            nonlocal in_flight, peak
+            async with limiter.slot("tenant_b"):
+                in_flight += 1
+                peak = max(peak, in_flight)
+                await asyncio.sleep(0.02)
+                in_flight -= 1
+
+        await asyncio.gather(*(run(workers[i % 2]) for i in range(8)))
+        assert peak == 2
+
+    @pytest.mark.asyncio
+    async def test_full_queue_is_rejected_and_wait_times_out(self, limited_tenant, monkeypatch):
+        monkeypatch.setitem(API_KEYS["tenant_b"], "max_queue", 1)
+        monkeypatch.setitem(API_KEYS["tenant_b"], "queue_timeout", timedelta(seconds=0.1))
+        limiter = concurrency.TenantConcurrencyLimiter(poll_interval=0.01)
+        tokens = [await limiter.acquire("tenant_b") for _ in range(2)]
+
+        results = await asyncio.gather(limiter.acquire("tenant_b"), limiter.acquire("tenant_b"),
+                                       return_exceptions=True)
+        assert sorted(result.status_code for result in results) == [429, 503]
+        assert not await concurrency.redis_client.zcard(limiter.keys("tenant_b")[1])
+
+        await limiter.release("tenant_b", tokens[0])
+        assert await limiter.acquire("tenant_b")
+
+    @pytest.mark.asyncio
+    async def test_full_execution_queue_is_rejected(self, limited_tenant, monkeypatch):
+        monkeypatch.setattr(worker, "redis_client", concurrency.redis_client)
+        monkeypatch.setitem(API_KEYS["tenant_b"], "max_queue", 2)
+        for execution_id in (1, 2):
+            await worker.enqueue_execution(execution_id, "tenant_b")
+
+        with pytest.raises(HTTPException) as rejected:
+            await worker.enqueue_execution(3, "tenant_b")
+        assert rejected.value.status_code == 429
+        assert rejected.value.headers["Retry-After"] == "5"
+        assert await worker.redis_client.llen(worker.queue_key("tenant_b")) == 2
+
+    def test_batch_calls_each_take_a_slot(self, client, agent1, limited_tenant, flush_redis, monkeypatch):
+        monkeypatch.setitem(API_KEYS["tenant_b"], "max_concurrency", 1)
+        monkeypatch.setitem(API_KEYS["tenant_b"], "max_queue", 1)
+        monkeypatch.setitem(API_KEYS["tenant_b"], "lease_size", 0)
+        # Slow enough model calls that all three items want a slot at once.
+        monkeypatch.setattr(llm, "_provider", llm.MockLLMProvider(first_token_delay=0.2))
+        agent = client.post("/agents", json=agent1, headers={"X-API-Key": "tenant_b"}).json()
+
+        response = client.post("/agents/run:batch",
+                               json={"items": [{"agent_id": agent["id"], "task": f"Task {i}"} for i in range(3)]},
+                               headers={"X-API-Key": "tenant_b"})
+        assert response.status_code == 200
+        results = response.json()["results"]
+        # Which item is turned away depends on the order the calls reach the limiter.
+        assert sorted(result["status_code"] for result in results) == [200, 200, 429]
+        assert [result["detail"] for result in results if result["status_code"] == 429] == ["Too many concurrent runs"]
+
+    def test_worker_queues_rotate_between_tenants(self):
+        pool = worker.ExecutionWorkerPool(size=1)
+        first, second = pool.queue_keys(), pool.queue_keys()
+        assert first[0] != second[0]
+        assert sorted(first) == sorted(second)
+
+    @pytest.mark.asyncio
+    async def test_worker_skips_a_busy_tenant_until_a_slot_is_released(self, limited_tenant, monkeypatch):
+        monkeypatch.setitem(API_KEYS["tenant_b"], "max_concurrency", 1)
+        limiter = concurrency.TenantConcurrencyLimiter(poll_interval=0.01)
+        token = await limiter.acquire("tenant_b")
+        with pytest.raises(concurrency.RunSlotBusy) as busy:
+            await limiter.acquire("tenant_b", wait=False)
+        assert not await concurrency.redis_client.zcard(limiter.keys("tenant_b")[1])
+
+        pool = worker.ExecutionWorkerPool(size=1)
+        pool.pause(worker.queue_key("tenant_b"), busy.value.released)
+        assert worker.queue_key("tenant_b") not in pool.queue_keys()
+        assert worker.queue_key("tenant_a") in pool.queue_keys()
+        await limiter.release("tenant_b", token)
+        assert worker.queue_key("tenant_b") in pool.queue_keys()
+
+
+class TestConnectionPools:
+
+    def test_pool_wait_timeout_is_a_503(self, client, real_header, monkeypatch):
+        engine = database.create_engine(URL_DATABASE, pool_size=1, max_overflow=1, pool_timeout=0.05)
+        monkeypatch.setattr(utils, "SessionLocal", async_sessionmaker(bind=engine))
+        overflow = metrics.pool_overflow.value(pool="database")
+        timeouts = metrics.pool_timeouts.value(pool="database")
+        waits = metrics.pool_wait_seconds.count(pool="database")
+
+        held = [client.portal.call(engine.connect().start) for _ in range(2)]
+        try:
+            response = client.get("/tools", headers=real_header)
+        finally:
+            for connection in held:
+                client.portal.call(connection.close)
+            client.portal.call(engine.dispose)
+        assert response.status_code == 503
+        assert response.headers["Retry-After"] == "1"
+        assert metrics.pool_overflow.value(pool="database") - overflow == 1
+        assert metrics.pool_timeouts.value(pool="database") - timeouts == 1
+        assert metrics.pool_wait_seconds.count(pool="database") - waits >= 3
+
+    def test_concurrent_first_runs_do_not_exhaust_the_pool(self, client, flush_redis, monkeypatch):
+        # More first-use runs, each storing a new prompt template, than the pool has connections.
+        runs = database.DB_POOL_SIZE + database.DB_MAX_OVERFLOW + 5
+        monkeypatch.setitem(API_KEYS, "tenant_pool", {"request_limit": 100, "limit_window": timedelta(hours=1)})
+        headers = {"X-API-Key": "tenant_pool"}
+        agent_ids = [client.post("/agents", json={"name": f"First run {uuid.uuid4().hex}", "role": "Helper",
+                                                  "description": "Helps"}, headers=headers).json()["id"]
+                     for _ in range(runs)]
+
+        async def run_all():
+            transport = httpx.ASGITransport(app=app)
+            async with httpx.AsyncClient(transport=transport, base_url="http://test") as http:
+                return await asyncio.gather(*(
+                    http.post(f"/agents/{agent_id}/run", json={"task": "Say hi", "model": "gpt-4o"}, headers=headers)
+                    for agent_id in agent_ids
+                ))
+
+        responses = client.portal.call(run_all)
+        assert [response.status_code for response in responses] == [200] * runs
+
+    def test_pool_gauges_are_exported(self, client):
+        body = client.get("/metrics").text
+        assert 'pool_connections{pool="database",state="in_use"}' in body
+        assert 'pool_connections{pool="redis",state="idle"}' in body
+        assert 'pool_wait_seconds_bucket{pool="database",le="+Inf"}' in body
+
+
+class TestRequestMetrics:
+
+    def test_requests_are_timed_by_route_and_tenant(self, client, real_header, fake_header, tools):
+        route = "/tools"
+        requests = metrics.http_request_duration.count(method="GET", route=route, tenant="tenant_a")
+        queries = metrics.http_request_db_queries.sum(route=route)
+        rejected = metrics.http_requests.value(method="GET", route=route, tenant="", status=401)
+
+        client.post("/tools", json=tools[0], headers=real_header)
+        assert client.get("/tools", headers=real_header).status_code == 200
+        assert client.get("/tools", headers=fake_header).status_code == 401
+
+        assert metrics.http_request_duration.count(method="GET", route=route, tenant="tenant_a") - requests == 1
+        assert metrics.http_request_db_queries.sum(route=route) - queries >= 1
+        assert metrics.http_requests.value(method="GET", route=route, tenant="", status=401) - rejected == 1
+
+    def test_model_calls_are_timed(self, client, agent1, real_header, flush_redis):
+        calls = metrics.llm_call_duration.count(model="gpt-4o", mode="complete")
+        rate_limit_calls = metrics.redis_call_duration.count(operation="rate_limit")
+        agent = client.post("/agents", json=agent1, headers=real_header).json()
+
+        response = client.post(f"/agents/{agent['id']}/run", json={"task": "Say hi", "model": "gpt-4o"},
+                               headers=real_header)
+        assert response.status_code == 200
+        assert metrics.llm_call_duration.count(model="gpt-4o", mode="complete") - calls == 1
+        assert metrics.redis_call_duration.count(operation="rate_limit") - rate_limit_calls == 1
+        assert 'http_request_duration_seconds_bucket{method="POST",route="/agents/{agent_id}/run",' \
+               'tenant="tenant_a",le="+Inf"}' in client.get("/metrics").text
+
+
+class TestSingleFlight:
+
+    @staticmethod
+    def slow_call(calls):
+        async def call():
+            calls.append(1)
+            await asyncio.sleep(0.05)
+            return f"response {len(calls)}"
+        return call
+
+    @pytest.mark.asyncio
+    async def test_concurrent_calls_share_one_in_flight_call(self):
+        group, calls = singleflight.SingleFlight(use_redis=False), []
+        results = await asyncio.gather(*(group.do("key", self.slow_call(calls)) for _ in range(10)))
+        assert len(calls) == 1
+        assert set(results) == {"response 1"}
+
+        assert await group.do("key", self.slow_call(calls)) == "response 2"
+
+    @pytest.mark.asyncio
+    async def test_calls_are_coalesced_across_workers(self, monkeypatch):
+        monkeypatch.setattr(singleflight, "redis_client", FakeAsyncRedis(decode_responses=True))
+        workers = [singleflight.SingleFlight(use_redis=True, timeout=5) for _ in range(3)]
+        calls = []
+        results = await asyncio.gather(*(workers[i % 3].do("key", self.slow_call(calls)) for i in range(9)))
+        assert len(calls) == 1
+        assert set(results) == {"response 1"}
+
+    @pytest.mark.asyncio
+    async def test_followers_never_get_an_earlier_leaders_result(self, monkeypatch):
+        monkeypatch.setattr(singleflight, "redis_client", FakeAsyncRedis(decode_responses=True))
+        workers = [singleflight.SingleFlight(use_redis=True, timeout=5) for _ in range(2)]
+        calls = []
+        assert await workers[0].do("key", self.slow_call(calls)) == "response 1"
+
+        leader = asyncio.create_task(workers[0].do("key", self.slow_call(calls)))
+        await asyncio.sleep(0.01)
+        assert await workers[1].do("key", self.slow_call(calls)) == "response 2"
+        assert await leader == "response 2"
+        assert len(calls) == 2
+
 
 class TestToolCRUD:
 
@@ -262,6 +834,160 @@ class TestToolCRUD:
         assert response_data["name"] == "New name"
         assert response_data["description"] == tools[0]["description"]
 
+    @pytest.mark.asyncio
+    async def test_definition_loaded_before_a_peer_invalidation_stays_out_of_redis(self, monkeypatch):
+        monkeypatch.setattr(cache, "redis_client", FakeAsyncRedis(decode_responses=True))
+        reader, writer = cache.DefinitionCache(use_redis=True), cache.DefinitionCache(use_redis=True)
+        key = reader.key("tool", "tenant_a", 1)
+        stale = ToolResponse(id=1, tenant_id="tenant_a", name="old", description="Old")
+
+        seen = await reader.snapshot([key])
+        await writer.invalidate("tenant_a", tool_ids=[1])
+        await reader.fill("tool", "tenant_a", [stale], seen)
+        assert await cache.redis_client.get(key) is None
+
+        fresh = stale.model_copy(update={"name": "new"})
+        await reader.fill("tool", "tenant_a", [fresh], await reader.snapshot([key]))
+        assert (await writer.get_many("tool", "tenant_a", [1], ToolResponse))[1].name == "new"
+
+    def test_tool_update_invalidates_cached_agent(self, client, tools, agent1, real_header):
+        tool = client.post(url="/tools",
+                           json=tools[0],
+                           headers=real_header).json()
+        agent1["tool_ids"] = [tool["id"]]
+        agent = client.post(url="/agents",
+                            json=agent1,
+                            headers=real_header).json()
+        hits = cache.definition_cache_requests.value(kind="agent", result="hit_local")
+        client.get(url=f"/agents/{agent['id']}", headers=real_header)
+        client.get(url=f"/agents/{agent['id']}", headers=real_header)
+        assert cache.definition_cache_requests.value(kind="agent", result="hit_local") == hits + 1
+
+        client.put(url=f"/tools/{tool['id']}",
+                   json={"name": "renamed"},
+                   headers=real_header)
+        response = client.get(url=f"/agents/{agent['id']}", headers=real_header).json()
+        assert response["tools"][0]["name"] == "renamed"
+        assert client.get(url=f"/tools/{tool['id']}", headers=real_header).json()["name"] == "renamed"
+
+        client.put(url=f"/agents/{agent['id']}",
+                   json={"role": "New role"},
+                   headers=real_header)
+        assert client.get(url=f"/agents/{agent['id']}", headers=real_header).json()["role"] == "New role"
+
+    def test_run_prompt_follows_tool_updates(self, client, tools, agent1, real_header, flush_redis):
+        tool = client.post(url="/tools",
+                           json=tools[0],
+                           headers=real_header).json()
+        agent1["tool_ids"] = [tool["id"]]
+        agent = client.post(url="/agents",
+                            json=agent1,
+                            headers=real_header).json()
+        run = client.post(url=f"/agents/{agent['id']}/run",
+                          json={"task": "Add 2 and 2", "model": "gpt-4o"},
+                          headers=real_header).json()
+        assert "Available tools:\n- calculator: Calculator tool\nTask: Add 2 and 2\n" in run["prompt"]
+
+        client.put(url=f"/tools/{tool['id']}",
+                   json={"name": "abacus"},
+                   headers=real_header)
+        run = client.post(url=f"/agents/{agent['id']}/run",
+                          json={"task": "Add 2 and 2", "model": "gpt-4o"},
+                          headers=real_header).json()
+        assert "- abacus: Calculator tool\n" in run["prompt"]
+
+    def test_compile_prompt_truncates_tool_catalog(self):
+        agent = AgentResponse(id=1, tenant_id="tenant_a", name="Agent", role="Helper", description="Helps",
+                              tools=[ToolResponse(id=i, tenant_id="tenant_a", name=f"tool{i}",
+                                                  description="Does one thing " * 10) for i in range(50)])
+        full = compile_prompt(agent)
+        assert full.omitted_tools == 0 and "- tool49:" in full.prefix
+
+        compiled = compile_prompt(agent, token_budget=300)
+        assert compiled.tokens <= 300 and compiled.omitted_tools > 0
+        assert f"- ... {compiled.omitted_tools} more tools not listed\nTask: " in compiled.prefix
+        assert compiled.render("Do it").endswith("Task: Do it" + compiled.suffix)
+
+    def test_prompt_template_is_stored_with_the_callers_transaction(self, client):
+        name = f"pending {uuid.uuid4().hex}"
+        agent = AgentResponse(id=1, tenant_id="tenant_a", name=name, role="Helper", description="Helps", tools=[])
+        template_id = compile_prompt(agent).template_id
+
+        async def store(commit):
+            async with SessionLocal() as db:
+                db.add(Tool(tenant_id="tenant_a", name=name, description="Pending"))
+                await cache.get_prompt_template(db, compile_prompt(agent))
+                await (db.commit() if commit else db.rollback())
+            async with SessionLocal() as db:
+                return (await db.get(PromptTemplate, template_id),
+                        await db.scalar(select(Tool).filter(Tool.name == name)))
+
+        assert client.portal.call(store, False) == (None, None)
+        assert not cache._stored_prompt_templates.get(template_id)
+        stored_template, tool = client.portal.call(store, True)
+        assert stored_template is not None and tool is not None
+        assert cache._stored_prompt_templates.get(template_id)
+
+    def test_conditional_get(self, client, tools, agent1, real_header):
+        tool = client.post(url="/tools",
+                           json=tools[0],
+                           headers=real_header).json()
+        agent1["tool_ids"] = [tool["id"]]
+        agent = client.post(url="/agents",
+                            json=agent1,
+                            headers=real_header).json()
+        urls = ["/tools", f"/tools/{tool['id']}", "/agents", f"/agents/{agent['id']}"]
+        etags = {url: client.get(url=url, headers=real_header).headers["ETag"] for url in urls}
+        for url, etag in etags.items():
+            response = client.get(url=url, headers={**real_header, "If-None-Match": etag})
+            assert response.status_code == 304
+            assert response.content == b""
+
+        client.put(url=f"/tools/{tool['id']}",
+                   json={"description": "Changed"},
+                   headers=real_header)
+        for url, etag in etags.items():
+            response = client.get(url=url, headers={**real_header, "If-None-Match": etag})
+            assert response.status_code == 200
+            assert response.headers["ETag"] != etag
+
+    def test_if_none_match_any_needs_an_existing_item(self, client, tools, agent1, real_header):
+        tool = client.post(url="/tools", json=tools[0], headers=real_header).json()
+        agent = client.post(url="/agents", json=agent1, headers=real_header).json()
+        any_tag = {**real_header, "If-None-Match": "*"}
+        assert client.get(url=f"/tools/{tool['id']}", headers=any_tag).status_code == 304
+        assert client.get(url=f"/agents/{agent['id']}", headers=any_tag).status_code == 304
+        for url in ["/tools/100000", "/agents/100000", "/executions/100000"]:
+            assert client.get(url=url, headers=any_tag).status_code == 404
+
+    def test_bulk_tools(self, client, tools, agent1, real_header):
+        response = client.post(url="/tools/bulk",
+                               json={"items": tools},
+                               headers=real_header)
+        assert response.status_code == 200
+        created = [result["tool"] for result in response.json()["results"]]
+        assert [tool["name"] for tool in created] == [tool["name"] for tool in tools]
+        agent1["tool_ids"] = [created[0]["id"]]
+        client.post(url="/agents", json=agent1, headers=real_header)
+
+        response = client.put(url="/tools/bulk",
+                              json={"items": [{"id": created[0]["id"], "description": "Bulk"},
+                                              {"id": 100000, "name": "missing"}]},
+                              headers=real_header)
+        assert response.status_code == 400
+        response = client.put(url="/tools/bulk",
+                              json={"items": [{"id": created[0]["id"], "description": "Bulk"},
+                                              {"id": 100000, "name": "missing"}], "mode": "partial"},
+                              headers=real_header)
+        assert [result["status_code"] for result in response.json()["results"]] == [200, 404]
+        assert client.get(url=f"/tools/{created[0]['id']}", headers=real_header).json()["description"] == "Bulk"
+
+        response = client.request("DELETE", url="/tools/bulk",
+                                  json={"ids": [tool["id"] for tool in created], "mode": "partial"},
+                                  headers=real_header)
+        assert [result["status_code"] for result in response.json()["results"]] == [400, 200]
+        assert client.get(url=f"/tools/{created[1]['id']}", headers=real_header).status_code == 404
+
     def test_delete_tool(self, client, tools, agent1, real_header):
         tool = client.post(url="/tools",
                            json=tools[0],
@@ -287,27 +1013,384 @@ class TestToolCRUD:
 
 class TestExecutions:
 
+    def test_list_responses_match_response_models(self, client, agent1, real_header, flush_redis):
+        tool = client.post("/tools", json={"name": "Météo 🌦", "description": "Line\nbreak \"quoted\" \u2028"},
+                           headers=real_header).json()
+        agent = client.post("/agents", json={**agent1, "tool_ids": [tool["id"]]}, headers=real_header).json()
+        client.post(f"/agents/{agent['id']}/run", json={"task": "Ünïcode task", "model": "gpt-4o"},
+                    headers=real_header)
+
+        async def load(query):
+            async with SessionLocal() as db:
+                return (await db.scalars(query)).all()
+
+        cases = [
+            ("/tools", ToolResponse, select(Tool).filter(Tool.tenant_id == "tenant_a")),
+            ("/agents", AgentResponse, select(Agent).options(selectinload(Agent.tools))
+             .filter(Agent.tenant_id == "tenant_a").order_by(Agent.id)),
+            ("/executions?page_size=1000", ExecutionResponse, select(Execution)
+             .filter(Execution.tenant_id == "tenant_a")
+             .order_by(Execution.timestamp.desc(), Execution.id.desc()).limit(1000)),
+        ]
+        for url, model, query in cases:
+            adapter = TypeAdapter(List[model])
+            items = adapter.validate_python(client.portal.call(load, query), from_attributes=True)
+            for item in items:
+                if model is AgentResponse:
+                    item.tools.sort(key=lambda tool_response: tool_response.id)
+            response = client.get(url, headers=real_header)
+            assert response.headers["content-type"] == "application/json"
+            assert response.content == adapter.dump_json(items)
+
     def test_get_executions(self, client, agent1, real_header, flush_redis):
         agent = client.post(url="/agents",
                             json=agent1,
                             headers=real_header).json()
-        exists_executions = client.get(url="/executions",
-                                       headers=real_header).json()
+        exists_executions = get_all_executions(client, real_header)
         for i in range(5):
             res = client.post(
                 url=f"/agents/{agent['id']}/run",
                 json={"task": f"Task {i}", "model": "gpt-4o"},
                 headers=real_header)
             assert res.status_code == 200
-        response = client.get(url="/executions",
-                              headers=real_header)
-        assert response.status_code == 200
-        assert len(exists_executions) + 5 == len(response.json())
+        assert len(exists_executions) + 5 == len(get_all_executions(client, real_header))
 
         response = client.get(url="/executions" + "?page=1&page_size=2",
                               headers=real_header)
         assert len(response.json()) == 2
 
+    def test_get_executions_with_cursor(self, client, agent1, real_header, flush_redis):
+        agent = client.post(url="/agents",
+                            json=agent1,
+                            headers=real_header).json()
+        for i in range(5):
+            client.post(url=f"/agents/{agent['id']}/run",
+                        json={"task": f"Task {i}", "model": "gpt-4o"},
+                        headers=real_header)
+
+        first = client.get(url=f"/executions?agent_id={agent['id']}&page_size=3",
+                           headers=real_header)
+        assert first.status_code == 200
+        assert len(first.json()) == 3
+        second = client.get(url="/executions",
+                            params={"agent_id": agent["id"], "page_size": 3,
+                                    "cursor": first.headers["X-Next-Cursor"]},
+                            headers=real_header)
+        assert len(second.json()) == 2
+        assert "X-Next-Cursor" not in second.headers
+
+        ids = [execution["id"] for execution in first.json() + second.json()]
+        assert ids == sorted(ids, reverse=True)
+
+        response = client.get(url="/executions?cursor=not-a-cursor",
+                              headers=real_header)
+        assert response.status_code == 400
+
+        etag = first.headers["ETag"]
+        response = client.get(url=f"/executions?agent_id={agent['id']}&page_size=3",
+                              headers={**real_header, "If-None-Match": etag})
+        assert response.status_code == 304
+        client.post(url=f"/agents/{agent['id']}/run",
+                    json={"task": "Another task", "model": "gpt-4o"},
+                    headers=real_header)
+        response = client.get(url=f"/executions?agent_id={agent['id']}&page_size=3",
+                              headers={**real_header, "If-None-Match": etag})
+        assert response.status_code == 200
+
+    def test_export_executions(self, client, agent1, real_header, flush_redis):
+        agent = client.post(url="/agents",
+                            json=agent1,
+                            headers=real_header).json()
+        for i in range(3):
+            client.post(url=f"/agents/{agent['id']}/run",
+                        json={"task": f"Task {i}", "model": "gpt-4o"},
+                        headers=real_header)
+        expected = client.get(url=f"/executions?agent_id={agent['id']}",
+                              headers=real_header).json()[::-1]
+
+        response = client.get(url=f"/executions/export?agent_id={agent['id']}",
+                              headers=real_header)
+        assert response.status_code == 200
+        assert response.headers["content-type"].startswith("application/x-ndjson")
+        assert [json.loads(line) for line in response.text.splitlines()] == expected
+
+        response = client.get(url=f"/executions/export?agent_id={agent['id']}&format=csv",
+                              headers=real_header)
+        rows = list(csv.DictReader(io.StringIO(response.text)))
+        assert [int(row["id"]) for row in rows] == [execution["id"] for execution in expected]
+        assert rows[0]["prompt"] == expected[0]["prompt"]
+
+        response = client.get(url=f"/executions/export?agent_id={agent['id']}&since=2999-01-01T00:00:00",
+                              headers=real_header)
+        assert response.text == ""
+
+    def test_archived_executions_are_still_served(self, client, agent1, real_header, flush_redis, monkeypatch,
+                                                  tmp_path):
+        monkeypatch.setattr(archive, "ARCHIVE_DIR", str(tmp_path))
+        monkeypatch.setattr(archive, "ARCHIVE_SEGMENT_ROWS", 2)
+        # Index entries are read one at a time and at most about one segment stays parsed in memory.
+        monkeypatch.setattr(archive, "SEGMENT_BATCH", 1)
+        monkeypatch.setattr("routers.executions.SEGMENT_BATCH", 1)
+        monkeypatch.setattr(archive, "_segment_cache", cache.LRUCache(4096))
+        agent = client.post(url="/agents",
+                            json=agent1,
+                            headers=real_header).json()
+        for i in range(3):
+            client.post(url=f"/agents/{agent['id']}/run",
+                        json={"task": f"Task {i}", "model": "gpt-4o"},
+                        headers=real_header)
+        listing = client.get(url=f"/executions?agent_id={agent['id']}", headers=real_header)
+        expected = listing.json()
+        exported = client.get(url=f"/executions/export?agent_id={agent['id']}", headers=real_header).text
+
+        archived = client.portal.call(archive.archive_tenant, "tenant_a", datetime.utcnow() + timedelta(seconds=1))
+        assert archived >= 3
+        assert client.get(url=f"/executions?agent_id={agent['id']}",
+                          headers={**real_header, "If-None-Match": listing.headers["ETag"]}).status_code == 200
+        assert list(tmp_path.glob("tenant_a/*.ndjson.gz"))
+
+        assert client.get(url=f"/executions?agent_id={agent['id']}", headers=real_header).json() == expected
+        first = client.get(url=f"/executions?agent_id={agent['id']}&page_size=2", headers=real_header)
+        second = client.get(url="/executions",
+                            params={"agent_id": agent["id"], "page_size": 2,
+                                    "cursor": first.headers["X-Next-Cursor"]},
+                            headers=real_header)
+        assert first.json() + second.json() == expected
+        response = client.get(url=f"/executions?agent_id={agent['id']}&page=2&page_size=2", headers=real_header)
+        assert response.json() == expected[2:]
+        response = client.get(url=f"/executions/{expected[1]['id']}", headers=real_header)
+        assert response.json() == expected[1]
+        assert client.get(url=f"/executions/export?agent_id={agent['id']}", headers=real_header).text == exported
+        assert 0 < archive._segment_cache.size <= 4096
+        assert len(archive._segment_cache) < len(list(tmp_path.glob("tenant_a/*.ndjson.gz")))
+        # Archived executions still keep their agent from being deleted.
+        assert client.delete(url=f"/agents/{agent['id']}", headers=real_header).status_code == 400
+
+    def test_migrate_executions_to_prompt_templates(self, client, agent1, real_header, monkeypatch):
+        monkeypatch.setattr(compression, "RESPONSE_COMPRESSION", compression.RESPONSE_COMPRESSION)
+        agent = client.post(url="/agents",
+                            json=agent1,
+                            headers=real_header).json()
+        prompt = (f"    You are {agent['name']}, {agent['role']}.\n    Description: {agent['description']}\n"
+                  f"    Available tools: No tools available\n    Task: Legacy task\n"
+                  f"    Please complete the task using the information and tools available to you.\n    ")
+        long_response = "A response that repeats itself. " * 50
+
+        async def insert_legacy():
+            async with SessionLocal() as db:
+                result = await db.execute(insert(Execution.__table__).returning(Execution.__table__.c.id), {
+                    "tenant_id": "tenant_a", "agent_id": agent["id"], "prompt": prompt, "model": "gpt-4o",
+                    "response": long_response, "timestamp": datetime.utcnow(), "status": "succeeded"
+                })
+                await db.commit()
+                return result.scalar_one()
+
+        execution_id = client.portal.call(insert_legacy)
+        before = client.get(url=f"/executions/{execution_id}", headers=real_header).json()
+
+        result = client.portal.call(migrate_executions.migrate, 1000, True)
+        assert result["executions"] >= 1
+        assert result["bytes_after"] < result["bytes_before"]
+
+        async def load():
+            async with SessionLocal() as db:
+                return await db.get(Execution, execution_id)
+
+        execution = client.portal.call(load)
+        assert (execution.stored_prompt, execution.task) == (None, "Legacy task")
+        assert execution.stored_response is None and execution.response_zstd
+        assert client.get(url=f"/executions/{execution_id}", headers=real_header).json() == before
+        assert before["prompt"] == prompt and before["response"] == long_response
+
+    def test_search_executions(self, client, agent1, real_header, flush_redis, monkeypatch):
+        agent = client.post(url="/agents",
+                            json=agent1,
+                            headers=real_header).json()
+        # Unique to this agent, so executions of earlier test runs do not match.
+        word = f"quasar{agent['id']}"
+        runs = [client.post(url=f"/agents/{agent['id']}/run",
+                            json={"task": task, "model": "gpt-4o"},
+                            headers=real_header).json()
+                for task in [f"Check the {word} telemetry", f"{word} {word}: explain the {word} jets",
+                             "Summarise the weekly report"]]
+
+        response = client.get(url="/executions/search", params={"q": word}, headers=real_header)
+        assert response.status_code == 200
+        results = response.json()
+        assert [result["id"] for result in results] == [runs[1]["execution_id"], runs[0]["execution_id"]]
+        assert results[0]["rank"] > results[1]["rank"]
+        assert results[0]["prompt"] == runs[1]["prompt"] and results[0]["response"] == runs[1]["response"]
+
+        found = client.get(url="/executions/search", params={"q": f"{word} telemetry"}, headers=real_header).json()
+        assert [result["id"] for result in found] == [runs[0]["execution_id"]]
+
+        pages, cursor = [], None
+        while True:
+            response = client.get(url="/executions/search",
+                                  params={"q": word, "page_size": 1, **({"cursor": cursor} if cursor else {})},
+                                  headers=real_header)
+            pages.extend(response.json())
+            cursor = response.headers.get("X-Next-Cursor")
+            if not cursor:
+                break
+        assert pages == results
+
+        response = client.get(url="/executions/search", params={"q": word}, headers={"X-API-Key": "tenant_b"})
+        assert response.status_code == 404
+        assert client.get(url="/executions/search", params={"q": ""}, headers=real_header).status_code == 422
+
+        # Past the cap the query fails rather than ranking only some of the matches.
+        monkeypatch.setattr(search, "SEARCH_MAX_CANDIDATES", 1)
+        response = client.get(url="/executions/search", params={"q": word}, headers=real_header)
+        assert response.status_code == 400
+        assert response.json()["detail"] == "More than 1 executions match, narrow the query"
+        assert client.get(url="/executions/search", params={"q": f"{word} telemetry"},
+                          headers=real_header).status_code == 200
+
+    def test_default_stats_window_is_part_of_the_etag(self, client, real_header, monkeypatch):
+        now = [datetime(2024, 1, 1, 12, 0, 30)]
+
+        class Clock(datetime):
+            @classmethod
+            def utcnow(cls):
+                return now[0]
+
+        monkeypatch.setattr("routers.executions.datetime", Clock)
+        url = "/executions/stats?granularity=minute"
+        etag = client.get(url=url, headers=real_header).headers["ETag"]
+        assert client.get(url=url, headers={**real_header, "If-None-Match": etag}).status_code == 304
+
+        # Another second in the same minute keeps the window; the next minute moves it.
+        now[0] += timedelta(seconds=1)
+        assert client.get(url=url, headers={**real_header, "If-None-Match": etag}).status_code == 304
+        now[0] += timedelta(minutes=1)
+        assert client.get(url=url, headers={**real_header, "If-None-Match": etag}).status_code == 200
+
+    def test_execution_stats(self, client, agent1, real_header, flush_redis):
+        agent = client.post(url="/agents",
+                            json=agent1,
+                            headers=real_header).json()
+        runs = [client.post(url=f"/agents/{agent['id']}/run",
+                            json={"task": f"Task {i}", "model": model},
+                            headers=real_header).json()
+                for i, model in enumerate(["gpt-4o", "gpt-4o", "claude-3-opus"])]
+        queued = client.post(url=f"/agents/{agent['id']}/run?async=true",
+                             json={"task": "Queued task", "model": "gpt-4o"},
+                             headers=real_header).json()
+        assert client.get(url=f"/executions/{queued['execution_id']}?wait=5",
+                          headers=real_header).json()["status"] == "succeeded"
+
+        params = {"granularity": "day", "agent_id": agent["id"], "group_by": "model"}
+        response = client.get(url="/executions/stats", params=params, headers=real_header)
+        assert response.status_code == 200
+        stats = {bucket["model"]: bucket for bucket in response.json()}
+        assert {model: bucket["runs"] for model, bucket in stats.items()} == {"gpt-4o": 3, "claude-3-opus": 1}
+        assert stats["gpt-4o"]["succeeded"] == 3 and stats["gpt-4o"]["failed"] == 0
+        assert stats["claude-3-opus"]["prompt_tokens"] == count_tokens(runs[2]["prompt"])
+        assert stats["claude-3-opus"]["response_tokens"] == count_tokens(runs[2]["response"])
+        minutes = client.get(url="/executions/stats",
+                             params={"granularity": "minute", "agent_id": agent["id"]},
+                             headers=real_header).json()
+        assert sum(bucket["runs"] for bucket in minutes) == 4
+        assert all(bucket["agent_id"] is None for bucket in minutes)
+
+        # A rebuild from the stored executions gives the same totals as the incremental updates.
+        params = {"granularity": "hour", "agent_id": agent["id"], "group_by": ["agent_id", "model"]}
+        expected = client.get(url="/executions/stats", params=params, headers=real_header).json()
+        assert client.portal.call(rollups.rebuild, ["tenant_a"])["tenant_a"] >= 4
+        assert client.get(url="/executions/stats", params=params, headers=real_header).json() == expected
+        response = client.get(url="/executions/stats",
+                              params={"granularity": "minute", "since": "2024-01-01T00:00:00",
+                                      "until": "2024-01-03T00:00:00"},
+                              headers=real_header)
+        assert response.status_code == 400
+
+    def test_write_behind_drops_rows_the_database_rejects(self, client, agent1, real_header, monkeypatch):
+        agent = client.post(url="/agents", json=agent1, headers=real_header).json()
+        taken = client.post(url=f"/agents/{agent['id']}/run", json={"task": "Task", "model": "gpt-4o"},
+                            headers=real_header).json()["execution_id"]
+        buffer = ExecutionWriteBehind(enabled=True, batch_size=10, interval=60, durability=DURABILITY_FLUSHED)
+
+        async def allocate_ids(count):
+            # The first id is already used, so the batch fails on its primary key.
+            return [taken] + [taken + 10 ** 6 + i for i in range(count - 1)]
+
+        monkeypatch.setattr(buffer, "_allocate_ids", allocate_ids)
+        # Queue rows without the flush loop, so the test decides when the batch is inserted.
+        buffer.active = True
+
+        async def write():
+            runs = [asyncio.create_task(buffer.add(Execution(tenant_id="tenant_a", agent_id=agent["id"],
+                                                             prompt=f"Prompt {i}", model="gpt-4o",
+                                                             response=f"Response {i}")))
+                    for i in range(3)]
+            while len(buffer._pending) < len(runs):
+                await asyncio.sleep(0)
+            assert buffer.pending_agent_ids() == {agent["id"]}
+            await buffer.flush()
+            return await asyncio.gather(*runs, return_exceptions=True)
+
+        results = client.portal.call(write)
+        assert isinstance(results[0], RuntimeError)
+        assert [execution.id for execution in results[1:]] == [taken + 10 ** 6, taken + 10 ** 6 + 1]
+        assert not buffer._pending
+        for execution in results[1:]:
+            response = client.get(url=f"/executions/{execution.id}", headers=real_header)
+            assert response.json()["response"] == execution.response
+
+    def test_write_behind_inserts_rows_added_after_stop(self, client, agent1, real_header, monkeypatch):
+        agent = client.post(url="/agents", json=agent1, headers=real_header).json()
+        taken = client.post(url=f"/agents/{agent['id']}/run", json={"task": "Task", "model": "gpt-4o"},
+                            headers=real_header).json()["execution_id"]
+        buffer = ExecutionWriteBehind(enabled=True, batch_size=10, interval=60, durability=DURABILITY_FLUSHED)
+
+        async def allocate_ids(count):
+            return [taken + 2 * 10 ** 6 + i for i in range(count)]
+
+        monkeypatch.setattr(buffer, "_allocate_ids", allocate_ids)
+
+        async def write():
+            # A run whose model call outlasted shutdown adds its row after the final flush.
+            await buffer.start()
+            await buffer.stop()
+            return await asyncio.wait_for(
+                buffer.add(Execution(tenant_id="tenant_a", agent_id=agent["id"], prompt="Prompt",
+                                     model="gpt-4o", response="Late response")),
+                timeout=5
+            )
+
+        execution = client.portal.call(write)
+        assert not buffer._pending
+        response = client.get(url=f"/executions/{execution.id}", headers=real_header)
+        assert response.status_code == 200
+        assert response.json()["response"] == "Late response"
+
+    @pytest.mark.skipif(not URL_DATABASE.startswith("postgresql"),
+                        reason="write-behind takes execution ids from a PostgreSQL sequence")
+    def test_run_agent_write_behind(self, client, agent1, real_header, flush_redis, monkeypatch):
+        buffer = ExecutionWriteBehind(enabled=True, batch_size=10, interval=60, id_block_size=2)
+        client.portal.call(buffer.start)
+        monkeypatch.setattr(agents, "execution_write_behind", buffer)
+        agent = client.post(url="/agents",
+                            json=agent1,
+                            headers=real_header).json()
+        runs = [client.post(url=f"/agents/{agent['id']}/run",
+                            json={"task": f"Task {i}", "model": "gpt-4o"},
+                            headers=real_header).json()
+                for i in range(3)]
+        assert len({run["execution_id"] for run in runs}) == 3
+        assert client.get(url=f"/executions/{runs[0]['execution_id']}", headers=real_header).status_code == 404
+
+        client.portal.call(buffer.stop)
+        for run in runs:
+            response = client.get(url=f"/executions/{run['execution_id']}", headers=real_header)
+            assert response.status_code == 200
+            assert response.json()["response"] == run["response"]
+        stats = client.get(url="/executions/stats",
+                           params={"granularity": "day", "agent_id": agent["id"]},
+                           headers=real_header).json()
+        assert sum(bucket["runs"] for bucket in stats) == 3
+
 
 if __name__ == "__main__":
     pytest.main([__file__, "-v"])
@@ -1,19 +1,70 @@
+import asyncio
+import base64
+import json
+import math
+import os
+import time
+import uuid
+from collections import defaultdict
 from datetime import datetime, timedelta
-from typing import Annotated
+from typing import Annotated, Literal, NamedTuple, Tuple
 
-import redis
+import redis.asyncio as redis
 from fastapi import Header, Depends, HTTPException
-from sqlalchemy.orm import Session
+from redis.exceptions import ConnectionError as RedisConnectionError
+from sqlalchemy import func
+from sqlalchemy.ext.asyncio import AsyncSession
 
 from database import SessionLocal
-from models import Agent
+from metrics import rate_limit_decisions, pool_connections, pool_timeouts, pool_wait_seconds, redis_call_duration
 
-redis_client = redis.Redis(
+# Per worker process. Commands wait up to REDIS_POOL_TIMEOUT seconds for a free connection before the
+# request is answered with 503. Long-lived connections (pub/sub listeners, background workers' BRPOP) count
+# against REDIS_MAX_CONNECTIONS, and REDIS_SOCKET_TIMEOUT must stay above worker.POLL_TIMEOUT.
+REDIS_MAX_CONNECTIONS = int(os.getenv("REDIS_MAX_CONNECTIONS", "100"))
+REDIS_POOL_TIMEOUT = float(os.getenv("REDIS_POOL_TIMEOUT", "5"))
+REDIS_SOCKET_TIMEOUT = float(os.getenv("REDIS_SOCKET_TIMEOUT", "5"))
+REDIS_SOCKET_CONNECT_TIMEOUT = float(os.getenv("REDIS_SOCKET_CONNECT_TIMEOUT", "2"))
+REDIS_HEALTH_CHECK_INTERVAL = int(os.getenv("REDIS_HEALTH_CHECK_INTERVAL", "30"))
+
+
+class RedisPoolTimeout(RedisConnectionError):
+    """No Redis connection became free within the pool timeout."""
+
+
+class InstrumentedRedisPool(redis.BlockingConnectionPool):
+    """Blocking pool that records how long commands wait for a connection and how often they give up."""
+
+    async def get_connection(self, *args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return await super().get_connection(*args, **kwargs)
+        except RedisConnectionError as error:
+            if not isinstance(error.__cause__, asyncio.TimeoutError):
+                raise
+            pool_timeouts.inc(pool="redis")
+            raise RedisPoolTimeout(str(error)) from error
+        finally:
+            pool_wait_seconds.observe(time.perf_counter() - start, pool="redis")
+
+    def report(self):
+        pool_connections.set(len(getattr(self, "_in_use_connections", ())), pool="redis", state="in_use")
+        pool_connections.set(len(getattr(self, "_available_connections", ())), pool="redis", state="idle")
+
+
+redis_pool = InstrumentedRedisPool(
     host='localhost',
     port=6379,
     db=0,
-    decode_responses=True
+    decode_responses=True,
+    max_connections=REDIS_MAX_CONNECTIONS,
+    timeout=REDIS_POOL_TIMEOUT,
+    socket_timeout=REDIS_SOCKET_TIMEOUT,
+    socket_connect_timeout=REDIS_SOCKET_CONNECT_TIMEOUT,
+    health_check_interval=REDIS_HEALTH_CHECK_INTERVAL
 )
+pool_connections.add_callback(redis_pool.report)
+redis_client = redis.Redis(connection_pool=redis_pool)
 REDIS_KEY = "rate_limit"
 
 API_KEYS = {
@@ -23,7 +74,20 @@ API_KEYS = {
     },
     "tenant_b": {
         "request_limit": 200,
-        "limit_window": timedelta(days=1)
+        "limit_window": timedelta(days=1),
+        # Optional local tier: each worker leases `lease_size` tokens from Redis and spends them
+        # in-process for up to `lease_ttl`. Set lease_size to 0 (or omit it) to always ask Redis.
+        "lease_size": 20,
+        "lease_ttl": timedelta(seconds=10),
+        # Optional: reuse model responses for identical (prompt, model) runs for this long.
+        "response_cache_ttl": timedelta(minutes=10),
+        # Optional: executions older than this are moved to compressed archive segments (see archive.py).
+        "retention": timedelta(days=90),
+        # Optional: at most `max_concurrency` runs in flight across workers; up to `max_queue` more wait
+        # up to `queue_timeout` for a slot (see concurrency.py).
+        "max_concurrency": 5,
+        "max_queue": 10,
+        "queue_timeout": timedelta(seconds=10)
     },
     "tenant_c": {
         "request_limit": 2,
@@ -33,13 +97,15 @@ API_KEYS = {
 
 SUPPORTED_MODELS = ["gpt-4o", "gpt-4-turbo", "claude-3-opus"]
 
+DEFAULT_PAGE_SIZE = 100
+MAX_PAGE_SIZE = 1000
+# How list filters compare names: equal, or case-insensitive prefix.
+NameMatch = Literal["exact", "prefix"]
 
-def get_db():
-    db = SessionLocal()
-    try:
+
+async def get_db():
+    async with SessionLocal() as db:
         yield db
-    finally:
-        db.close()
 
 
 def verify_api_key(tenant_id_header: str = Header(..., alias="x-api-key")):
@@ -49,47 +115,294 @@ def verify_api_key(tenant_id_header: str = Header(..., alias="x-api-key")):
     return tenant_id_header
 
 
-db_dependency = Annotated[Session, Depends(get_db)]
+db_dependency = Annotated[AsyncSession, Depends(get_db)]
 api_key_dependency = Annotated[str, Depends(verify_api_key)]
 
 
-def check_tenant_limit(tenant_id):
-    tenant = API_KEYS.get(tenant_id)
-    now = datetime.utcnow()
+class RateLimitResult(NamedTuple):
+    allowed: bool
+    limit: int
+    remaining: int
+    reset_after: float
+
+
+class Reservation(NamedTuple):
+    """How many of a batch's requests got a token, the limit state after reserving them, and the window
+    members of the granted tokens, for release_tenant_limit."""
+    granted: int
+    result: RateLimitResult
+    members: Tuple[str, ...] = ()
+
+
+# Sliding-window log kept in a sorted set scored by request time (ms, Redis server clock).
+# Returning the members in ARGV[5..] (unspent tokens of an earlier reservation), trimming, counting and
+# reserving up to ARGV[4] tokens happen in one atomic round-trip.
+SLIDING_WINDOW_SCRIPT = redis_client.register_script("""
+local key = KEYS[1]
+local window = tonumber(ARGV[1])
+local limit = tonumber(ARGV[2])
+local member = ARGV[3]
+local requested = tonumber(ARGV[4])
+local time = redis.call('TIME')
+local now = tonumber(time[1]) * 1000 + math.floor(tonumber(time[2]) / 1000)
+
+if #ARGV > 4 then
+    redis.call('ZREM', key, unpack(ARGV, 5))
+end
+redis.call('ZREMRANGEBYSCORE', key, '-inf', now - window)
+local count = redis.call('ZCARD', key)
+local granted = math.max(0, math.min(requested, limit - count))
+for i = 1, granted do
+    redis.call('ZADD', key, now, member .. ':' .. i)
+end
+count = count + granted
+redis.call('PEXPIRE', key, window)
 
-    count = redis_client.get(f"{REDIS_KEY}:{tenant_id}:count")
-    count = int(count) if count else 0
-    last_reset = redis_client.get(f"{REDIS_KEY}:{tenant_id}:last_reset")
-    if last_reset:
-        last_reset = datetime.fromisoformat(last_reset)
+local reset_after = window
+local oldest = redis.call('ZRANGE', key, 0, 0, 'WITHSCORES')
+if oldest[2] then
+    reset_after = tonumber(oldest[2]) + window - now
+end
+return {granted, limit - count, reset_after}
+""")
 
-    else:
-        last_reset = now
-        redis_client.set(f"{REDIS_KEY}:{tenant_id}:last_reset", now.isoformat())
 
-    time_diff = now - last_reset
-    if time_diff >= tenant["limit_window"]:
-        redis_client.set(f"{REDIS_KEY}:{tenant_id}:count", 0)
-        redis_client.set(f"{REDIS_KEY}:{tenant_id}:last_reset", now.isoformat())
-        count = 0
+async def reserve_tokens(tenant_id, count=1, member=None, release=()):
+    """Atomically takes up to `count` tokens from the tenant's Redis window, recorded as the members
+    `member:1` to `member:<granted>`, after giving back the `release` members of an earlier reservation.
 
-    if count >= tenant["request_limit"]:
-        return False
+    Returns (granted, remaining, reset_after_seconds)."""
+    tenant = API_KEYS.get(tenant_id)
+    window_ms = int(tenant["limit_window"].total_seconds() * 1000)
+    with redis_call_duration.time(operation="rate_limit"):
+        granted, remaining, reset_after_ms = await SLIDING_WINDOW_SCRIPT(
+            keys=[f"{REDIS_KEY}:{tenant_id}"],
+            args=[window_ms, tenant["request_limit"], member or uuid.uuid4().hex, count, *release],
+            client=redis_client
+        )
+    return int(granted), int(remaining), int(reset_after_ms) / 1000
+
+
+class TokenLease:
+    def __init__(self, member, granted, tokens, remaining, reset_at, expires_at):
+        self.member = member
+        self.granted = granted
+        self.tokens = tokens
+        self.remaining = remaining
+        self.reset_at = reset_at
+        self.expires_at = expires_at
+
+    def unspent(self):
+        """Window members of the tokens not spent yet; tokens are spent from `member:1` up."""
+        return [f"{self.member}:{i}" for i in range(self.granted - self.tokens + 1, self.granted + 1)]
 
-    redis_client.incr(f"{REDIS_KEY}:{tenant_id}:count")
-    return True
 
+class LocalTokenCache:
+    """Per-worker tier in front of Redis.
 
-def generate_prompt(agent: Agent, task: str):
-    prompt_msg = f"""    You are {agent.name}, {agent.role}.
-    Description: {agent.description}
-    Available tools: {agent.tools or "No tools available"}
-    Task: {task}
-    Please complete the task using the information and tools available to you.
+    Leased tokens are already recorded in the Redis window, so the tenant limit is never exceeded.
+    What the lease trades is timing: a token counted at lease time may be spent up to `lease_ttl`
+    later, so in any window a tenant can see at most `lease_size` extra requests per worker that were
+    counted in the previous window. Tokens left when a lease expires are removed from the window by the
+    next lease, so a tenant with fewer than `lease_size` requests per `lease_ttl` can still use its whole
+    limit; until then they hold at most `lease_size` tokens per worker.
     """
-    return prompt_msg
+
+    def __init__(self, clock=time.monotonic):
+        self._leases = {}
+        self._locks = defaultdict(asyncio.Lock)
+        self._clock = clock
+
+    def _spend(self, tenant_id, tenant):
+        lease = self._leases.get(tenant_id)
+        now = self._clock()
+        if not lease or lease.tokens <= 0 or lease.expires_at <= now:
+            return None
+        lease.tokens -= 1
+        return RateLimitResult(
+            allowed=True,
+            limit=tenant["request_limit"],
+            remaining=lease.remaining + lease.tokens,
+            reset_after=max(0.0, lease.reset_at - now)
+        )
+
+    async def acquire(self, tenant_id) -> RateLimitResult:
+        tenant = API_KEYS.get(tenant_id)
+        result = self._spend(tenant_id, tenant)
+        if result:
+            rate_limit_decisions.inc(tenant=tenant_id, tier="local", outcome="allowed")
+            return result
+
+        async with self._locks[tenant_id]:
+            # Another request may have refilled the lease while this one waited for the lock.
+            result = self._spend(tenant_id, tenant)
+            if result:
+                rate_limit_decisions.inc(tenant=tenant_id, tier="local", outcome="allowed")
+                return result
+
+            previous = self._leases.get(tenant_id)
+            member = uuid.uuid4().hex
+            granted, remaining, reset_after = await reserve_tokens(
+                tenant_id, tenant["lease_size"], member, previous.unspent() if previous else ()
+            )
+            self._leases.pop(tenant_id, None)
+            now = self._clock()
+            if not granted:
+                rate_limit_decisions.inc(tenant=tenant_id, tier="redis", outcome="rejected")
+                return RateLimitResult(False, tenant["request_limit"], 0, reset_after)
+
+            self._leases[tenant_id] = TokenLease(
+                member=member,
+                granted=granted,
+                tokens=granted - 1,
+                remaining=remaining,
+                reset_at=now + reset_after,
+                expires_at=now + tenant["lease_ttl"].total_seconds()
+            )
+            rate_limit_decisions.inc(tenant=tenant_id, tier="redis", outcome="allowed")
+            return RateLimitResult(True, tenant["request_limit"], remaining + granted - 1, reset_after)
+
+    async def reserve(self, tenant_id, count) -> Reservation:
+        """Takes up to `count` tokens, from this worker's lease first and the rest straight from Redis.
+
+        The rest is not leased: a batch already reserves its tokens in one round-trip."""
+        tenant = API_KEYS.get(tenant_id)
+        async with self._locks[tenant_id]:
+            lease = self._leases.get(tenant_id)
+            now = self._clock()
+            expired = lease if lease and lease.expires_at <= now else None
+            local, members = 0, []
+            if lease and not expired:
+                local = min(count, lease.tokens)
+                spent = lease.granted - lease.tokens
+                members = [f"{lease.member}:{i}" for i in range(spent + 1, spent + local + 1)]
+                lease.tokens -= local
+                rate_limit_decisions.inc(local, tenant=tenant_id, tier="local", outcome="allowed")
+                if local == count:
+                    return Reservation(local, RateLimitResult(True, tenant["request_limit"],
+                                                              lease.remaining + lease.tokens,
+                                                              max(0.0, lease.reset_at - now)), tuple(members))
+
+            member = uuid.uuid4().hex
+            granted, remaining, reset_after = await reserve_tokens(
+                tenant_id, count - local, member, release=expired.unspent() if expired else ()
+            )
+            members += [f"{member}:{i}" for i in range(1, granted + 1)]
+            if expired:
+                self._leases.pop(tenant_id, None)
+            rate_limit_decisions.inc(granted, tenant=tenant_id, tier="redis", outcome="allowed")
+            rate_limit_decisions.inc(count - local - granted, tenant=tenant_id, tier="redis", outcome="rejected")
+            if lease and not expired:
+                remaining += lease.tokens
+            return Reservation(local + granted, RateLimitResult(local + granted > 0, tenant["request_limit"],
+                                                                remaining, reset_after), tuple(members))
+
+
+local_token_cache = LocalTokenCache()
+
+
+async def check_tenant_limit(tenant_id) -> RateLimitResult:
+    tenant = API_KEYS.get(tenant_id)
+    if tenant.get("lease_size"):
+        return await local_token_cache.acquire(tenant_id)
+
+    granted, remaining, reset_after = await reserve_tokens(tenant_id)
+    rate_limit_decisions.inc(tenant=tenant_id, tier="redis", outcome="allowed" if granted else "rejected")
+    return RateLimitResult(
+        allowed=bool(granted),
+        limit=tenant["request_limit"],
+        remaining=remaining,
+        reset_after=reset_after
+    )
+
+
+async def reserve_tenant_limit(tenant_id, count) -> Reservation:
+    """Reserves up to `count` requests in one step, spending the worker's lease first when the tenant has
+    the local tier; `remaining` in the result is what is left after the reservation."""
+    tenant = API_KEYS.get(tenant_id)
+    if tenant.get("lease_size"):
+        return await local_token_cache.reserve(tenant_id, count)
+
+    member = uuid.uuid4().hex
+    granted, remaining, reset_after = await reserve_tokens(tenant_id, count, member)
+    rate_limit_decisions.inc(granted, tenant=tenant_id, tier="redis", outcome="allowed")
+    rate_limit_decisions.inc(count - granted, tenant=tenant_id, tier="redis", outcome="rejected")
+    return Reservation(granted, RateLimitResult(
+        allowed=granted > 0,
+        limit=tenant["request_limit"],
+        remaining=remaining,
+        reset_after=reset_after
+    ), tuple(f"{member}:{i}" for i in range(1, granted + 1)))
+
+
+async def release_tenant_limit(tenant_id, members):
+    """Gives back reserved tokens that were not used, by their window `members` (see Reservation).
+
+    Tokens of a worker's lease are removed from the window too; the lease already counts them as spent."""
+    if members:
+        await reserve_tokens(tenant_id, 0, release=members)
+
+
+def rate_limit_headers(result: RateLimitResult):
+    reset_after = str(math.ceil(result.reset_after))
+    headers = {
+        "X-RateLimit-Limit": str(result.limit),
+        "X-RateLimit-Remaining": str(result.remaining),
+        "X-RateLimit-Reset": reset_after
+    }
+    if not result.allowed:
+        headers["Retry-After"] = reset_after
+    return headers
+
+
+def check_bulk_errors(mode: str, errors: dict):
+    """`errors` maps item index to (status_code, detail). In atomic mode any error rejects the request
+    with 400 and the per-item errors as detail."""
+    if mode == "atomic" and errors:
+        raise HTTPException(status_code=400, detail=[
+            {"index": index, "status_code": status_code, "detail": detail}
+            for index, (status_code, detail) in sorted(errors.items())
+        ])
+
+
+def _encode_cursor(payload: dict) -> str:
+    payload = json.dumps(payload, separators=(",", ":"))
+    return base64.urlsafe_b64encode(payload.encode()).decode().rstrip("=")
+
+
+def _decode_cursor(cursor: str, parse):
+    try:
+        return parse(json.loads(base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4))))
+    except (ValueError, KeyError, TypeError):
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+
+
+def encode_cursor(timestamp: datetime, row_id: int):
+    return _encode_cursor({"ts": timestamp.isoformat(), "id": row_id})
+
+
+def decode_cursor(cursor: str):
+    return _decode_cursor(cursor, lambda payload: (datetime.fromisoformat(payload["ts"]), int(payload["id"])))
+
+
+def encode_rank_cursor(rank: float, row_id: int):
+    return _encode_cursor({"rank": rank, "id": row_id})
+
+
+def decode_rank_cursor(cursor: str):
+    return _decode_cursor(cursor, lambda payload: (float(payload["rank"]), int(payload["id"])))
+
+
+def encode_id_cursor(row_id: int):
+    return _encode_cursor({"id": row_id})
+
+
+def decode_id_cursor(cursor: str):
+    return _decode_cursor(cursor, lambda payload: int(payload["id"]))
 
 
-def mock_llm_call(prompt: str, model: str):
-    mock_res = prompt.split("\n")[0].strip()
-    return f"[mock-response from {model}]: {mock_res}"
+def name_filter(column, value: str, match: NameMatch):
+    """`column` equal to `value`, or starting with it ignoring case, which models.name_indexes serve."""
+    if match == "prefix":
+        return func.lower(column).startswith(value.lower(), autoescape=True)
+    return column == value
@@ -0,0 +1,200 @@
+import asyncio
+import json
+import logging
+import math
+import os
+from contextlib import asynccontextmanager
+
+from fastapi import HTTPException
+
+from concurrency import RunSlotBusy
+from database import SessionLocal
+from etag import bump_versions
+from models import Execution, EXECUTION_QUEUED, EXECUTION_RUNNING, EXECUTION_SUCCEEDED, EXECUTION_FAILED
+from cache import cached_call_llm
+from rollups import record_executions
+from search import index_executions
+from utils import API_KEYS, redis_client
+
+logger = logging.getLogger(__name__)
+
+QUEUE_KEY = "execution_queue"
+DONE_CHANNEL = "execution_done"
+EXECUTION_WORKERS = int(os.getenv("EXECUTION_WORKERS", "4"))
+POLL_TIMEOUT = 1
+# Expired slot leases are not announced, so a queue paused for a busy tenant is retried after this long anyway.
+QUEUE_PAUSE_TIMEOUT = 5
+
+
+def done_channel(execution_id: int):
+    return f"{DONE_CHANNEL}:{execution_id}"
+
+
+def queue_key(tenant_id: str):
+    return f"{QUEUE_KEY}:{tenant_id}"
+
+
+# Pushes the job ARGV[1] unless the queue already holds ARGV[2] jobs (a negative cap means none), in one
+# atomic step so concurrent runs cannot overfill it. Returns the new length, or -1 when the queue is full.
+ENQUEUE_SCRIPT = redis_client.register_script("""
+local max_queue = tonumber(ARGV[2])
+if max_queue >= 0 and redis.call('LLEN', KEYS[1]) >= max_queue then
+    return -1
+end
+return redis.call('LPUSH', KEYS[1], ARGV[1])
+""")
+
+
+async def enqueue_execution(execution_id: int, tenant_id: str, use_cache: bool = True):
+    """Queues the execution for the worker pool; 429 when the tenant already has `max_queue` jobs waiting."""
+    tenant = API_KEYS[tenant_id]
+    job = json.dumps({"execution_id": execution_id, "tenant_id": tenant_id, "use_cache": use_cache})
+    length = await ENQUEUE_SCRIPT(keys=[queue_key(tenant_id)], args=[job, tenant.get("max_queue", -1)],
+                                  client=redis_client)
+    if length < 0:
+        timeout = tenant.get("queue_timeout")
+        retry_after = max(1, math.ceil(timeout.total_seconds())) if timeout else 1
+        raise HTTPException(status_code=429, detail="Too many queued runs", headers={"Retry-After": str(retry_after)})
+
+
+async def process_execution(execution_id: int, use_cache: bool = True, tenant_id: str = None):
+    """Runs a queued execution.
+
+    Its model call holds one of the tenant's run slots, unless it joins an identical call already in flight.
+    The call does not wait for a slot: when none is free the job goes back to the head of the tenant's queue
+    and the HTTPException (RunSlotBusy for the call's own slot) is raised again for the worker pool."""
+    try:
+        await run_execution(execution_id, use_cache)
+    except HTTPException:
+        await redis_client.rpush(queue_key(tenant_id) if tenant_id else QUEUE_KEY, json.dumps(
+            {"execution_id": execution_id, "tenant_id": tenant_id, "use_cache": use_cache}
+        ))
+        raise
+
+
+async def run_execution(execution_id: int, use_cache: bool = True):
+    """Runs the execution if it is still queued; if its model call gets no run slot it is left queued and the
+    HTTPException is raised."""
+    async with SessionLocal() as db:
+        execution = await db.get(Execution, execution_id)
+        if not execution or execution.status != EXECUTION_QUEUED:
+            return
+        execution.status = EXECUTION_RUNNING
+        await db.commit()
+        await bump_versions(execution.tenant_id, "executions", f"execution:{execution_id}")
+
+        try:
+            execution.response, execution.cached = await cached_call_llm(
+                execution.tenant_id, execution.agent_id, execution.prompt, execution.model, use_cache,
+                wait_for_slot=False
+            )
+            execution.status = EXECUTION_SUCCEEDED
+        except HTTPException:
+            # No run slot, for this call or the identical one it joined.
+            execution.status = EXECUTION_QUEUED
+            await db.commit()
+            await bump_versions(execution.tenant_id, "executions", f"execution:{execution_id}")
+            raise
+        except Exception as exc:
+            logger.exception("Execution %s failed", execution_id)
+            execution.status = EXECUTION_FAILED
+            execution.error = str(exc)
+        await record_executions(db, [execution])
+        await index_executions(db, [execution])
+        await db.commit()
+    await bump_versions(execution.tenant_id, "executions", f"execution:{execution_id}")
+    await redis_client.publish(done_channel(execution_id), execution.status)
+
+
+class ExecutionWorkerPool:
+    """Drains the Redis execution queues with `size` concurrent workers per process.
+
+    Each tenant has its own queue, and successive pops start from successive tenants, so a tenant with a
+    long backlog takes turns with the others instead of running ahead of them. A job whose tenant has no free
+    run slot goes back to its queue, and that queue is skipped until one of the tenant's slots is released,
+    so workers keep serving the other tenants meanwhile.
+
+    Jobs are popped once, so delivery is at-most-once: a process killed mid-run leaves its
+    execution in `running`. Stopping lets each worker finish its current job first."""
+
+    def __init__(self, size: int = EXECUTION_WORKERS):
+        self.size = size
+        self._stopping = asyncio.Event()
+        self._tasks = []
+        self._next_tenant = 0
+        # Queue key -> (event set at the tenant's next slot release, loop time to retry by at the latest).
+        self._paused = {}
+
+    def queue_keys(self):
+        """Tenant queues in round-robin order, then the shared queue jobs were enqueued on before, leaving out
+        paused queues."""
+        tenants = list(API_KEYS)
+        start = self._next_tenant % len(tenants)
+        self._next_tenant += 1
+        keys = [queue_key(tenant_id) for tenant_id in tenants[start:] + tenants[:start]] + [QUEUE_KEY]
+        return [key for key in keys if not self._is_paused(key)]
+
+    def pause(self, key: str, released: asyncio.Event):
+        self._paused[key] = (released, asyncio.get_running_loop().time() + QUEUE_PAUSE_TIMEOUT)
+
+    def _is_paused(self, key):
+        if key not in self._paused:
+            return False
+        released, until = self._paused[key]
+        if released.is_set() or asyncio.get_running_loop().time() >= until:
+            del self._paused[key]
+            return False
+        return True
+
+    def start(self):
+        self._stopping.clear()
+        self._tasks = [asyncio.create_task(self._work()) for _ in range(self.size)]
+
+    async def stop(self):
+        self._stopping.set()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    async def _work(self):
+        while not self._stopping.is_set():
+            try:
+                keys = self.queue_keys()
+                if not keys:
+                    await asyncio.sleep(POLL_TIMEOUT)
+                    continue
+                item = await redis_client.brpop(keys, timeout=POLL_TIMEOUT)
+                if not item:
+                    continue
+                job = json.loads(item[1])
+                try:
+                    await process_execution(job["execution_id"], job.get("use_cache", True), job.get("tenant_id"))
+                except RunSlotBusy as busy:
+                    self.pause(item[0], busy.released)
+                except HTTPException:
+                    # The identical call this job joined got no slot; the job is queued again.
+                    pass
+            except Exception:
+                logger.exception("Execution worker error")
+                await asyncio.sleep(POLL_TIMEOUT)
+
+
+@asynccontextmanager
+async def execution_done_listener(execution_id: int):
+    """Subscribes to the completion of `execution_id` and yields `wait(timeout)`.
+
+    Subscribe before re-reading the execution status so a completion published in between is not missed."""
+    pubsub = redis_client.pubsub()
+    await pubsub.subscribe(done_channel(execution_id))
+
+    async def wait(timeout: float):
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + timeout
+        while (remaining := deadline - loop.time()) > 0:
+            if await pubsub.get_message(ignore_subscribe_messages=True, timeout=remaining):
+                return
+
+    try:
+        yield wait
+    finally:
+        await pubsub.unsubscribe()
+        await pubsub.aclose()
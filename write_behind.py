@@ -0,0 +1,224 @@
+import asyncio
+import logging
+import os
+from collections import deque
+from typing import List
+
+from sqlalchemy import insert, inspect, text
+from sqlalchemy.exc import DataError, IntegrityError
+
+from database import engine
+from etag import bump_versions
+from models import Execution
+from rollups import add_rollups, aggregate, execution_usage
+from search import index_executions
+
+logger = logging.getLogger(__name__)
+
+DURABILITY_BUFFERED = "buffered"
+DURABILITY_FLUSHED = "flushed"
+
+WRITE_BEHIND = os.getenv("EXECUTION_WRITE_BEHIND", "0") == "1"
+WRITE_BEHIND_BATCH_SIZE = int(os.getenv("EXECUTION_WRITE_BEHIND_BATCH_SIZE", "500"))
+WRITE_BEHIND_INTERVAL = float(os.getenv("EXECUTION_WRITE_BEHIND_INTERVAL_MS", "50")) / 1000
+WRITE_BEHIND_DURABILITY = os.getenv("EXECUTION_WRITE_BEHIND_DURABILITY", DURABILITY_BUFFERED)
+EXECUTION_ID_BLOCK_SIZE = int(os.getenv("EXECUTION_ID_BLOCK_SIZE", "1000"))
+
+ALLOCATE_IDS_SQL = text(
+    "SELECT nextval(pg_get_serial_sequence('execution', 'id')) FROM generate_series(1, :count)"
+)
+
+
+class ExecutionWriteBehind:
+    """Buffers finished executions in memory and inserts them in batches.
+
+    Ids are taken from blocks of the execution id sequence reserved ahead of time, so an execution can be
+    returned before its row exists. The buffer is flushed with one multi-row insert, plus the rollup and
+    search index updates of its rows, once it holds `batch_size` rows or every `interval` seconds, and on stop.
+    A batch the database rejects for its data is retried row by row, and rows that still fail are logged and
+    dropped, so one bad row cannot hold up the rest; other errors keep the batch queued for the next flush.
+
+    With `buffered` durability a run returns as soon as its row is queued, and a crash loses whatever was
+    not flushed yet. With `flushed` it waits for the commit of the batch holding its row, which still groups
+    concurrent runs into a single insert. The sequence is PostgreSQL only; elsewhere the buffer stays off."""
+
+    def __init__(self,
+                 enabled: bool = WRITE_BEHIND,
+                 batch_size: int = WRITE_BEHIND_BATCH_SIZE,
+                 interval: float = WRITE_BEHIND_INTERVAL,
+                 durability: str = WRITE_BEHIND_DURABILITY,
+                 id_block_size: int = EXECUTION_ID_BLOCK_SIZE):
+        if durability not in (DURABILITY_BUFFERED, DURABILITY_FLUSHED):
+            raise ValueError(f"Unknown write-behind durability: {durability}")
+        self.enabled = enabled
+        self.batch_size = batch_size
+        self.interval = interval
+        self.durability = durability
+        self.id_block_size = id_block_size
+        # Runs block on a flush once this many rows are waiting, so a stalled database cannot grow the buffer forever.
+        self.max_pending = batch_size * 10
+        self.active = False
+        self._pending = []
+        # The batch being inserted; its rows are neither pending nor committed.
+        self._flushing = []
+        self._ids = deque()
+        self._id_lock = asyncio.Lock()
+        self._flush_lock = asyncio.Lock()
+        self._wakeup = asyncio.Event()
+        self._task = None
+
+    async def start(self):
+        if not self.enabled:
+            return
+        if engine.dialect.name != "postgresql":
+            logger.warning("Execution write-behind needs PostgreSQL, writing executions directly")
+            return
+        self.active = True
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        """Stops accepting rows and flushes everything still buffered."""
+        if not self.active:
+            return
+        self.active = False
+        self._wakeup.set()
+        await asyncio.gather(self._task, return_exceptions=True)
+        self._task = None
+        try:
+            await self.flush()
+        except Exception:
+            logger.exception("Dropping %s buffered executions on shutdown", len(self._pending))
+            self._fail_pending()
+
+    async def add(self, execution: Execution) -> Execution:
+        await self.add_all([execution])
+        return execution
+
+    async def add_all(self, executions: List[Execution]):
+        """Assigns ids and column defaults to `executions` and queues them for insert.
+
+        Once the buffer is stopped its final flush has already run, so the rows are inserted right away."""
+        if not executions:
+            return
+        while self.active and len(self._pending) >= self.max_pending:
+            await self.flush()
+        ids = await self._take_ids(len(executions))
+        active = self.active
+        waiter = (asyncio.get_running_loop().create_future()
+                  if active and self.durability == DURABILITY_FLUSHED else None)
+        entries = []
+        for execution, execution_id in zip(executions, ids):
+            execution.id = execution_id
+            row = {}
+            for attribute in inspect(Execution).column_attrs:
+                column = attribute.columns[0]
+                if getattr(execution, attribute.key) is None and column.default is not None:
+                    setattr(execution, attribute.key, column.default.arg(None) if column.default.is_callable
+                            else column.default.arg)
+                row[column.key] = getattr(execution, attribute.key)
+            entries.append((row, execution, waiter))
+        if not active:
+            await self._insert(entries)
+            await self._bump(entries)
+            return
+        self._pending.extend(entries)
+        if len(self._pending) >= self.batch_size:
+            self._wakeup.set()
+        if waiter:
+            await waiter
+
+    def pending_agent_ids(self) -> set:
+        """Agents with executions in this process's buffer that are not committed yet."""
+        return {execution.agent_id for _, execution, _ in self._pending + self._flushing}
+
+    async def flush(self):
+        async with self._flush_lock:
+            while self._pending:
+                batch, self._pending = self._pending[:self.batch_size], self._pending[self.batch_size:]
+                self._flushing = batch
+                try:
+                    await self._insert(batch)
+                except (DataError, IntegrityError):
+                    logger.warning("Execution write-behind batch rejected, inserting its rows one by one")
+                    batch = await self._insert_each(batch)
+                except Exception:
+                    self._pending[:0] = batch
+                    raise
+                finally:
+                    self._flushing = []
+                self._settle(batch)
+                await self._bump(batch)
+
+    async def _insert(self, batch):
+        async with engine.begin() as conn:
+            await conn.execute(insert(Execution.__table__), [row for row, _, _ in batch])
+            executions = [execution for _, execution, _ in batch]
+            await add_rollups(conn, aggregate(execution_usage(execution.tenant_id, execution)
+                                              for execution in executions))
+            await index_executions(conn, executions)
+
+    @staticmethod
+    async def _bump(batch):
+        for tenant_id in {row["tenant_id"] for row, _, _ in batch}:
+            await bump_versions(tenant_id, "executions")
+
+    async def _insert_each(self, batch):
+        """Inserts the rows of `batch` one at a time and returns those inserted; rows rejected for their data
+        are dropped and fail their waiters."""
+        inserted = []
+        for position, entry in enumerate(batch):
+            try:
+                await self._insert([entry])
+            except (DataError, IntegrityError):
+                logger.exception("Dropping execution %s that cannot be inserted", entry[0]["id"])
+                self._fail([entry])
+            except Exception:
+                self._pending[:0] = batch[position:]
+                self._settle(inserted)
+                raise
+            else:
+                inserted.append(entry)
+        return inserted
+
+    async def _run(self):
+        while self.active:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), self.interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            try:
+                await self.flush()
+            except Exception:
+                logger.exception("Execution write-behind flush failed, retrying")
+
+    async def _take_ids(self, count: int) -> List[int]:
+        async with self._id_lock:
+            if len(self._ids) < count:
+                self._ids.extend(await self._allocate_ids(max(count - len(self._ids), self.id_block_size)))
+            return [self._ids.popleft() for _ in range(count)]
+
+    async def _allocate_ids(self, count: int) -> List[int]:
+        async with engine.connect() as conn:
+            result = await conn.execute(ALLOCATE_IDS_SQL, {"count": count})
+            return [row[0] for row in result]
+
+    def _settle(self, entries):
+        """Resolves the waiters of `entries` whose runs have no rows left in the buffer."""
+        queued = {waiter for _, _, waiter in self._pending}
+        for _, _, waiter in entries:
+            if waiter and not waiter.done() and waiter not in queued:
+                waiter.set_result(None)
+
+    @staticmethod
+    def _fail(entries):
+        for _, _, waiter in entries:
+            if waiter and not waiter.done():
+                waiter.set_exception(RuntimeError("Execution was not persisted"))
+
+    def _fail_pending(self):
+        self._fail(self._pending)
+        self._pending = []
+
+
+execution_write_behind = ExecutionWriteBehind()